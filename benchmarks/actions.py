@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+'''
+Throughput and latency of the core actions, on two backends: a
+MockConfigurationManager (the fake filesystem the tests use) and a
+ConfigurationManager working in a directory on tmpfs (/dev/shm, where
+there is one), so that neither measures the disk.
+
+Most cases are run cold (nothing there yet) and warm (run again, with
+nothing to change), which is the common case in a converge.  Accounts
+are only benchmarked on tmpfs, against passwd, group and shadow files
+of thousands of accounts there; the mock keeps its accounts in lists.
+Neither backend runs any commands.
+
+Results are written as json (--output), and --compare reports how a
+run differs from an earlier one, so runs can be compared between
+commits:
+
+    python benchmarks/actions.py --output before.json
+    git checkout ...
+    python benchmarks/actions.py --compare before.json
+'''
+
+import argparse
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path.insert(0, ROOT)
+
+import carlcm
+
+def _no_commands(*args, **kwargs):
+    raise AssertionError('a benchmark ran a command: %r' % (args,))
+
+class MockBackend(object):
+
+    name = 'mock'
+
+    def __enter__(self):
+        self.root = '/bench'
+        return self
+
+    def context(self, **kwargs):
+        c = carlcm.MockConfigurationManager()
+        c._mkdir(self.root)
+        return c
+
+    def serve(self, c, path, data):
+        url = 'http://bench.invalid/' + path
+        c.mock_urls[url] = data
+        return url
+
+    def __exit__(self, *exc):
+        return False
+
+class TmpfsBackend(object):
+
+    name = 'tmpfs'
+
+    def __enter__(self):
+        self.root = tempfile.mkdtemp(prefix='carlcm-bench-',
+                                     dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        self.server = None
+        return self
+
+    def context(self, **kwargs):
+        c = carlcm.ConfigurationManager(**kwargs)
+        c._cmd = c._cmd_quiet = c._cmd_in = _no_commands
+        return c
+
+    def serve(self, c, path, data):
+        if self.server is None:
+            files = self.files = {}
+            class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+                protocol_version = 'HTTP/1.1'
+                def do_GET(self):
+                    data = files.get(self.path[1:])
+                    if data is None:
+                        self.send_error(404)
+                        return
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                def log_message(self, *args):
+                    pass
+            self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+            t = threading.Thread(target=self.server.serve_forever)
+            t.daemon = True
+            t.start()
+        self.files[path] = data
+        return 'http://127.0.0.1:%d/%s' % (self.server.server_port, path)
+
+    def __exit__(self, *exc):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.root)
+        return False
+
+BACKENDS = {'mock': MockBackend, 'tmpfs': TmpfsBackend}
+
+def measure(f, n):
+    '''
+    calls f(i) for i in range(n), and summarizes how long they took.
+    '''
+    latencies = []
+    start = time.time()
+    for i in xrange(n):
+        t = time.time()
+        f(i)
+        latencies.append(time.time() - t)
+    seconds = time.time() - start
+    latencies.sort()
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    return {'ops': n, 'seconds': seconds, 'ops_per_second': n / seconds if seconds else None,
+            'latency_ms': {'p50': pct(0.5), 'p90': pct(0.9), 'p99': pct(0.99),
+                           'max': latencies[-1] * 1000}}
+
+def cold_and_warm(f, n):
+    return [('cold', measure(f, n)), ('warm', measure(f, n))]
+
+# each benchmark takes a backend and a scale (1 normally, smaller with
+# --quick), and returns [(case, result)]
+
+def bench_file_small(backend, scale):
+    c = backend.context()
+    data = 'x' * 100
+    return cold_and_warm(lambda i: c.file(os.path.join(backend.root, 'small%d' % i), data=data,
+                                          mode=0o644), int(1000 * scale))
+
+def bench_file_large(backend, scale):
+    c = backend.context()
+    data = os.urandom(8 << 20)
+    return cold_and_warm(lambda i: c.file(os.path.join(backend.root, 'large%d' % i), data=data),
+                         max(2, int(10 * scale)))
+
+def bench_file_state(backend, scale):
+    '''
+    file() with a state store, whose warm runs are a stat.
+    '''
+    c = backend.context()
+    c.state.path = os.path.join(backend.root, 'state.json')
+    data = 'x' * 100
+    return cold_and_warm(lambda i: c.file(os.path.join(backend.root, 'state%d' % i), data=data),
+                         int(1000 * scale))
+
+def bench_file_json(backend, scale):
+    c = backend.context()
+    doc = dict([('key%d' % k, {'value': k, 'list': range(10)}) for k in xrange(100)])
+    return cold_and_warm(lambda i: c.file(os.path.join(backend.root, 'j%d.json' % i), json_data=doc),
+                         int(300 * scale))
+
+def bench_file_yaml(backend, scale):
+    c = backend.context()
+    doc = dict([('key%d' % k, {'value': k, 'list': range(10)}) for k in xrange(100)])
+    return cold_and_warm(lambda i: c.file(os.path.join(backend.root, 'y%d.yaml' % i), yaml_data=doc),
+                         int(100 * scale))
+
+def bench_file_template(backend, scale):
+    c = backend.context()
+    template = '{% for k, v in items %}{{ k }} = {{ v }}\n{% endfor %}'
+    items = [('key%d' % k, k) for k in xrange(100)]
+    return cold_and_warm(lambda i: c.file(os.path.join(backend.root, 't%d.conf' % i),
+                                          template=template, items=items), int(300 * scale))
+
+def bench_line_in_file(backend, scale):
+    c = backend.context()
+    path = os.path.join(backend.root, 'large.conf')
+    c._write_file(path, ''.join(['option%d = %d\n' % (k, k) for k in xrange(int(100000 * scale))]))
+    n = max(2, int(20 * scale))
+    return cold_and_warm(lambda i: c.line_in_file(path, 'added%d = yes' % i,
+                                                  regexp='^added%d = ' % i), n)
+
+def bench_dir(backend, scale):
+    c = backend.context()
+    return cold_and_warm(lambda i: c.dir(os.path.join(backend.root, 'd%d' % i), mode=0o755),
+                         int(1000 * scale))
+
+def _accounts(backend, c, n):
+    passwd, group, shadow = [], [], []
+    for k in xrange(n):
+        name = 'user%d' % k
+        passwd.append('%s:x:%d:%d::/nonexistent:/bin/sh\n' % (name, 10000 + k, 10000 + k))
+        group.append('%s:x:%d:\n' % (name, 10000 + k))
+        shadow.append('%s:!:16000:0:99999:7:::\n' % name)
+    for k in xrange(20):
+        group.append('team%d:x:%d:%s\n' % (k, 5000 + k, ','.join(['user%d' % u for u in xrange(k, n, 20)])))
+    for attr, lines in [('passwd_path', passwd), ('group_path', group), ('shadow_path', shadow)]:
+        path = os.path.join(backend.root, attr[:-len('_path')])
+        c._write_file(path, ''.join(lines))
+        setattr(c.accounts, attr, path)
+
+def bench_accounts(backend, scale):
+    if backend.name != 'tmpfs':
+        return []
+    results = []
+    for n in [int(1000 * scale), int(5000 * scale)]:
+        c = backend.context()
+        _accounts(backend, c, n)
+        results.append(('group_%d' % n, measure(lambda i: c.group('user%d' % i), n)))
+        results.append(('user_%d' % n, measure(lambda i: c.user('user%d' % i, home=False,
+                                                                 groups=['team%d' % (i % 20)]), n)))
+        specs = [{'username': 'user%d' % i, 'home': False, 'groups': ['team%d' % (i % 20)]}
+                 for i in xrange(n)]
+        results.append(('users_%d' % n, measure(lambda i: c.users(specs), 1)))
+        # the same, when every lookup has to re-read the files
+        def invalidated(i):
+            c.accounts.invalidate()
+            c.group('user%d' % i)
+        results.append(('group_uncached_%d' % n, measure(invalidated, min(n, int(200 * scale)))))
+    return results
+
+def bench_download(backend, scale):
+    c = backend.context()
+    data = os.urandom(1 << 20)
+    sha256 = hashlib.sha256(data).hexdigest()
+    url = backend.serve(c, 'blob', data)
+    return cold_and_warm(lambda i: c.download(os.path.join(backend.root, 'blob%d' % i), url,
+                                              sha256=sha256), int(50 * scale))
+
+class SyntheticModule(carlcm.BaseModule):
+
+    def __init__(self, root, name, resources):
+        self.root = root
+        self.name = name
+        self.resources = resources
+
+    def main(self, context):
+        d = os.path.join(self.root, self.name)
+        context.dir(d)
+        for k in xrange(self.resources - 1):
+            context.file(os.path.join(d, 'f%d' % k), data='%s %d\n' % (self.name, k), mode=0o644)
+
+def bench_run_modules(backend, scale):
+    results = []
+    for resources in [10, 1000, 10000]:
+        resources = max(10, int(resources * scale))
+        modules = min(10, resources // 10)
+        c = backend.context()
+        root = os.path.join(backend.root, 'modules%d' % resources)
+        c._mkdir(root)
+        c.add_modules(*[SyntheticModule(root, 'm%d' % m, resources // modules)
+                        for m in xrange(modules)])
+        for case, result in [('cold', measure(lambda i: c.run_modules(), 1)),
+                             ('warm', measure(lambda i: c.run_modules(), 3))]:
+            result['resources'] = resources
+            result['resources_per_second'] = resources * result['ops'] / result['seconds']
+            results.append(('%d_%s' % (resources, case), result))
+    return results
+
+BENCHMARKS = [(name[len('bench_'):], f) for name, f in sorted(globals().items())
+              if name.startswith('bench_')]
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(backends, only=None, scale=1.0, log=sys.stdout):
+    results = {}
+    for backend_name in backends:
+        for name, f in BENCHMARKS:
+            if only and not re.search(only, name):
+                continue
+            with BACKENDS[backend_name]() as backend:
+                for case, result in f(backend, scale):
+                    key = '%s/%s/%s' % (backend_name, name, case)
+                    results[key] = result
+                    log.write('%-44s %10.1f ops/s  p50 %8.3fms  p99 %8.3fms\n' % (
+                        key, result['ops_per_second'] or 0, result['latency_ms']['p50'],
+                        result['latency_ms']['p99']))
+    return {'commit': _commit(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'time': time.time(), 'scale': scale,
+            'results': results}
+
+def compare(old, new, threshold=0.2, log=sys.stdout):
+    '''
+    prints how each case's throughput changed; returns the cases that
+    got more than threshold slower.
+    '''
+    slower = []
+    log.write('compared to %s:\n' % (old.get('commit') or 'the old run'))
+    if old.get('scale') != new.get('scale'):
+        log.write('(which was run at scale %s, not %s)\n' % (old.get('scale'), new.get('scale')))
+    for key in sorted(set(old['results']) & set(new['results'])):
+        a, b = old['results'][key]['ops_per_second'], new['results'][key]['ops_per_second']
+        if not a or not b:
+            continue
+        change = b / a - 1
+        if change < -threshold:
+            slower.append(key)
+        log.write('%-44s %+7.1f%%%s\n' % (key, change * 100, '  SLOWER' if change < -threshold else ''))
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--backend', action='append', choices=sorted(BACKENDS),
+                        help="run on this backend (default: all of them)")
+    parser.add_argument('--only', metavar='REGEX', help="only run the benchmarks matching REGEX")
+    parser.add_argument('--quick', action='store_true', help="a tenth of the usual sizes")
+    parser.add_argument('--output', metavar='FILE', help="write the results to FILE")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare the results to an earlier run's, and exit 1 if "
+                             "anything got more than --threshold slower")
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args(argv)
+    results = run(args.backend or sorted(BACKENDS), args.only, 0.1 if args.quick else 1.0)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, sort_keys=True, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), results, args.threshold):
+                return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+'''
+How long each entry point takes to get from a fresh interpreter to
+the point where it starts doing something, excluding the interpreter's
+own startup, and which of the heavy dependencies it has imported by
+then (it should be none of them).
+
+Exits 1 if any entry point's median is over its threshold (in
+milliseconds; scale them all with --scale on slow machines) or if it
+imported anything in HEAVY.
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HEAVY = ['boto', 'consul', 'jinja2', 'requests', 'yaml']
+
+# what each one does before it runs the role, catalog or counselor
+ENTRY_POINTS = {
+    'carlcm-run-role': '''
+import carlcm
+from carlcm.facts import DEFAULT_FACTS_PATH
+context = carlcm.Context(facts_path=DEFAULT_FACTS_PATH)
+''',
+    'carlcm-cluster-role': '''
+import carlcm
+from carlcm.facts import DEFAULT_FACTS_PATH
+context = carlcm.Context(facts_path=DEFAULT_FACTS_PATH)
+context.add_action_module('carlcm.actions.aws')
+''',
+    'carlcm-apply-catalog': '''
+from carlcm.catalog import Catalog
+from carlcm.configuration_manager import ConfigurationManager
+from carlcm.facts import DEFAULT_FACTS_PATH
+context = ConfigurationManager(facts_path=DEFAULT_FACTS_PATH)
+''',
+    'carlcm-counselor': '''
+import carlcm
+from carlcm.facts import DEFAULT_FACTS_PATH
+facts = carlcm.Context(facts_path=DEFAULT_FACTS_PATH).facts
+''',
+}
+
+THRESHOLDS_MS = {
+    'carlcm-run-role': 60,
+    'carlcm-cluster-role': 60,
+    'carlcm-apply-catalog': 60,
+    'carlcm-counselor': 60,
+}
+
+MEASURE = '''
+import json, sys, time
+start = time.time()
+exec %r
+print json.dumps({'seconds': time.time() - start,
+                  'heavy': sorted(set([m.split('.')[0] for m in sys.modules
+                                       if sys.modules[m] is not None]) & set(%r))})
+'''
+
+def measure(snippet, runs, python=sys.executable):
+    root = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+    results = []
+    for _ in xrange(runs):
+        out = subprocess.check_output([python, '-c', MEASURE % (snippet, HEAVY)], cwd=root)
+        results.append(json.loads(out))
+    seconds = sorted([r['seconds'] for r in results])
+    return {'median_ms': seconds[len(seconds) // 2] * 1000, 'min_ms': seconds[0] * 1000,
+            'max_ms': seconds[-1] * 1000, 'heavy': results[-1]['heavy']}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=9)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="multiply every threshold by SCALE")
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write the results to FILE")
+    args = parser.parse_args(argv)
+    results = {}
+    failed = False
+    for name in sorted(ENTRY_POINTS):
+        r = results[name] = measure(ENTRY_POINTS[name], args.runs)
+        r['threshold_ms'] = THRESHOLDS_MS[name] * args.scale
+        r['ok'] = r['median_ms'] <= r['threshold_ms'] and not r['heavy']
+        failed = failed or not r['ok']
+        print '%-22s %7.1fms (min %.1f, max %.1f, threshold %.0f)%s%s' % (
+            name, r['median_ms'], r['min_ms'], r['max_ms'], r['threshold_ms'],
+            ' imported ' + ', '.join(r['heavy']) if r['heavy'] else '',
+            '' if r['ok'] else '  FAIL')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, sort_keys=True, indent=4)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,3 +3,5 @@ from .configuration_manager import ConfigurationManager, MockConfigurationManage
 from .counselor import Counselor
 from .modules import *
 #import .modules as modules
+
+Context = ConfigurationManager
@@ -0,0 +1,119 @@
+import errno
+
+class Accounts(object):
+    '''
+    An indexed snapshot of /etc/passwd, /etc/group and /etc/shadow,
+    read once (through the context's os and open) and then answering
+    every user and group lookup from memory.  The ConfigurationManager
+    calls invalidate() whenever it changes an account, so the next
+    lookup re-reads the files.
+
+    Lookups that miss fall back to pwd and grp, so accounts that come
+    from other NSS sources (ldap, ...) are still found.
+    '''
+
+    passwd_path = '/etc/passwd'
+    group_path = '/etc/group'
+    shadow_path = '/etc/shadow'
+
+    def __init__(self, context):
+        self.context = context
+        self.users = None
+        self.uids = None
+        self.groups = None
+        self.gids = None
+        self.members = None
+        self.shadow = None
+        self.loads = 0
+
+    def invalidate(self):
+        self.users = None
+
+    def _lines(self, path):
+        try:
+            with self.context.open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.ENOENT, errno.EACCES):
+                raise
+            return []
+        # skips comments and NIS compat (+/-) entries
+        return [l.split(':') for l in data.split('\n') if l and l[0] not in '#+-']
+
+    def _load(self):
+        if self.users is not None:
+            return
+        users, uids, groups, gids, members, shadow = {}, {}, {}, {}, {}, {}
+        for f in self._lines(self.passwd_path):
+            if len(f) < 7:
+                continue
+            users[f[0]] = {'name': f[0], 'uid': int(f[2]), 'gid': int(f[3]),
+                           'comment': f[4], 'home': f[5], 'shell': f[6]}
+            uids.setdefault(int(f[2]), f[0])
+        for f in self._lines(self.group_path):
+            if len(f) < 4:
+                continue
+            groups[f[0]] = {'name': f[0], 'gid': int(f[2]),
+                            'members': [m for m in f[3].split(',') if m]}
+            gids.setdefault(int(f[2]), f[0])
+            for m in groups[f[0]]['members']:
+                members.setdefault(m, set()).add(f[0])
+        for f in self._lines(self.shadow_path):
+            if len(f) >= 2:
+                shadow[f[0]] = f[1]
+        self.uids, self.groups, self.gids, self.members, self.shadow = uids, groups, gids, members, shadow
+        self.users = users
+        self.loads += 1
+
+    def user(self, name):
+        self._load()
+        u = self.users.get(name)
+        if u is None:
+            import pwd
+            try:
+                p = pwd.getpwnam(name)
+            except KeyError:
+                return None
+            u = {'name': p.pw_name, 'uid': p.pw_uid, 'gid': p.pw_gid,
+                 'comment': p.pw_gecos, 'home': p.pw_dir, 'shell': p.pw_shell}
+        return u
+
+    def group(self, name):
+        self._load()
+        g = self.groups.get(name)
+        if g is None:
+            import grp
+            try:
+                r = grp.getgrnam(name)
+            except KeyError:
+                return None
+            g = {'name': r.gr_name, 'gid': r.gr_gid, 'members': list(r.gr_mem)}
+        return g
+
+    def user_groups(self, name):
+        '''
+        names of every group name belongs to, primary group included,
+        like `groups name`.
+        '''
+        u = self.user(name)
+        if u is None:
+            return []
+        groups = set(self.members.get(name, set()))
+        primary = self.gids.get(u['gid'])
+        if primary is None:
+            import grp
+            try:
+                primary = grp.getgrgid(u['gid']).gr_name
+            except KeyError:
+                pass
+        if primary is not None:
+            groups.add(primary)
+        return sorted(groups)
+
+    def password_hash(self, name):
+        '''
+        the encrypted password from /etc/shadow, or None if there's no
+        entry (or the file can't be read).
+        '''
+        self._load()
+        return self.shadow.get(name)
@@ -1,4 +1,8 @@
 
 class ActionModule(object):
+    # actions that handle plan mode themselves (see
+    # ConfigurationManager.begin_plan); the rest aren't run in it
+    plannable = ()
+
     def __init__(self, context=None):
         self.context = context
@@ -2,12 +2,6 @@
 import json
 import time
 
-import boto
-import boto.ec2
-import boto.iam
-import boto.utils
-import consul
-
 from .action_module import ActionModule
 
 class Aws(ActionModule):
@@ -15,25 +9,40 @@ class Aws(ActionModule):
     def __init__(self, context=None, region=None, ec2=None, iam=None, in_ec2=False):
         self.context = context
         self.in_ec2 = in_ec2
-        self.ec2 = ec2
-        self.iam = iam
+        self._ec2 = ec2
+        self._iam = iam
         self.meta = {}
         self.region = region
         self._connect()
 
     def _connect(self):
         if self.in_ec2:
-            self.meta = boto.utils.get_instance_metadata()
+            # shares the (cached) metadata with the ConfigurationManager
+            self.meta = self.context.facts.get('ec2')
         if self.region is None:
             if self.in_ec2:
-                self.region = self.meta['hostname'].split('.')[1]
+                self.region = self.meta['region']
             else:
                 self.region = 'us-west-2'
 
-        self.ec2 = self.ec2 or boto.ec2.connect_to_region(self.region)
-        self.iam = self.iam or boto.connect_iam()
-        assert self.ec2
-        assert self.iam
+    # boto is only imported, and the connections made, once an action
+    # needs them
+
+    @property
+    def ec2(self):
+        if self._ec2 is None:
+            import boto.ec2
+            self._ec2 = boto.ec2.connect_to_region(self.region)
+            assert self._ec2
+        return self._ec2
+
+    @property
+    def iam(self):
+        if self._iam is None:
+            import boto
+            self._iam = boto.connect_iam()
+            assert self._iam
+        return self._iam
 
     def iam_role_and_profile(self, name):
         self.iam_role(name)
@@ -42,6 +51,7 @@ class Aws(ActionModule):
     def iam_role(self, name, policy_name='managedpolicy', policy_data={}):
         if type(policy_data) != str:
             policy_data = json.dumps(policy_data, sort_keys=True, indent=4, separators=(',', ': '))
+        import boto.exception
         try: role = self.iam.get_role(name)
         except boto.exception.BotoServerError: role = None
         if role is None:
@@ -56,6 +66,7 @@ class Aws(ActionModule):
         If role_name is None, ensure the instance profile has no role
         associated with it, otherwise, the appropriate role.
         '''
+        import boto.exception
         try: profile = self.iam.get_instance_profile(name)
         except boto.exception.BotoServerError: profile = None
         if profile is None:
@@ -83,6 +94,7 @@ class Aws(ActionModule):
             should_add = True
 
     def security_group(self, name, description):
+        import boto.exception
         try: group = self.ec2.get_all_security_groups(groupnames=[name])[0]
         except boto.exception.EC2ResponseError: group = None
         if group is None:
@@ -1,12 +1,14 @@
 
-import jinja2
-
 from .action_module import ActionModule
 
 class Core(ActionModule):
 
+    plannable = ('mkdir',)
+
     def mkdir(self, path, owner=None, group=None, mode=None):
         path = self.context.os.path.realpath(path)
+        if self.context.planned is not None:
+            return self.context._plan_path('dir', path, owner, group, mode)
         is_new = self.context._mkdir(path)
         perm_change = self.context._apply_permissions(path, owner, group, mode)
         return is_new or perm_change
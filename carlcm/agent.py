@@ -0,0 +1,342 @@
+import BaseHTTPServer
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import json
+import os as real_os
+import select
+import struct
+import threading
+import time
+
+# actions whose first argument is the path they manage
+PATH_ACTIONS = ('file', 'dir', 'mkdir', 'download', 'line_in_file')
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+class Recorder(object):
+    '''
+    Records every top-level action call of a run (name, args, kwargs
+    and the module that made it), along with the handlers, package
+    batches and action modules it set up, and which calls manage which
+    paths: a nested call (the file() inside authorized_keys(), say)
+    maps its path to the call that made it, since that's what has to
+    run again to repair it.
+
+    Only arguments that can be passed again can be recorded: a file
+    object or an iterator would be used up by the time of a replay, so
+    a top-level call given one raises ValueError.
+    '''
+
+    def __init__(self, context):
+        self.context = context
+        self.calls = []
+        self.paths = {}
+        self.depth = 0
+
+    def _replayable(self, value):
+        return not hasattr(value, 'read') and not (hasattr(value, 'next') and iter(value) is value)
+
+    @contextlib.contextmanager
+    def call(self, name, args, kwargs):
+        if self.depth == 0:
+            for value in list(args) + kwargs.values():
+                if not self._replayable(value):
+                    raise ValueError('%s() was given %r, which a replay could not pass again'
+                                     % (name, value))
+            self.calls.append((name, args, kwargs, self.context.metrics.module))
+        if name in PATH_ACTIONS and args and isinstance(args[0], basestring):
+            path = self.context.os.path.abspath(args[0])
+            index = len(self.calls) - 1
+            if index not in self.paths.setdefault(path, []):
+                self.paths[path].append(index)
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+
+    def replay(self, indexes):
+        '''
+        makes the calls at indexes again, in the order they were first
+        made, and returns whether any of them changed anything.
+        '''
+        changed = False
+        try:
+            for i in sorted(set(indexes)):
+                name, args, kwargs, self.context.metrics.module = self.calls[i]
+                changed = bool(getattr(self.context, name)(*args, **dict(kwargs))) or changed
+        finally:
+            self.context.metrics.module = None
+        return changed
+
+class Inotify(object):
+    '''
+    A minimal inotify(7) binding, through ctypes: watch() directories,
+    then read() (path, name, mask) events for their entries.  A queue
+    overflow is reported as a single (None, None, IN_Q_OVERFLOW).
+    '''
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, real_os.strerror(e))
+        self.wds = {}
+        self.dirs = {}
+
+    def watch(self, path):
+        '''
+        returns whether path is (now) watched; it isn't if it doesn't
+        exist (yet).
+        '''
+        if path in self.dirs:
+            return True
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            raise OSError(e, real_os.strerror(e), path)
+        self.wds[wd] = path
+        self.dirs[path] = wd
+        return True
+
+    def read(self, timeout=None):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        events = []
+        while True:
+            try:
+                data = real_os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip('\0')
+                offset += 16 + length
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, None, mask))
+                    continue
+                path = self.wds.get(wd)
+                if mask & IN_IGNORED:
+                    # the directory's gone; the next full run watches it again
+                    self.wds.pop(wd, None)
+                    self.dirs.pop(path, None)
+                elif path is not None:
+                    events.append((path, name, mask))
+        return events
+
+    def close(self):
+        real_os.close(self.fd)
+
+class Agent(object):
+    '''
+    Keeps one ConfigurationManager converging: converge(context) (a
+    role's main(), say, or lambda c: c.run_modules()) runs every
+    interval seconds, and in between, the directories of every path it
+    manages are watched with inotify, so that when one of them drifts
+    only the action calls that manage it run again.  The
+    ConfigurationManager lives as long as the agent does, so its
+    caches (the dpkg inventory, file hashes and state, templates, ...)
+    stay warm between runs; see begin_run() for what doesn't.
+
+    Events caused by our own runs are discarded once each run is over,
+    so a change made while a run is in progress is only repaired by the
+    next full run.
+
+    With a status_port, GET http://127.0.0.1:<status_port>/ returns
+    status() as json.
+
+    Needs the real os: with a mock filesystem (or watch=False) there's
+    nothing to watch, and only the full runs happen.
+    '''
+
+    def __init__(self, context, converge, interval=1800, status_port=None, watch=True,
+                 debounce=0.05):
+        self.context = context
+        self.converge = converge
+        self.interval = interval
+        self.status_port = status_port
+        self.debounce = debounce
+        self.inotify = Inotify() if watch and context.os is real_os else None
+        self.recorder = None
+        self.next_full_run = 0
+        self.runs = 0
+        self.repairs = 0
+        self.last_run = None
+        self.last_repair = None
+        self.server = None
+        self.stopped = threading.Event()
+
+    def _timed(self, full, f, *args):
+        start = time.time()
+        error = None
+        try:
+            return f(*args)
+        except Exception as e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+            raise
+        finally:
+            summary = self.context.metrics.summary()
+            record = {'started': start, 'seconds': time.time() - start, 'error': error,
+                      'actions': sum([s['calls'] for s in summary.values()]),
+                      'changed': sum([s['changed'] for s in summary.values()]),
+                      'modules': dict([(k or '', v) for k, v in summary.items()])}
+            if full:
+                self.runs += 1
+                self.last_run = record
+            else:
+                self.repairs += 1
+                self.last_repair = record
+
+    def run(self):
+        '''
+        a full run, after which every managed path is watched.
+        '''
+        self.context.begin_run(full=True)
+        self.recorder = self.context.recorder = Recorder(self.context)
+        try:
+            self._timed(True, self._converge)
+        finally:
+            self.next_full_run = time.time() + self.interval
+            self._watch()
+        return self
+
+    def _converge(self):
+        self.converge(self.context)
+        self.context.finish_run()
+
+    def _watch(self):
+        if self.inotify is None:
+            return
+        for path in self.recorder.paths:
+            self.inotify.watch(self.context.os.path.dirname(path))
+        self.inotify.read(0)
+
+    def drifted(self, events):
+        '''
+        indexes of the recorded calls that manage the paths in events,
+        or None if the events overflowed and anything could have.
+        '''
+        indexes = []
+        for d, name, mask in events:
+            if mask & IN_Q_OVERFLOW:
+                return None
+            indexes += self.recorder.paths.get(self.context.os.path.join(d, name), [])
+        return indexes
+
+    def repair(self, indexes):
+        '''
+        runs the recorded calls at indexes again, and their handlers.
+        '''
+        self.context.begin_run(full=False)
+        recorder, self.context.recorder = self.context.recorder, None
+        try:
+            return self._timed(False, self._replay, indexes)
+        finally:
+            self.context.recorder = recorder
+            self._watch()
+
+    def _replay(self, indexes):
+        changed = self.recorder.replay(indexes)
+        self.context.finish_run()
+        return changed
+
+    def step(self, timeout):
+        '''
+        waits up to timeout seconds for drift and repairs it, then
+        returns the number of calls that were made again (None if it
+        did a full run instead, after an overflow).
+        '''
+        if self.inotify is None:
+            self.stopped.wait(timeout)
+            return 0
+        events = self.inotify.read(timeout)
+        if not events:
+            return 0
+        # an editor's save is a burst of events; take it all at once
+        time.sleep(self.debounce)
+        events += self.inotify.read(0)
+        indexes = self.drifted(events)
+        if indexes is None:
+            self.run()
+            return None
+        if indexes:
+            self.repair(indexes)
+        return len(set(indexes))
+
+    def serve_forever(self):
+        if self.status_port is not None:
+            self.serve_status()
+        while not self.stopped.is_set():
+            left = self.next_full_run - time.time()
+            if left <= 0:
+                try:
+                    self.run()
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+                continue
+            try:
+                self.step(left)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def status(self):
+        return {'pid': real_os.getpid(), 'runs': self.runs, 'repairs': self.repairs,
+                'last_run': self.last_run, 'last_repair': self.last_repair,
+                'next_full_run': self.next_full_run,
+                'watched_paths': len(self.recorder.paths) if self.recorder else 0,
+                'watching': self.inotify is not None}
+
+    def serve_status(self):
+        '''
+        serves status() on 127.0.0.1:status_port (0 picks a port; see
+        self.server.server_port), from a daemon thread.
+        '''
+        agent = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(agent.status(), sort_keys=True, default=str)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', self.status_port), Handler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self.server
@@ -0,0 +1,170 @@
+import errno
+import json
+import threading
+import time
+
+DEFAULT_ARTIFACT_PATH = '/var/cache/carlcm/artifacts'
+
+class ArtifactCache(object):
+    '''
+    A content-addressed store of downloaded files, keyed by sha256,
+    so that an artifact is fetched once no matter how many paths it
+    is installed to, or how many runs install it.
+
+    max_bytes bounds the size of the local store; the least recently
+    used artifacts are evicted first.  shared_path may point at a
+    directory every host can see (an NFS mount, or a mounted bucket);
+    artifacts missing locally are looked for there before going to
+    the network, and new ones are published there.
+
+    With path=None (the default) the cache does nothing.
+    '''
+
+    def __init__(self, context, path=None, max_bytes=None, shared_path=None):
+        self.context = context
+        self.path = path
+        self.max_bytes = max_bytes
+        self.shared_path = shared_path
+        self.index = None
+        self.lock = threading.RLock() # prefetch threads put() concurrently
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _object_path(self, root, sha256):
+        return self.context.os.path.join(root, sha256[:2], sha256)
+
+    def _index_path(self):
+        return self.context.os.path.join(self.path, 'index.json')
+
+    def _load(self):
+        if self.index is not None:
+            return self.index
+        self.index = {}
+        try:
+            with self.context.open(self._index_path(), 'rb') as f:
+                self.index = json.loads(f.read())
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            pass
+        return self.index
+
+    def _used(self, sha256):
+        self._load()[sha256] = time.time()
+
+    def _verified(self, path, sha256):
+        return self.context._hash_file(path, 'sha256') == sha256
+
+    def get(self, sha256):
+        '''
+        local path of the artifact, pulling it from the shared store
+        if need be, or None if neither has it.
+        '''
+        if not self.enabled:
+            return None
+        with self.lock:
+            return self._get(sha256)
+
+    def _get(self, sha256):
+        local = self._object_path(self.path, sha256)
+        if self.context.os.path.isfile(local):
+            if self._verified(local, sha256):
+                self.hits += 1
+                self._used(sha256)
+                return local
+            # corrupted (or truncated) since it was put; fetch it again
+            self.context.os.remove(local)
+            self._load().pop(sha256, None)
+        if self.shared_path is not None:
+            shared = self._object_path(self.shared_path, sha256)
+            if self.context.os.path.isfile(shared) and self._verified(shared, sha256):
+                self.context._mkdir(self.context.os.path.dirname(local))
+                self.context._copy_file(shared, local)
+                self.hits += 1
+                self._used(sha256)
+                self.evict()
+                return local
+        self.misses += 1
+        return None
+
+    def put(self, path, sha256):
+        '''
+        adds the (already verified) file at path to the store, and to
+        the shared store if there is one.
+        '''
+        if not self.enabled:
+            return
+        with self.lock:
+            self._put(path, sha256)
+
+    def _put(self, path, sha256):
+        for root in [self.path, self.shared_path]:
+            if root is None:
+                continue
+            obj = self._object_path(root, sha256)
+            if self.context.os.path.isfile(obj):
+                continue
+            self.context._mkdir(self.context.os.path.dirname(obj))
+            self.context._copy_file(path, obj)
+        self._used(sha256)
+        self.evict()
+
+    def install(self, sha256, dest, owner=None, group=None, mode=None):
+        '''
+        copies the artifact to dest (never a hardlink, so that editing
+        dest in place can't corrupt the store).  returns False if the
+        artifact isn't cached.
+        '''
+        obj = self.get(sha256)
+        if obj is None:
+            return False
+        self.context._mkdir(self.context.os.path.dirname(dest))
+        self.context._copy_file(obj, dest, owner, group, mode)
+        return True
+
+    def size(self):
+        total = 0
+        for sha256 in self._objects():
+            total += self.context.os.stat(self._object_path(self.path, sha256)).st_size
+        return total
+
+    def _objects(self):
+        os = self.context.os
+        objects = []
+        if not os.path.isdir(self.path):
+            return objects
+        for prefix in os.listdir(self.path):
+            if len(prefix) == 2 and os.path.isdir(os.path.join(self.path, prefix)):
+                objects += [o for o in os.listdir(os.path.join(self.path, prefix))
+                            if not o.startswith('.')]
+        return objects
+
+    def evict(self):
+        '''
+        removes least recently used artifacts until the store fits in
+        max_bytes.
+        '''
+        if not self.enabled or self.max_bytes is None:
+            return
+        index = self._load()
+        sizes = {}
+        for sha256 in self._objects():
+            sizes[sha256] = self.context.os.stat(self._object_path(self.path, sha256)).st_size
+        total = sum(sizes.values())
+        for sha256 in sorted(sizes, key=lambda s: index.get(s, 0)):
+            if total <= self.max_bytes:
+                break
+            self.context.os.remove(self._object_path(self.path, sha256))
+            index.pop(sha256, None)
+            total -= sizes[sha256]
+
+    def save(self):
+        if not self.enabled or self.index is None:
+            return
+        self.context._mkdir(self.path)
+        self.context._write_file(self._index_path(), json.dumps(self.index, sort_keys=True))
@@ -0,0 +1,91 @@
+import json
+
+def _native(obj):
+    '''
+    json gives back unicode, and actions check for str.
+    '''
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [_native(o) for o in obj]
+    if isinstance(obj, dict):
+        return dict([(_native(k), _native(v)) for k, v in obj.items()])
+    return obj
+
+class Catalog(object):
+    '''
+    Everything a role converges, as the calls its main() makes (action
+    calls, handlers, package batches and action modules, each with the
+    module that made it): compile() records them, in plan mode so that
+    nothing changes, and apply() makes the same calls again, without
+    importing or running the role or any of its modules.  One catalog
+    can be compiled once and applied to any number of identical hosts.
+
+    Only the calls are recorded, not the python around them, so a role
+    that branches on what an action returned (or on the host) compiles
+    to whatever it did where it was compiled.  Paths (data_file=,
+    template_file=, ...) are recorded as they were given, so they have
+    to exist where the catalog is applied, and every argument has to be
+    json-able (and any str in it utf-8).
+    '''
+
+    version = 1
+
+    def __init__(self, context, calls=None, role=None):
+        self.context = context
+        self.calls = calls or []
+        self.role = role
+
+    def compile(self, converge):
+        from .agent import Recorder
+        recorder = Recorder(self.context)
+        planned = self.context.planned
+        self.context.begin_plan()
+        previous, self.context.recorder = self.context.recorder, recorder
+        try:
+            converge(self.context)
+        finally:
+            self.context.recorder = previous
+            self.context.planned = planned
+        self.calls = [[name, list(args), kwargs, module]
+                      for name, args, kwargs, module in recorder.calls]
+        return self
+
+    def to_json(self):
+        for name, args, kwargs, _ in self.calls:
+            try:
+                json.dumps([args, kwargs])
+            except (TypeError, ValueError) as e:
+                raise ValueError("%s() can't be compiled into a catalog: %s" % (name, e))
+        return json.dumps({'version': self.version, 'role': self.role, 'calls': self.calls},
+                          sort_keys=True, separators=(',', ':'))
+
+    def save(self, path):
+        d = self.context.os.path.dirname(path)
+        if d:
+            self.context._mkdir(d)
+        # it can hold passwords and secrets
+        self.context._write_file(path, self.to_json(), mode=0600)
+        return self
+
+    def load(self, path):
+        with self.context.open(path, 'rb') as f:
+            d = _native(json.loads(f.read()))
+        if d.get('version') != self.version:
+            raise ValueError('%s is a version %s catalog; this is version %d'
+                             % (path, d.get('version'), self.version))
+        self.role = d['role']
+        self.calls = d['calls']
+        return self
+
+    def apply(self):
+        '''
+        makes every call, then finishes the run as run_modules() does.
+        '''
+        try:
+            for name, args, kwargs, module in self.calls:
+                self.context.metrics.module = module
+                getattr(self.context, name)(*args, **kwargs)
+        finally:
+            self.context.metrics.module = None
+        return self.context.finish_run()
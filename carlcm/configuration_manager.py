@@ -1,22 +1,36 @@
 
 import errno
 import filecmp
-import grp
+import functools
 import hashlib
 import json
 import os as real_os
-import pwd
 import re
 import shutil
 from stat import S_IMODE, S_ISDIR
-import subprocess
 import sys
+import time
 import types
-import urllib
-import yaml
+
+from .tracing import NO_SPAN
 
 # TODO: some sort of locking/mutexing to wait if some other context is running
 
+CHUNK_SIZE = 1 << 20
+
+def _measured(f):
+    '''
+    records every call of the action f in context.metrics, and in a
+    span of context.tracer
+    '''
+    @functools.wraps(f)
+    def measured(self, *args, **kwargs):
+        resource = args[0] if args else None
+        with self._recording(f.__name__, args, kwargs):
+            with self.tracer.span(f.__name__, 'action', resource=resource):
+                return self.metrics.measure(f.__name__, resource, f, self, *args, **kwargs)
+    return measured
+
 class ConfigurationManager(object):
     '''
     Most methods return True if something was modified, and False otherwise
@@ -24,18 +38,61 @@ class ConfigurationManager(object):
 
     is_mock = False
 
-    def __init__(self, _os=None, _open=None):
+    def __init__(self, _os=None, _open=None, state_path=None, durability=None, facts_path=None,
+                 bytecode_cache_path=None, verify=False):
+        from .accounts import Accounts
+        from .artifact_cache import ArtifactCache
+        from .facts import Facts
+        from .hashing import HashCache
+        from .metrics import Metrics
+        from .profiling import Profiler
+        from .runner import Runner
+        from .tracing import Tracer
+        from .state import StateStore
+        assert durability in [None, 'file', 'run']
         self.os = _os or real_os
         self.open = _open or open
+        self.durability = durability
+        self.unsynced = set()
+        self.state = StateStore(self, state_path, verify)
+        self.artifacts = ArtifactCache(self)
+        self.hashes = HashCache(self)
+        self.accounts = Accounts(self)
+        self.facts = Facts(self, facts_path)
+        self.metrics = Metrics(self)
+        self.tracer = Tracer(self)
+        self.profiler = Profiler(self)
+        self.runner = Runner(self)
+        self.recorder = None
+        self.bytecode_cache_path = bytecode_cache_path
+        self._templates = None
         self.triggers = set()
+        self.handlers = []
+        self.pending_handlers = set()
         self.apt_package_cache = None
+        self.apt_status_cache = None
+        self.dpkg_status_path = '/var/lib/dpkg/status'
         self.pip_package_cache = None
+        self.pip_paths = None
+        self.package_batch = None
+        self.planned = None
+        self.pip_find_links = None
+        self.prefetch_pool = None
+        self.prefetching = {}
         self.aws_info_cache = None
         self.modules = []
         self.actions = {}
+        self.plannable = set()
         self.action_modules = {}
         self.add_action_module('carlcm.actions.core')
 
+    @property
+    def templates(self):
+        if self._templates is None:
+            from .templates import Templates
+            self._templates = Templates(self, self.bytecode_cache_path)
+        return self._templates
+
     def _before(self, triggered_by):
         '''
         If this returns True, we should skip the run
@@ -60,9 +117,136 @@ class ConfigurationManager(object):
             raise bad_triggers_message
         if is_new:
             self.triggers = self.triggers.union(set(triggers))
+            self.pending_handlers.update(triggers)
         return is_new
 
+    def _recording(self, name, args, kwargs):
+        if self.recorder is None:
+            return NO_SPAN
+        return self.recorder.call(name, args, dict(kwargs))
+
+    def begin_run(self, full=True):
+        '''
+        Starts another run on this (long-lived) ConfigurationManager,
+        as the agent does: triggers, metrics, the trace, the command
+        history and the inline template sources start over, and the run
+        timeout counts from now.
+        Before a full run, the caches that can't tell for themselves
+        whether they're stale (pip's package list and the account
+        snapshot) are dropped too; the rest are keyed on the stat of
+        what they cache, so they stay warm.
+        Handlers registered by the full run stay registered, since a
+        partial run doesn't re-run the code that registered them.
+        '''
+        from .metrics import Metrics
+        self.triggers = set()
+        self.pending_handlers = set()
+        self.metrics = Metrics(self, textfile_path=self.metrics.textfile_path)
+        self.tracer.spans = []
+        self.runner.history = []
+        if self._templates is not None:
+            self._templates.clear_inline()
+        self.runner.started = time.time()
+        if full:
+            self.handlers = []
+            self.pip_package_cache = None
+            self.accounts.invalidate()
+        return self
+
+    def finish_run(self):
+        '''
+        Runs the pending handlers, then saves the state, the artifact
+        cache and the trace and makes the run durable.  In plan mode,
+        it only saves the trace.
+        '''
+        with self.tracer.span('flush_handlers', 'run'):
+            self.flush_handlers()
+        self.finish_prefetch()
+        self.tracer.save()
+        if self.planned is None:
+            self.state.save()
+            self.artifacts.save()
+            self.sync()
+            self.metrics.finish()
+        return self
+
+    def handler(self, name, cmd=None, service=None, action=None):
+        '''
+        Registers a handler for the trigger called name: either a
+        command, or an action ('restart', 'reload', ...) on a service.
+        Instead of running where the trigger fires, it runs once, at
+        the end of the run (or at the next flush_handlers()), however
+        many times the trigger fired, and whether the trigger fired
+        before or after the handler was registered.
+        '''
+        assert bool(cmd is not None) != bool(service is not None and action is not None)
+        with self._recording('handler', (name,), {'cmd': cmd, 'service': service, 'action': action}):
+            if cmd is None:
+                cmd = ['service', service, action]
+            self.handlers.append({'name': name, 'cmd': cmd, 'service': service, 'action': action})
+        return self
+
+    def flush_handlers(self):
+        '''
+        Runs the handlers of every trigger that fired since the last
+        flush, in the order they were registered.  Each distinct
+        command runs once, and a restart of a service supersedes any
+        reload of it.
+        '''
+        with self._recording('flush_handlers', (), {}):
+            return self._flush_handlers()
+
+    def _flush_handlers(self):
+        pending = [h for h in self.handlers if h['name'] in self.pending_handlers]
+        self.pending_handlers -= set([h['name'] for h in pending])
+        restarted = set([h['service'] for h in pending if h['action'] == 'restart'])
+        ran = []
+        unrun = list(pending)
+        try:
+            for h in pending:
+                if not (h['action'] == 'reload' and h['service'] in restarted) and h['cmd'] not in ran:
+                    ran.append(h['cmd'])
+                    self.cmd(h['cmd'], shell=type(h['cmd']) == str)
+                unrun.remove(h)
+        finally:
+            # if one raised, it and the ones after it run at the next flush
+            self.pending_handlers |= set([h['name'] for h in unrun])
+        return len(ran) > 0
+
+    def begin_plan(self):
+        '''
+        Switches to plan mode: from here on, actions work out what they
+        would change, without changing anything, and record it in
+        self.planned (a ChangeSet).  Triggers propagate exactly as in a
+        real run, so triggered_by actions are planned if and only if
+        they would have run.
+        '''
+        from .plan import ChangeSet
+        if self.planned is None:
+            self.planned = ChangeSet(self)
+        return self
+
+    def _plan(self, action, resource, delta, triggers=None):
+        '''
+        records delta (a json-able dict, empty if nothing would change)
+        and fires triggers if it isn't empty.
+        '''
+        if delta:
+            if type(triggers) == str:
+                triggers = [triggers]
+            self.planned.add(action, resource, delta, triggers)
+        return self._after(bool(delta), triggers)
+
+    def _plan_path(self, action, path, owner=None, group=None, mode=None, triggers=None):
+        if not self.os.path.exists(path):
+            return self._plan(action, path, {'create': True}, triggers)
+        return self._plan(action, path, self._permission_delta(path, owner, group, mode), triggers)
+
     def add_action_module(self, am_name, *args, **kwargs):
+        with self._recording('add_action_module', (am_name,) + args, kwargs):
+            self._add_action_module(am_name, *args, **kwargs)
+
+    def _add_action_module(self, am_name, *args, **kwargs):
         import_name = am_name
         if self.is_mock:
             import_name += '_mock'
@@ -75,10 +259,12 @@ class ConfigurationManager(object):
         classname = ''.join([a.capitalize() for a in name.split('_')])
         am = py_module.__getattribute__(classname)(context=self, *args, **kwargs)
         self.action_modules[name] = am
-        for k in dir(am):
-            v = am.__getattribute__(k)
-            if k[:1] != '_' and type(v) == types.MethodType:
-                self.actions[k] = v
+        self.plannable.update(am.plannable)
+        # looks at the class, so that nothing lazy (a property that
+        # connects somewhere, say) is evaluated just by adding it
+        for k in dir(type(am)):
+            if k[:1] != '_' and type(getattr(type(am), k)) == types.MethodType:
+                self.actions[k] = getattr(am, k)
 
     def __getattr__(self, name):
         if name in self.action_modules:
@@ -86,78 +272,173 @@ class ConfigurationManager(object):
         if name in self.actions:
             action = self.actions[name]
             def _missing(*args, **kwargs):
-                triggers = kwargs.get('triggers')
-                triggered_by = kwargs.get('triggered_by')
-                if 'triggers' in kwargs: del kwargs['triggers']
-                if 'triggered_by' in kwargs: del kwargs['triggered_by']
-                if self._before(triggered_by):
-                    return False
-                changed = action(*args, **kwargs)
-                return self._after(changed, triggers)
+                with self._recording(name, args, kwargs):
+                    triggers = kwargs.pop('triggers', None)
+                    triggered_by = kwargs.pop('triggered_by', None)
+                    if self._before(triggered_by):
+                        return False
+                    if self.planned is not None and name not in self.plannable:
+                        self.planned.add(name, None, {'unplanned': True})
+                        return False
+                    resource = args[0] if args else None
+                    with self.tracer.span(name, 'action', resource=resource):
+                        changed = self.metrics.measure(name, resource, action, *args, **kwargs)
+                    return self._after(changed, triggers)
             return _missing
         raise AttributeError('No attribute %s' % name)
 
     def shell(self, cmd, **kwargs):
         return self.cmd(cmd, shell=True, **kwargs)
 
-    def _cmd_quiet(self, *args, **kwargs):
-        kwargs = kwargs.copy()
-        kwargs['stderr'] = kwargs.get('stderr', subprocess.STDOUT)
-        return subprocess.check_output(*args, **kwargs)
+    def _cmd_quiet(self, cmd, **kwargs):
+        '''
+        runs cmd through self.runner (see Runner for timeout and the
+        other options) and returns its output, stderr included.
+        '''
+        with self.tracer.span('cmd', 'subprocess', cmd=cmd), self.metrics.command():
+            return self.runner.run(cmd, **kwargs).output
 
-    def _cmd(self, *args, **kwargs):
-        return subprocess.check_call(*args, **kwargs)
+    def _cmd(self, cmd, **kwargs):
+        '''
+        like _cmd_quiet, but echoes the output as it arrives.
+        '''
+        with self.tracer.span('cmd', 'subprocess', cmd=cmd), self.metrics.command():
+            return self.runner.run(cmd, echo=True, **kwargs).returncode
 
     def _cmd_in(self, cmd, stdin, **kwargs):
-        proc=subprocess.Popen(cmd,
-                              stdin=subprocess.PIPE,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              **kwargs)
-        proc.stdin.write(str(stdin))
-        proc.stdin.flush()
-        stdout, stderr = proc.communicate()
-        return stdout
+        with self.tracer.span('cmd', 'subprocess', cmd=cmd), self.metrics.command():
+            return self.runner.run(cmd, stdin=stdin, **kwargs).output
 
+    @_measured
     def pip(self, packages, triggers=None, triggered_by=None):
-        # TODO: something smarter :/
-        #
-        # basically, we want to do something like is happening with
-        # apt, but with pip syntax. unfortunately right now it messily
-        # depends on apt methods, and calls pip too many times.
+        '''
+        Like apt(), this queues its packages while a package batch is
+        open.
+        '''
         if self._before(triggered_by): return False
         if type(packages) == str: packages = packages.split()
-        changed = False
-        for p in packages:
-            arg = self._pkg_str(p, cache=self.current_pip_packages())
-            if arg is None: continue
-            if '=' in arg:
-                self._cmd_quiet(['pip', 'install', arg.replace('=','==')])
-            else:
-                self._cmd_quiet(['pip', 'install', arg, '--upgrade'])
-            changed = True
+        if self.package_batch is not None:
+            self.package_batch['pip'].append((packages, triggers))
+            return self._after(False, triggers)
+        return self._after(len(self._pip_install(packages)) > 0, triggers)
+
+    def _pip_name(self, name):
+        '''
+        pip treats 'PyYAML', 'pyyaml' and 'python_consul'/'python-consul'
+        as the same project.
+        '''
+        return re.sub('[-_.]+', '-', name).lower()
+
+    def _pip_args(self, packages):
+        '''
+        the (merged, normalized) specs in packages that aren't already
+        satisfied.
+        '''
+        cache = self.current_pip_packages()
+        specs = [self._parse_pkg(spec) for spec in packages]
+        specs = self._merge_pkgs([self._unparse_pkg(self._pip_name(n), v, c) for n, v, c in specs])
+        return [p for p in [self._pkg_str(spec, cache=cache) for spec in specs] if p]
+
+    def _pip_install(self, packages):
+        '''
+        installs whatever in packages isn't already satisfied, in one
+        pip invocation for the unpinned names (with --upgrade) and one
+        for the pinned ones.  returns the set of (normalized) project
+        names that were installed.
+        '''
+        args = self._pip_args(packages)
+        if self.planned is not None:
+            for a in args:
+                self._plan('pip', self._parse_pkg(a)[0], {'install': a})
+        elif len(args) > 0:
+            find_links = []
+            if self._wait_prefetch('pip'):
+                find_links = ['--find-links', self.pip_find_links]
+            # --upgrade only for the unpinned names, so that it can't
+            # drag a pinned requirement's dependencies along with it
+            unpinned = sorted([a for a in args if '=' not in a])
+            pinned = sorted([a.replace('=', '==') for a in args if '=' in a])
+            if unpinned:
+                self._cmd_quiet(['pip', 'install', '--upgrade'] + find_links + unpinned)
+            if pinned:
+                self._cmd_quiet(['pip', 'install'] + find_links + pinned)
             self.pip_package_cache = None
-        return self._after(changed, triggers)
+        return set([self._parse_pkg(a)[0] for a in args])
 
     def current_pip_packages(self):
+        '''
+        (normalized) name -> version of the installed python
+        distributions, found by listing the *.dist-info and *.egg-info
+        entries in pip_paths (sys.path by default) instead of running
+        pip freeze.
+        '''
         if self.pip_package_cache is not None:
             return self.pip_package_cache
-        self.pip_package_cache = dict([x.strip().split('==') for x in self._cmd_quiet(['pip', 'freeze']).splitlines() if len(x.split('==')) == 2])
-        return self.pip_package_cache
+        d = {}
+        for path in self.pip_paths or [p for p in sys.path if p]:
+            try:
+                entries = self.os.listdir(path)
+            except OSError:
+                continue
+            for entry in entries:
+                stem, ext = self.os.path.splitext(entry)
+                parts = stem.split('-')
+                if ext in ('.dist-info', '.egg-info') and len(parts) >= 2:
+                    d.setdefault(self._pip_name(parts[0]), parts[1])
+        self.pip_package_cache = d
+        return d
+
+    def apt_package_status(self):
+        '''
+        name -> (version, architecture, status) for every package in
+        the dpkg status database, read directly from the file rather
+        than via dpkg -l.  The file is only re-read when its mtime,
+        size or inode change.  Multi-arch packages are also indexed as
+        name:arch.
+        '''
+        try:
+            st = self.os.stat(self.dpkg_status_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        key = (st.st_mtime, st.st_size, st.st_ino)
+        if self.apt_status_cache is not None and self.apt_status_cache[0] == key:
+            return self.apt_status_cache[1]
+        d = {}
+        fields = {}
+        with self.open(self.dpkg_status_path, 'rb') as f:
+            for line in f.read().split('\n') + ['']:
+                if line == '':
+                    name = fields.get('Package')
+                    if name:
+                        entry = (fields.get('Version'), fields.get('Architecture'),
+                                 fields.get('Status'))
+                        d[name] = entry
+                        if entry[1] and entry[1] != 'all':
+                            d[name + ':' + entry[1]] = entry
+                    fields = {}
+                elif line[0] not in ' \t':
+                    k, _, v = line.partition(':')
+                    if k in ('Package', 'Version', 'Architecture', 'Status'):
+                        fields[k] = v.strip()
+        self.apt_status_cache = (key, d)
+        self.apt_package_cache = None
+        return d
 
     def current_apt_packages(self):
+        status = self.apt_package_status()
         if self.apt_package_cache is not None:
             return self.apt_package_cache
-        s = self._cmd_quiet(['dpkg', '-l'])
-        d = {}
-        for line in [l.strip().split() for l in s.split("\n") if l.strip()[:2] == 'ii']:
-            if len(line) >= 3:
-                d[line[1]] = line[2]
-        self.apt_package_cache = d
-        return d
+        self.apt_package_cache = dict([(k, v[0]) for k, v in status.iteritems()
+                                       if v[2] and v[2].endswith(' installed')])
+        return self.apt_package_cache
 
+    @_measured
     def apt_update(self, triggers=None, triggered_by=None):
         if self._before(triggered_by): return False
+        if self.planned is not None:
+            return self._plan('apt_update', None, {'run': True}, triggers)
         self._cmd_quiet(['apt-get', 'update'])
         return self._after(True, triggers)
 
@@ -174,20 +455,71 @@ class ConfigurationManager(object):
         l = zip([0]+l, l+[len(version)])
         return [int(version[a:b]) if version[a:b].isdigit() else version[a:b] for a, b in l]
 
-    def _pkg_str(self, s, cache=None):
-        if cache is None:
-            cache = self.current_apt_packages()
-        name, version, comparator = None, None, None
+    def _parse_pkg(self, s):
+        '''
+        splits a package spec like 'foo', 'foo=1.2', 'foo==1.2' or
+        'foo>=1.2' into (name, version, comparator)
+        '''
         if '>=' in s:
-            name, version, comparator = s.split('>=') + ['>=']
+            return tuple(s.split('>=') + ['>='])
         elif '>' in s:
             raise Exception('only >= is supported for now, not >')
         elif '==' in s:
-            name, version, comparator = s.split('==') + ['=']
+            return tuple(s.split('==') + ['='])
         elif '=' in s:
-            name, version, comparator = s.split('=') + ['=']
-        else:
-            name, version, comparator = s, 'any', '='
+            return tuple(s.split('=') + ['='])
+        return s, 'any', '='
+
+    def _unparse_pkg(self, name, version, comparator):
+        if version == 'any':
+            return name
+        return name + comparator + version
+
+    def _merge_pkgs(self, packages):
+        '''
+        collapses several specs for the same package into one, so
+        that e.g. 'foo', 'foo>=1.2' and 'foo>=1.4' become 'foo>=1.4'.
+        conflicting requirements raise an exception.
+        '''
+        merged = {}
+        order = []
+        for s in packages:
+            name, version, comparator = self._parse_pkg(s)
+            if name not in merged:
+                merged[name] = (version, comparator)
+                order.append(name)
+                continue
+            old_version, old_comparator = merged[name]
+            conflict = Exception('conflicting requirements for package %s: %s and %s' %
+                                 (name, self._unparse_pkg(name, old_version, old_comparator),
+                                  self._unparse_pkg(name, version, comparator)))
+            for (v1, c1), (v2, c2) in [((old_version, old_comparator), (version, comparator)),
+                                       ((version, comparator), (old_version, old_comparator))]:
+                if v2 == 'any' or (v1, c1) == (v2, c2):
+                    merged[name] = (v1, c1)
+                    break
+                if v1 == 'any':
+                    continue
+                if v1 == 'latest':
+                    if c2 != '>=':
+                        raise conflict
+                    merged[name] = (v1, c1)
+                    break
+                if c1 == '=' and v2 != 'latest':
+                    if c2 == '=' or self._split_version(v1) < self._split_version(v2):
+                        raise conflict
+                    merged[name] = (v1, c1)
+                    break
+                if c1 == '>=' and c2 == '>=':
+                    merged[name] = max((v1, c1), (v2, c2),
+                                       key=lambda x: self._split_version(x[0]))
+                    break
+        return [self._unparse_pkg(name, *merged[name]) for name in order]
+
+    def _pkg_str(self, s, cache=None):
+        if cache is None:
+            cache = self.current_apt_packages()
+        name, version, comparator = self._parse_pkg(s)
         current = cache.get(name)
         need_install = not current
         if version == 'any': pass
@@ -204,11 +536,25 @@ class ConfigurationManager(object):
             return name + '=' + version
         return None
 
-    def apt(self, packages, triggers=None, triggered_by=None):
-        if type(packages) == str: packages = packages.split()
-        if self._before(triggered_by): return False
-        new_packages = filter(None, map(self._pkg_str, packages))
-        if len(new_packages) > 0:
+    def _apt_args(self, packages):
+        '''
+        the (merged) specs in packages that aren't already satisfied.
+        '''
+        cache = self.current_apt_packages()
+        return [p for p in [self._pkg_str(spec, cache=cache) for spec in self._merge_pkgs(packages)] if p]
+
+    def _apt_install(self, packages):
+        '''
+        installs whatever in packages isn't already satisfied, in a
+        single apt-get transaction.  returns the set of package names
+        that were installed.
+        '''
+        self._wait_prefetch('apt')
+        new_packages = self._apt_args(packages)
+        if self.planned is not None:
+            for p in new_packages:
+                self._plan('apt', self._parse_pkg(p)[0], {'install': p})
+        elif len(new_packages) > 0:
             old_env = self.os.getenv('DEBIAN_FRONTEND', None)
             self.os.environ['DEBIAN_FRONTEND'] = 'noninteractive'
             self._cmd_quiet(['apt-get', 'install', '-y'] + sorted(new_packages))
@@ -216,18 +562,119 @@ class ConfigurationManager(object):
                 self.os.environ['DEBIAN_FRONTEND'] = old_env
             else:
                 del self.os.environ['DEBIAN_FRONTEND']
-            self.package_cache = None
+            self.apt_package_cache = None
+            self.apt_status_cache = None
             # TODO: if anything had a '>=', raise an exception if it installed a version lower than that.
-        return self._after(len(new_packages) > 0, triggers)
+        return set([self._parse_pkg(p)[0] for p in new_packages])
+
+    @_measured
+    def apt(self, packages, triggers=None, triggered_by=None):
+        '''
+        While a package batch is open (see begin_package_batch), this
+        only queues the packages and returns False; its triggers fire
+        at flush time if any of its packages get installed.
+        '''
+        if type(packages) == str: packages = packages.split()
+        if self._before(triggered_by): return False
+        if self.package_batch is not None:
+            self.package_batch['apt'].append((packages, triggers))
+            return self._after(False, triggers)
+        return self._after(len(self._apt_install(packages)) > 0, triggers)
+
+    package = packages = apt
 
-    def cmd(self, cmd, quiet=False, triggers=None, triggered_by=None, **kwargs):
+    def begin_package_batch(self):
+        '''
+        Start collecting apt() and pip() requests instead of installing
+        them right away.  Everything collected is merged and installed
+        in a single transaction per package manager by
+        flush_package_batch().
+        '''
+        with self._recording('begin_package_batch', (), {}):
+            if self.package_batch is None:
+                self.package_batch = {'apt': [], 'pip': []}
+        return self
+
+    def flush_package_batch(self):
+        with self._recording('flush_package_batch', (), {}):
+            return self._flush_package_batch()
+
+    def _flush_package_batch(self):
+        batch = self.package_batch
+        self.package_batch = None
+        if batch is None:
+            return False
+        changed = False
+        for manager, install, normalize in [('apt', self._apt_install, lambda name: name),
+                                            ('pip', self._pip_install, self._pip_name)]:
+            requests = batch[manager]
+            installed = set()
+            if len(requests) > 0:
+                installed = install([p for packages, _ in requests for p in packages])
+            for packages, triggers in requests:
+                names = set([normalize(self._parse_pkg(p)[0]) for p in packages])
+                self._after(len(names.intersection(installed)) > 0, triggers)
+            changed = changed or len(installed) > 0
+        return changed
+
+    def _succeeds(self, cmd):
+        '''
+        True if the (guard) command cmd exits 0.  strings are run by
+        the shell.
+        '''
+        return self.runner.run(cmd, shell=type(cmd) == str, check=False).returncode == 0
+
+    @_measured
+    def cmd(self, cmd, quiet=False, creates=None, unless=None, onlyif=None, inputs=None,
+            triggers=None, triggered_by=None, **kwargs):
+        '''
+        Guards skip the command (and it then reports no change):
+        creates is a path that, if it exists, means the command has
+        already run; unless and onlyif are commands that must fail, or
+        succeed, respectively; inputs is a list of files which, with
+        the command itself, are fingerprinted after every successful
+        run (in the state store, so only when one is configured), and
+        the command is skipped until one of them changes (a missing
+        input counts as a change, so the command gets to report it).
+        creates and inputs cost no fork.
+
+        unless and onlyif run even in plan mode, so that the plan only
+        has the commands that would run; they must not change anything.
+        '''
         if self._before(triggered_by): return False
+        if creates is not None and self.os.path.exists(creates):
+            return self._after(False, triggers)
+        if inputs is not None:
+            key = 'cmd:' + self.state.digest(json.dumps([cmd, kwargs], sort_keys=True))
+            fingerprint = [cmd, sorted([(p, self._input_digest(p)) for p in inputs])]
+            if self.state.unchanged(key, fingerprint, None):
+                return self._after(False, triggers)
+        if unless is not None and self._succeeds(unless):
+            return self._after(False, triggers)
+        if onlyif is not None and not self._succeeds(onlyif):
+            return self._after(False, triggers)
+        if self.planned is not None:
+            return self._plan('cmd', cmd if type(cmd) == str else ' '.join(cmd),
+                              {'run': True}, triggers)
         if quiet:
             self._cmd_quiet(cmd, **kwargs)
         else:
             self._cmd(cmd, **kwargs)
+        if inputs is not None:
+            self.state.record(key, fingerprint, None)
         return self._after(True, triggers)
 
+    def _input_digest(self, path):
+        '''
+        the sha256 of one of cmd()'s inputs, or None if it's missing.
+        '''
+        try:
+            return self._hash_file(path, 'sha256')
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
     def _mkdir(self, d):
         """
         Based on http://code.activestate.com/recipes/82465-a-friendly-mkdir/
@@ -241,24 +688,44 @@ class ConfigurationManager(object):
         else:
             h, t = self.os.path.split(d)
             if h: self._mkdir(h)
-            if t: self.os.mkdir(d)
+            if t:
+                try:
+                    self.os.mkdir(d)
+                except OSError as e:
+                    # someone (e.g. a prefetch thread) beat us to it
+                    if e.errno != errno.EEXIST or not self.os.path.isdir(d):
+                        raise
         return True
 
     def _user_name_to_uid(self, user):
-        try:
-            return pwd.getpwnam(user).pw_uid
-        except KeyError:
-            return None
+        u = self.accounts.user(user)
+        return u and u['uid']
     def _group_name_to_gid(self, group):
-        try:
-            return grp.getgrnam(group).gr_gid
-        except KeyError:
-            return None
+        g = self.accounts.group(group)
+        return g and g['gid']
     def _user_home(self, user):
-        try:
-            return pwd.getpwnam(user).pw_dir
-        except KeyError:
-            return None
+        u = self.accounts.user(user)
+        return u and u['home']
+
+    def _permission_delta(self, path, owner, group, mode):
+        '''
+        {'mode'|'owner'|'group': [current, wanted]} for whatever
+        _apply_permissions would change on path.
+        '''
+        stat = self.os.stat(path)
+        delta = {}
+        if mode is not None:
+            if type(mode) == str:
+                mode = int(mode, 8)
+            if S_IMODE(stat.st_mode) != mode:
+                delta['mode'] = ['%04o' % S_IMODE(stat.st_mode), '%04o' % mode]
+        for name, wanted, current, lookup in [('owner', owner, stat.st_uid, self._user_name_to_uid),
+                                              ('group', group, stat.st_gid, self._group_name_to_gid)]:
+            if not wanted:
+                continue
+            if (lookup(wanted) if type(wanted) == str else wanted) != current:
+                delta[name] = [current, wanted]
+        return delta
 
     def _apply_permissions(self, path, owner, group, mode):
         stat = self.os.stat(path)
@@ -291,16 +758,171 @@ class ConfigurationManager(object):
             f.write('')
 
     def _read_file(self, path):
-        return self.open(path, 'rb').read()
+        data = self.open(path, 'rb').read()
+        self.metrics.count('bytes_read', len(data))
+        return data
 
-    def _write_file(self, path, data):
-        with self.open(path, 'wb') as f:
-            f.truncate()
-            f.write(data)
+    def _files_equal(self, path1, path2):
+        '''
+        compares two files chunk by chunk, so memory use doesn't
+        depend on their size.  different sizes short-circuit.
+        '''
+        size = self.os.stat(path1).st_size
+        if size != self.os.stat(path2).st_size:
+            return False
+        self.metrics.count('bytes_read', 2 * size)
+        with self.open(path1, 'rb') as f1:
+            with self.open(path2, 'rb') as f2:
+                while True:
+                    s1 = f1.read(CHUNK_SIZE)
+                    if s1 != f2.read(CHUNK_SIZE):
+                        return False
+                    if len(s1) == 0:
+                        return True
+
+    def _copy_into(self, fsrc, fdest):
+        '''
+        copies the rest of fsrc into fdest, in-kernel (copy_file_range,
+        then sendfile) where the os module offers it, otherwise in
+        chunks.
+        '''
+        names = ['copy_file_range', 'sendfile'] if self.os is real_os else []
+        for name in names:
+            copy = getattr(self.os, name, None)
+            if copy is None:
+                continue
+            offset = 0
+            try:
+                fdest.flush()
+                while True:
+                    if name == 'sendfile':
+                        n = copy(fdest.fileno(), fsrc.fileno(), offset, CHUNK_SIZE)
+                    else:
+                        n = copy(fsrc.fileno(), fdest.fileno(), CHUNK_SIZE, offset)
+                    if n == 0:
+                        return
+                    offset += n
+            except OSError as e:
+                if offset > 0 or e.errno not in (errno.EINVAL, errno.ENOSYS,
+                                                 errno.EXDEV, errno.EOPNOTSUPP):
+                    raise
+        shutil.copyfileobj(fsrc, fdest, CHUNK_SIZE)
+
+    def _copy_file(self, src, dest, owner=None, group=None, mode=None):
+        with self.open(src, 'rb') as fsrc:
+            self._replace_file(dest, lambda fdest: self._copy_into(fsrc, fdest),
+                               owner, group, mode)
+        size = self.os.stat(dest).st_size
+        self.metrics.count('bytes_read', size)
+        self.metrics.count('bytes_written', size)
+
+    def _write_file(self, path, data, owner=None, group=None, mode=None):
+        self._replace_file(path, lambda f: f.write(data), owner, group, mode)
+        self.metrics.count('bytes_written', len(data))
+
+    def _temp_path(self, path):
+        head, tail = self.os.path.split(path)
+        return self.os.path.join(head, '.%s.carlcm-%d.tmp' % (tail, self.os.getpid()))
+
+    def _replace_file(self, path, fill, owner=None, group=None, mode=None):
+        '''
+        fill() writes the new contents into a temporary file next to
+        path, which is then renamed over it, so readers only ever see
+        the old or the new file.
+        '''
+        tmp = self._temp_path(path)
+        committed = False
+        try:
+            with self.open(tmp, 'wb') as f:
+                fill(f)
+            self._commit_file(tmp, path, owner, group, mode)
+            committed = True
+        finally:
+            if not committed and self.os.path.exists(tmp):
+                self.os.remove(tmp)
+
+    def _commit_file(self, tmp, path, owner=None, group=None, mode=None):
+        '''
+        gives tmp the owner and mode of the file it replaces (or the
+        requested ones), then renames it into place, syncing according
+        to self.durability.
+        '''
+        try:
+            old = self.os.stat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            old = None
+        if old is not None:
+            self.os.chmod(tmp, S_IMODE(old.st_mode))
+            new = self.os.stat(tmp)
+            if (new.st_uid, new.st_gid) != (old.st_uid, old.st_gid):
+                self.os.chown(tmp, old.st_uid, old.st_gid)
+        self._apply_permissions(tmp, owner, group, mode)
+        if self.durability == 'file':
+            self._fsync(tmp)
+        self.os.rename(tmp, path)
+        if self.durability == 'file':
+            self._fsync(self.os.path.dirname(self.os.path.abspath(path)))
+        elif self.durability == 'run':
+            self.unsynced.add(self.os.path.abspath(path))
+
+    def _fsync(self, path):
+        fd = self.os.open(path, self.os.O_RDONLY)
+        try:
+            self.os.fsync(fd)
+        finally:
+            self.os.close(fd)
+
+    def _syncfs(self, path):
+        '''
+        syncfs(2) on the filesystem holding path.  returns False if
+        the platform doesn't have it.
+        '''
+        import ctypes
+        import ctypes.util
+        try:
+            syncfs = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).syncfs
+        except (OSError, AttributeError):
+            return False
+        fd = self.os.open(path, self.os.O_RDONLY)
+        try:
+            if syncfs(fd) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, self.os.strerror(err), path)
+        finally:
+            self.os.close(fd)
+        return True
+
+    def sync(self):
+        '''
+        With durability='run', files are renamed into place without
+        syncing; this flushes them all at once, with one syncfs() per
+        filesystem where possible, otherwise an fsync() of every file
+        and then of every directory they were renamed in.
+        '''
+        paths, self.unsynced = self.unsynced, set()
+        if len(paths) == 0:
+            return
+        dirs = set([self.os.path.dirname(p) for p in paths])
+        filesystems = {}
+        for d in sorted(dirs):
+            filesystems.setdefault(self.os.stat(d).st_dev, d)
+        for d in sorted(filesystems.values()):
+            if not self._syncfs(d):
+                break
+        else:
+            return
+        for p in sorted(paths):
+            if self.os.path.exists(p):
+                self._fsync(p)
+        for d in sorted(dirs):
+            self._fsync(d)
 
     def _http_get(self, url):
         import requests
-        res = requests.get(url)
+        with self.tracer.span('get', 'http', url=url):
+            res = requests.get(url)
         if res.status_code != 200:
             raise Exception('failed http get of '+url+' status code = ' + str(res.status_code))
         return res.text
@@ -308,103 +930,309 @@ class ConfigurationManager(object):
     def aws_info(self):
         if self.aws_info_cache is not None:
             return self.aws_info_cache
-        prefix = 'http://169.254.169.254/latest/meta-data/'
-        az = self._http_get(prefix + 'placement/availability-zone').strip()
-        region = az[:-1]
-        inst_id = self._http_get(prefix + 'instance-id').strip()
+        ec2_facts = self.facts.get('ec2')
+        if ec2_facts is None:
+            raise Exception('not running in EC2')
+        region = ec2_facts['region']
+        inst_id = ec2_facts['instance-id']
         import boto
         import boto.ec2
-        ec2 = boto.ec2.connect_to_region(region)
-        self.aws_info_cache = ec2.get_only_instances(inst_id)[0]
+        with self.tracer.span('get_only_instances', 'aws', region=region, instance_id=inst_id):
+            ec2 = boto.ec2.connect_to_region(region)
+            self.aws_info_cache = ec2.get_only_instances(inst_id)[0]
         return self.aws_info_cache
 
-    def _urlretrieve(self, url, path):
-        urllib.urlretrieve(url, path)
+    def _http_open(self, url, headers=None, method='GET', timeout=None):
+        import requests
+        return requests.request(method, url, headers=headers or {},
+                                stream=True, allow_redirects=True, timeout=timeout)
 
-    def _hash_file(self, path, hash_algo):
-        m = hashlib.new(hash_algo)
+    def _partial_path(self, path):
+        head, tail = self.os.path.split(path)
+        return self.os.path.join(head, '.%s.carlcm-partial' % tail)
+
+    def _feed_hashers(self, path, hashers):
         with self.open(path, 'rb') as f:
             while True:
-                s = f.read(4096)
-                m.update(s)
-                if len(s) <= 0:
+                chunk = f.read(CHUNK_SIZE)
+                if len(chunk) == 0:
                     break
-        return m.hexdigest()
+                for h in hashers.values():
+                    h.update(chunk)
 
+    def _fetch(self, url, path, hashers, headers=None, resume=False):
+        '''
+        streams url into path, feeding every byte to hashers as it
+        arrives.  with resume=True, whatever path already holds is
+        kept and only the rest is requested.  returns the response,
+        which may be a 304 if headers made the request conditional.
+        '''
+        headers = dict(headers or {})
+        offset = 0
+        if resume and self.os.path.isfile(path):
+            offset = self.os.stat(path).st_size
+        if offset > 0:
+            headers['Range'] = 'bytes=%d-' % offset
+        with self.tracer.span('fetch', 'http', url=url, offset=offset):
+            return self._fetch_into(url, path, hashers, headers, offset)
+
+    def _range_start(self, res):
+        '''
+        the first byte of a 206's Content-Range, or None.
+        '''
+        unit, _, rng = res.headers.get('Content-Range', '').partition(' ')
+        start = rng.partition('-')[0]
+        if unit != 'bytes' or not start.isdigit():
+            return None
+        return int(start)
+
+    def _fetch_into(self, url, path, hashers, headers, offset):
+        res = self._http_open(url, headers)
+        try:
+            if res.status_code == 304:
+                return res
+            if offset > 0 and (res.status_code == 416 or (res.status_code == 206 and
+                                                          self._range_start(res) != offset)):
+                # the partial file is stale, or the server sent some other
+                # range than the one asked for: start over from the top
+                res.close()
+                self.os.remove(path)
+                headers.pop('Range')
+                return self._fetch(url, path, hashers, headers)
+            if res.status_code == 206 and offset > 0:
+                self._feed_hashers(path, hashers)
+                open_mode = 'ab'
+            elif res.status_code == 200:
+                open_mode = 'wb'
+            else:
+                raise Exception('failed http get of %s status code = %d' % (url, res.status_code))
+            with self.open(path, open_mode) as f:
+                for chunk in res.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    self.metrics.count('bytes_written', len(chunk))
+                    for h in hashers.values():
+                        h.update(chunk)
+        finally:
+            res.close()
+        return res
+
+    def _fetch_parallel(self, url, path, parts):
+        '''
+        fetches url into path as `parts` concurrent Range requests.
+        returns None, having fetched nothing, unless the server
+        reports the length, accepts byte ranges, and the file is big
+        enough to be worth splitting.
+        '''
+        import threading
+        with self.tracer.span('head', 'http', url=url):
+            head = self._http_open(url, method='HEAD')
+            head.close()
+        size = int(head.headers.get('Content-Length') or 0)
+        if (head.status_code != 200 or head.headers.get('Accept-Ranges') != 'bytes' or
+            size < parts * CHUNK_SIZE):
+            return None
+        with self.open(path, 'wb') as f:
+            f.seek(size - 1)
+            f.write('\0')
+        errors = []
+        def fetch_part(start, end):
+            try:
+                with self.tracer.span('fetch_part', 'http', url=url, start=start, end=end):
+                    res = self._http_open(url, {'Range': 'bytes=%d-%d' % (start, end - 1)})
+                    try:
+                        if res.status_code != 206:
+                            raise Exception('failed ranged http get of %s status code = %d' %
+                                            (url, res.status_code))
+                        with self.open(path, 'r+b') as f:
+                            f.seek(start)
+                            for chunk in res.iter_content(CHUNK_SIZE):
+                                f.write(chunk)
+                    finally:
+                        res.close()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=fetch_part,
+                                    args=(i * size // parts, (i + 1) * size // parts))
+                   for i in xrange(parts)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            self.os.remove(path)
+            raise errors[0]
+        # counted here, since the parts were written outside the action's thread
+        self.metrics.count('bytes_written', size)
+        return head
+
+    def _retrieve(self, path, url, hashes, owner=None, group=None, mode=None,
+                  conditional=False, etag=None, parallel=1):
+        '''
+        fetches url and, if it matches hashes, moves it into place.
+        returns (fetched, etag), where fetched is False if a
+        conditional request found the file unmodified.
+        '''
+        from email.utils import formatdate, mktime_tz, parsedate_tz
+        self._mkdir(self.os.path.dirname(path))
+        partial = self._partial_path(path)
+        headers = {}
+        if conditional:
+            if etag:
+                headers['If-None-Match'] = etag
+            headers['If-Modified-Since'] = formatdate(self.os.stat(path).st_mtime, usegmt=True)
+        res = None
+        if parallel > 1 and not conditional:
+            res = self._fetch_parallel(url, partial, parallel)
+            if res is not None:
+                digests = self.hashes.digests(partial, hashes)
+        if res is None:
+            hashers = dict([(a, hashlib.new(a)) for a in hashes])
+            # without a hash to check the result against, a resumed
+            # transfer could silently splice two versions together
+            res = self._fetch(url, partial, hashers, headers, resume=bool(hashes))
+            digests = dict([(a, h.hexdigest()) for a, h in hashers.items()])
+        if res.status_code == 304:
+            return False, etag
+        for a in sorted(hashes):
+            if digests[a] != hashes[a]:
+                self.os.remove(partial)
+                raise AssertionError('%s of %s was %s, expected %s' %
+                                     (a, url, digests[a], hashes[a]))
+        last_modified = parsedate_tz(res.headers.get('Last-Modified') or '')
+        if last_modified is not None:
+            mtime = mktime_tz(last_modified)
+            self.os.utime(partial, (mtime, mtime))
+        self._commit_file(partial, path, owner, group, mode)
+        if digests:
+            self.hashes.remember(path, digests)
+        return True, res.headers.get('ETag')
+
+    def _hash_file(self, path, hash_algo):
+        return self.hashes.digests(path, [hash_algo])[hash_algo]
+
+    @_measured
     def download(self, path, url,
-                 owner=None, group=None, mode=None,
+                 owner=None, group=None, mode=None, revalidate=False, parallel=1,
                  triggers=None, triggered_by=None, **kwargs):
-        # NOTE: this downloads in-place currently, which is not great
-        # for sanctity of the file.
+        '''
+        Hashes may be given as e.g. sha256='...' or sha256sum='...';
+        the file is fetched again whenever it doesn't match them.
+        Without a hash, the file is only fetched if it is missing,
+        unless revalidate=True, in which case the server is asked
+        (via ETag and If-Modified-Since) whether it has changed.
 
-        # Also... right now, if you don't pass a hash, it will only
-        # download once, and never check again.  Is that desired?
-        # Should it always download and compare the file?
+        Transfers are streamed to a partial file and hashed as they
+        arrive; an interrupted hashed transfer resumes where it left
+        off next time.  parallel=N fetches big files as N concurrent
+        ranged requests.
+        '''
         if self._before(triggered_by): return False
-        file_new = not self.os.path.isfile(path)
-        if file_new:
-            self._touch(path)
-        perm_change = self._apply_permissions(path, owner, group, mode)
-        if not file_new:
-            for a, k in [(a, a+s) for a in hashlib.algorithms for s in ['','sum']]:
-                if k in kwargs:
-                    file_new = file_new or self._hash_file(path, a) != kwargs[k]
-
-        if file_new:
-            self._urlretrieve(url, path)
-            for a, k in [(a, a+s) for a in hashlib.algorithms for s in ['','sum']]:
-                if k in kwargs:
-                    assert self._hash_file(path, a) == kwargs[k]
+        hashes = dict([(a, kwargs[k]) for a in hashlib.algorithms for k in [a, a+'sum'] if k in kwargs])
+        revalidate = revalidate and not hashes
+        key = 'download:' + path
+        inputs = [url, hashes, owner, group, mode]
+        if not revalidate and self.state.unchanged(key, inputs, path):
+            return self._after(False, triggers)
+        etag = self.state.entry(key).get('etag')
+        file_existed = self.os.path.isfile(path)
+        file_new = not file_existed or self.hashes.digests(path, hashes) != hashes
+        if self.planned is not None:
+            # revalidation would take a request, so isn't planned
+            if not file_existed:
+                return self._plan('download', path, {'create': True, 'url': url}, triggers)
+            delta = self._permission_delta(path, owner, group, mode)
+            if file_new:
+                delta['content'] = True
+            return self._plan('download', path, delta, triggers)
+        perm_change = file_existed and self._apply_permissions(path, owner, group, mode)
+
+        sha256 = hashes.get('sha256')
+        if file_new and sha256:
+            self._wait_prefetch(sha256)
+        if file_new and sha256 and self.artifacts.install(sha256, path, owner, group, mode):
+            pass
+        elif file_new or revalidate:
+            file_new, etag = self._retrieve(path, url, hashes, owner, group, mode,
+                                            conditional=not file_new, etag=etag,
+                                            parallel=parallel)
+            if file_new and sha256:
+                self.artifacts.put(path, sha256)
+        self.state.record(key, inputs, path, sha256, etag=etag)
         return self._after(perm_change or file_new, triggers)
 
+    @_measured
     def dir(self, path, owner=None, group=None, mode=None,
             triggers=None, triggered_by=None):
         if self._before(triggered_by): return False
+        key = 'dir:' + path
+        inputs = [owner, group, mode]
+        if self.state.unchanged(key, inputs, path):
+            return self._after(False, triggers)
+        if self.planned is not None:
+            return self._plan_path('dir', path, owner, group, mode, triggers)
         is_new = self._mkdir(path)
         perm_change = self._apply_permissions(path, owner, group, mode)
+        self.state.record(key, inputs, path)
         return self._after(perm_change or is_new, triggers)
 
+    @_measured
     def file(self, dest_path, data_file=None, data=None,
              json_data=None, yaml_data=None,
              template=None, template_file=None, template_engine='jinja2',
              owner=None, group=None, mode=None,
              triggers=None, triggered_by=None,
              vars=None, **kwargs):
-        # NOTE: this writes the file in-place currently, which is not
-        # great for the stability of reads to that file.
         if self._before(triggered_by): return False
         if json_data:
             data = json.dumps(json_data, sort_keys=True,
                               indent=4, separators=(',', ': ')).strip() + '\n'
         if yaml_data:
+            import yaml
             data = yaml.dump(yaml_data)
-        if template_file is not None:
-            template = self._read_file(template_file)
-        if template:
+        if template_file is not None or template:
             merged_vars = kwargs.copy()
             merged_vars.update(vars or {})
             if template_engine == 'jinja2':
-                import jinja2
-                data = jinja2.Template(template).render(merged_vars)
+                data = self.templates.render(template, template_file, merged_vars)
             else:
                 raise ValueError('no matching template engine!')
         assert bool(data_file is not None) != bool(data is not None)
-        if data_file is not None:
-            data = self._read_file(data_file)
         if hasattr(data, 'read'): # in case we were passed a file handle
             data = data.read()
+        if data_file is not None:
+            inputs = [data_file, self.state.stat_fingerprint(data_file)]
+        else:
+            inputs = [self.state.digest(data)]
+        inputs += [owner, group, mode]
         if dest_path[-1:] == '/' and data_file:
             _, tail = self.os.path.split(data_file)
             dest_path += tail
         dest_path = self.os.path.realpath(dest_path)
+        key = 'file:' + dest_path
+        if self.state.unchanged(key, inputs, dest_path):
+            return self._after(False, triggers)
         file_existed = self.os.path.isfile(dest_path)
-        if not file_existed:
-            self._touch(dest_path)
-        perm_change = self._apply_permissions(dest_path, owner, group, mode)
-        old_contents = self._read_file(dest_path)
-        contents_match = data == old_contents
+        contents_match = False
+        if file_existed:
+            if data_file is not None:
+                contents_match = self._files_equal(data_file, dest_path)
+            else:
+                contents_match = data == self._read_file(dest_path)
+        if self.planned is not None:
+            if not file_existed:
+                return self._plan('file', dest_path, {'create': True}, triggers)
+            delta = self._permission_delta(dest_path, owner, group, mode)
+            if not contents_match:
+                delta['content'] = True
+            return self._plan('file', dest_path, delta, triggers)
+        perm_change = file_existed and self._apply_permissions(dest_path, owner, group, mode)
         if not contents_match:
-            self._write_file(dest_path, data)
+            self._mkdir(self.os.path.dirname(dest_path))
+            if data_file is not None:
+                self._copy_file(data_file, dest_path, owner, group, mode)
+            else:
+                self._write_file(dest_path, data, owner, group, mode)
+        self.state.record(key, inputs, dest_path)
         return self._after(perm_change or not (file_existed and contents_match), triggers)
 
     def _groupadd_cmd(self, groupname, gid=None):
@@ -416,10 +1244,14 @@ class ConfigurationManager(object):
 
     def _groupadd(self, groupname, gid=None):
         self._cmd_quiet(self._groupadd_cmd(groupname, gid))
+        self.accounts.invalidate()
 
+    @_measured
     def group(self, groupname, gid=None, triggers=None, triggered_by=None):
         if self._before(triggered_by): return False
-        group_existed = bool(self._group_name_to_gid(groupname))
+        group_existed = self._group_name_to_gid(groupname) is not None
+        if self.planned is not None:
+            return self._plan('group', groupname, {} if group_existed else {'create': True}, triggers)
         if not group_existed:
             self._groupadd(groupname, gid)
         return self._after(not group_existed, triggers)
@@ -449,16 +1281,74 @@ class ConfigurationManager(object):
                  groups=None, shell=None, comment=None):
         self._cmd_quiet(self._useradd_cmd(username, home, uid, gid,
                                           groups, shell, comment))
+        self.accounts.invalidate()
 
     def _user_groups(self, username):
-        gs = self._cmd_quiet(['groups', username])
-        return sorted(gs.split(':')[-1].strip().split())
+        return self.accounts.user_groups(username)
 
-    def _add_user_to_group(self, username, groupname):
-        self._cmd_quiet(['gpasswd', '-a', username, groupname])
-    def _remove_user_from_group(self, username, groupname):
-        self._cmd_quiet(['gpasswd', '-d', username, groupname])
+    def _set_user_groups(self, username, groups):
+        '''
+        makes groups the user's supplementary groups, in one usermod.
+        '''
+        self._cmd_quiet(['usermod', '-G', ','.join(sorted(groups)), username])
+        self.accounts.invalidate()
+
+    def _chpasswd(self, lines, encrypted=False):
+        self._cmd_in(['chpasswd'] + (['-e'] if encrypted else []), lines)
+        self.accounts.invalidate()
 
+    def _useradd_home_base(self):
+        '''
+        where useradd puts homes that aren't given: HOME in
+        /etc/default/useradd, or /home.
+        '''
+        try:
+            with self.open('/etc/default/useradd', 'rb') as f:
+                for line in f.read().split('\n'):
+                    key, _, value = line.strip().partition('=')
+                    if key == 'HOME' and value.strip():
+                        return value.strip().strip('"\'')
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return '/home'
+
+    def _newusers(self, users):
+        '''
+        creates all of users (dicts of useradd arguments, with a home)
+        with a single newusers.  each gets a random password, to be
+        replaced by the caller.
+        '''
+        lines = ''
+        for u in users:
+            home = u['home']
+            if type(home) is not str:
+                home = self.os.path.join(self._useradd_home_base(), u['username'])
+            fields = [u['username'], real_os.urandom(20).encode('hex'), u['uid'], u['gid'],
+                      u['comment'], home, u['shell']]
+            lines += ':'.join(['' if f is None else str(f) for f in fields]) + '\n'
+        self._cmd_in(['newusers'], lines)
+        self.accounts.invalidate()
+
+    def _password_hash(self, username):
+        return self.accounts.password_hash(username)
+
+    def _password_updates(self, username, password=None, encrypted_password=None):
+        '''
+        [(chpasswd line, encrypted)] needed to give username these
+        passwords; empty if it already has them.  a plain password is
+        checked by crypt()ing it with the salt of the current hash.
+        '''
+        import crypt
+        current = self._password_hash(username)
+        updates = []
+        if password is not None and (current is None or crypt.crypt(password, current) != current):
+            updates += [(username + ':' + password + '\n', False)]
+        if encrypted_password is not None and current != encrypted_password:
+            updates += [(username + ':' + encrypted_password + '\n', True)]
+        return updates
+
+    @_measured
     def authorized_keys(self, user, authorized_keys, triggers=None, triggered_by=None):
         if self._before(triggered_by): return False
         if type(authorized_keys) is list:
@@ -473,6 +1363,7 @@ class ConfigurationManager(object):
                             owner=user, group=user, mode=0600)
         return self._after(changed, triggers)
 
+    @_measured
     def user(self, username, password=None, encrypted_password=None,
              authorized_keys=None,
              home=True, home_mode='755', uid=None, gid=None, groups=None, shell=None,
@@ -482,10 +1373,28 @@ class ConfigurationManager(object):
         echo "P4sSw0rD" | openssl passwd -1 -stdin
         '''
         if self._before(triggered_by): return False
-        user_existed = bool(self._user_name_to_uid(username))
+        user_existed = self._user_name_to_uid(username) is not None
+        if self.planned is not None:
+            return self._plan_user(username, user_existed, authorized_keys, home, home_mode,
+                                   groups, password, encrypted_password, triggers)
         if not user_existed:
             self._useradd(username, home, uid, gid,
                           groups, shell, comment)
+        changed = self._user_home_and_groups(username, home, home_mode, groups)
+
+        # a random password is only ever set on a new account
+        if random_password and not user_existed:
+            password = real_os.urandom(20).encode('hex')
+        updates = self._password_updates(username, password, encrypted_password)
+        for line, encrypted in updates:
+            self._chpasswd(line, encrypted)
+
+        changed_auth_keys = False
+        if authorized_keys is not None:
+            changed_auth_keys = self.authorized_keys(username, authorized_keys)
+        return self._after(not user_existed or changed or len(updates) > 0 or changed_auth_keys, triggers)
+
+    def _user_home_and_groups(self, username, home, home_mode, groups):
         home_changed = False
         home_perm_changed = False
         if home is not False:
@@ -495,27 +1404,94 @@ class ConfigurationManager(object):
 
         changing_groups = False
         if groups:
-            gs = self._user_groups(username)
             existing_groups = set(self._user_groups(username)) - set([username])
             changing_groups = existing_groups != set(groups)
-            for group in sorted(list(set(groups) - set(existing_groups))):
-                self._add_user_to_group(username, group)
-            for group in sorted(list(set(existing_groups) - set(groups))):
-                self._remove_user_from_group(username, group)
+            if changing_groups:
+                self._set_user_groups(username, groups)
+        return home_changed or home_perm_changed or changing_groups
 
-        # TODO: need to be able to check if the password was the same or not
-        if random_password:
-            password = real_os.urandom(20).encode('hex')
-        if password is not None:
-            self._cmd_in(['chpasswd'], username + ':' + password + '\n')
-        if encrypted_password is not None:
-            self._cmd_in(['chpasswd', '-e'], username + ':' + encrypted_password + '\n')
+    @_measured
+    def users(self, users, triggers=None, triggered_by=None):
+        '''
+        Provisions many accounts in one pass.  users is a list of dicts
+        of user() arguments, each of which may have its own triggers.
+        Missing accounts are created by a single newusers (or useradd,
+        for home=False), and every password that needs setting goes
+        through a single chpasswd (and a single chpasswd -e).
+        Passwords are checked against /etc/shadow first, so unchanged
+        ones cost nothing.  authorized_keys are written once all the
+        accounts exist.
+        '''
+        if self._before(triggered_by): return False
+        defaults = {'password': None, 'encrypted_password': None, 'authorized_keys': None,
+                    'home': True, 'home_mode': '755', 'uid': None, 'gid': None, 'groups': None,
+                    'shell': None, 'comment': None, 'random_password': False, 'triggers': None}
+        specs = [dict(defaults, **u) for u in users]
+        if self.planned is not None:
+            changed = False
+            for u in specs:
+                changed = self._plan_user(u['username'], self._user_name_to_uid(u['username']) is not None,
+                                          u['authorized_keys'], u['home'], u['home_mode'], u['groups'],
+                                          u['password'], u['encrypted_password'], u['triggers']) or changed
+            return self._after(changed, triggers)
+        new = set([u['username'] for u in specs if self._user_name_to_uid(u['username']) is None])
+        for u in specs:
+            if u['username'] in new and u['home'] is False:
+                self._useradd(u['username'], False, u['uid'], u['gid'], u['groups'], u['shell'], u['comment'])
+        batch = [u for u in specs if u['username'] in new and u['home'] is not False]
+        if batch:
+            self._newusers(batch)
 
-        changed_auth_keys = False
+        changed = dict([(u['username'], u['username'] in new) for u in specs])
+        updates = {False: '', True: ''}
+        for u in specs:
+            name = u['username']
+            if self._user_home_and_groups(name, u['home'], u['home_mode'], u['groups']):
+                changed[name] = True
+            password, encrypted_password = u['password'], u['encrypted_password']
+            if name in new and u['random_password']:
+                password = real_os.urandom(20).encode('hex')
+            if name in new and password is None and encrypted_password is None:
+                encrypted_password = '!' # locked, as useradd leaves it
+            for line, encrypted in self._password_updates(name, password, encrypted_password):
+                updates[encrypted] += line
+                changed[name] = True
+        for encrypted in [False, True]:
+            if updates[encrypted]:
+                self._chpasswd(updates[encrypted], encrypted)
+
+        for u in specs:
+            if u['authorized_keys'] is not None and self.authorized_keys(u['username'], u['authorized_keys']):
+                changed[u['username']] = True
+        for u in specs:
+            self._after(changed[u['username']], u['triggers'])
+        return self._after(any(changed.values()), triggers)
+
+    def _plan_user(self, username, user_existed, authorized_keys, home, home_mode,
+                   groups, password, encrypted_password, triggers):
+        if not user_existed:
+            # everything else follows from creating it
+            return self._plan('user', username, {'create': True}, triggers)
+        delta = {}
+        if home is not False:
+            _home = self._user_home(username)
+            if not self.os.path.isdir(_home):
+                delta['home'] = 'create'
+            else:
+                delta.update(dict([('home_' + k, v) for k, v in
+                                   self._permission_delta(_home, username, username, home_mode).items()]))
+        if groups:
+            existing_groups = set(self._user_groups(username)) - set([username])
+            if existing_groups != set(groups):
+                delta['groups'] = [sorted(existing_groups), sorted(groups)]
+        if self._password_updates(username, password, encrypted_password):
+            delta['password'] = True
+        changed = False
         if authorized_keys is not None:
-            changed_auth_keys = self.authorized_keys(username, authorized_keys)
-        return self._after(not user_existed or home_changed or home_perm_changed or changing_groups or changed_auth_keys, triggers)
+            changed = self.authorized_keys(username, authorized_keys)
+        return self._plan('user', username, delta, triggers) or self._after(changed, triggers)
 
+    @_measured
     def line_in_file(self, path, line=None, regexp=None, state='present',
                      enforce_trailing_newline=True, new_position='bottom',
                      triggers=None, triggered_by=None):
@@ -523,8 +1499,19 @@ class ConfigurationManager(object):
         boy is this complicated
         '''
         if self._before(triggered_by): return False
+        if self.planned is not None and (self.planned.rewrites(path) or
+                                         not self.os.path.exists(path)):
+            # an earlier planned action would have created (or
+            # rewritten) it, so what's on disk says nothing yet
+            return self._plan('line_in_file', path, {'content': True}, triggers)
         if not self.os.path.isfile(path):
             raise ValueError('path %s is not a file!' % path)
+        key = 'line_in_file:' + path
+        inputs = [line, getattr(regexp, 'pattern', regexp), state,
+                  enforce_trailing_newline, new_position]
+        key += ':' + self.state.digest(json.dumps(inputs))
+        if self.state.unchanged(key, inputs, path):
+            return self._after(False, triggers)
         assert state in ['present', 'absent']
         assert new_position in ['bottom', 'top']
         if state == 'present': assert line is not None
@@ -561,21 +1548,124 @@ class ConfigurationManager(object):
         data2 = '\n'.join(lines)
         if enforce_trailing_newline and (len(data2) == 0 or data2[-1] != '\n'):
             data2 += '\n'
-        return self.file(path, data=data2)
+        if self.planned is not None:
+            return self._plan('line_in_file', path, {} if data2 == data else {'content': True}, triggers)
+        changed = self.file(path, data=data2)
+        self.state.record(key, inputs, path)
+        return self._after(changed, triggers)
 
     def add_modules(self, *args):
         self.modules += args
         return self
 
-    def run_modules(self):
+    def prefetch(self, downloads=None, apt=None, pip=None, workers=4):
+        '''
+        Starts fetching, on a pool of worker threads, everything the
+        run is going to need from the network, and returns right away:
+        downloads (dicts of download() arguments; only ones with a
+        sha256 can be verified, so only those are prefetched), apt
+        packages (apt-get install --download-only) and pip packages
+        (pip download).  download(), apt() and pip() wait for and use
+        whatever was prefetched for them.
+
+        Downloads and pip packages are staged into the artifact cache,
+        so they're only prefetched when the caller has enabled it (see
+        ArtifactCache); apt packages always are.
+        '''
+        from multiprocessing.pool import ThreadPool
+        if self.planned is not None:
+            return self
+        if self.prefetch_pool is None:
+            self.prefetch_pool = ThreadPool(workers)
+        if not self.artifacts.enabled:
+            downloads = pip = None
+        downloads = [d for d in downloads or [] if d.get('sha256', d.get('sha256sum'))]
+        if downloads:
+            self._mkdir(self.os.path.join(self.artifacts.path, '.staging'))
+        for d in downloads:
+            sha256 = d.get('sha256', d.get('sha256sum'))
+            if sha256 in self.prefetching or self.artifacts.get(sha256):
+                continue
+            self.prefetching[sha256] = self.prefetch_pool.apply_async(
+                self._prefetch_download, (d['url'], sha256))
+        new = self._apt_args(apt or [])
+        if new:
+            self.prefetching['apt'] = self.prefetch_pool.apply_async(
+                self._cmd_quiet, (['apt-get', 'install', '--download-only', '-y'] + sorted(new),))
+        args = self._pip_args(pip or [])
+        if args:
+            self.pip_find_links = self.os.path.join(self.artifacts.path, 'pip')
+            self._mkdir(self.pip_find_links)
+            self.prefetching['pip'] = self.prefetch_pool.apply_async(
+                self._cmd_quiet, (['pip', 'download', '--dest', self.pip_find_links] +
+                                  sorted([a.replace('=', '==') for a in args]),))
+        return self
+
+    def _prefetch_download(self, url, sha256):
+        partial = self.os.path.join(self.artifacts.path, '.staging', sha256)
+        hashers = {'sha256': hashlib.new('sha256')}
+        self._fetch(url, partial, hashers, resume=True)
+        if hashers['sha256'].hexdigest() != sha256:
+            self.os.remove(partial)
+            raise AssertionError('sha256 of %s was %s, expected %s' %
+                                 (url, hashers['sha256'].hexdigest(), sha256))
+        self.artifacts.put(partial, sha256)
+        self.os.remove(partial)
+
+    def _wait_prefetch(self, key):
+        '''
+        blocks until the prefetch of key (a sha256, 'apt' or 'pip') is
+        done, if there is one.  a failed prefetch isn't an error here;
+        the caller simply fetches for itself.
+        '''
+        result = self.prefetching.pop(key, None)
+        if result is None:
+            return False
+        try:
+            result.get()
+            return True
+        except Exception:
+            return False
+
+    def finish_prefetch(self):
+        for key in list(self.prefetching):
+            self._wait_prefetch(key)
+        if self.prefetch_pool is not None:
+            self.prefetch_pool.close()
+            self.prefetch_pool.join()
+            self.prefetch_pool = None
+
+    def run_modules(self, prefetch=False):
+        '''
+        With prefetch=True, every module's downloads(), packages() and
+        pip_packages() start fetching concurrently before anything is
+        applied (see prefetch()).
+        '''
         packages = []
+        pip_packages = []
+        downloads = []
         for module in self.modules:
             packages += module.packages()
-        # TODO: change the package format to allow inclusion of versions... somehow
-        self.packages(packages)
-        for module in self.modules:
-            module.main(self)
-        return self
+            pip_packages += module.pip_packages()
+            downloads += module.downloads()
+        if prefetch:
+            self.prefetch(downloads, packages, pip_packages)
+        try:
+            # TODO: change the package format to allow inclusion of versions... somehow
+            self.begin_package_batch()
+            self.packages(packages)
+            if pip_packages:
+                self.pip(pip_packages)
+            self.metrics.measure('flush_package_batch', None, self.flush_package_batch)
+            for module in self.modules:
+                self.metrics.module = module.__class__.__name__
+                with self.tracer.span(self.metrics.module, 'module'):
+                    self.profiler.run(self.metrics.module, module.main, self)
+            self.metrics.module = None
+            return self.finish_run()
+        finally:
+            # a module that raised skipped finish_run(); don't leak the pool
+            self.finish_prefetch()
 
 # TODO: rsync, git repo, apt sources, apt keys, ssh authorized_keys, cron
 
@@ -588,12 +1678,13 @@ class MockConfigurationManager(ConfigurationManager):
         from mock import Mock
 
         self.fs = fs or fake_filesystem.FakeFilesystem()
-        self.users = users or [{'name':'root', 'id':0,
+        self.mock_users = users or [{'name':'root', 'id':0,
                                 'groups':['root'], 'home':'/root'}]
-        self.groups = groups or [{'name':'root', 'id':0}]
+        self.mock_groups = groups or [{'name':'root', 'id':0}]
         self.mock_urls = {}
         self._cmd = Mock()
         self._cmd_quiet = Mock()
+        self._succeeds = Mock(return_value=True)
         ConfigurationManager.__init__(self,
                                       _os=fake_filesystem.FakeOsModule(self.fs),
                                       _open=fake_filesystem.FakeFileOpen(self.fs))
@@ -604,14 +1695,14 @@ class MockConfigurationManager(ConfigurationManager):
     def _cmd_in(self):
         assert False
     def _user_home(self, user):
-        return [x for x in self.users if x['name'] == user][0].get('home')
+        return [x for x in self.mock_users if x['name'] == user][0].get('home')
     def _user_groups(self, user):
-        return [x for x in self.users if x['name'] == user][0].get('groups', [])
+        return [x for x in self.mock_users if x['name'] == user][0].get('groups', [])
     def _user_name_to_uid(self, user):
-        try: return [x for x in self.users if x['name'] == user][0]['id']
+        try: return [x for x in self.mock_users if x['name'] == user][0]['id']
         except IndexError: return None
     def _group_name_to_gid(self, group):
-        try: return [x for x in self.groups if x['name'] == group][0]['id']
+        try: return [x for x in self.mock_groups if x['name'] == group][0]['id']
         except IndexError: return None
     def _next_id(self, arr):
         i = 1000
@@ -620,15 +1711,15 @@ class MockConfigurationManager(ConfigurationManager):
         return i
 
     def _groupadd(self, groupname, gid=None):
-        gid = gid or self._next_id(self.groups)
-        if len([x for x in self.groups if x['id'] == gid]) > 0:
+        gid = gid or self._next_id(self.mock_groups)
+        if len([x for x in self.mock_groups if x['id'] == gid]) > 0:
             raise Exception('gid already taken!')
-        self.groups += [{'name':groupname, 'id': gid}]
+        self.mock_groups += [{'name':groupname, 'id': gid}]
 
     def _useradd(self, username, home=True, uid=None, gid=None,
                  groups=None, shell=None, comment=None):
-        uid = uid or self._next_id(self.groups)
-        if len([x for x in self.users if x['id'] == uid]) > 0:
+        uid = uid or self._next_id(self.mock_groups)
+        if len([x for x in self.mock_users if x['id'] == uid]) > 0:
             raise Exception('uid already taken!')
         user = {'name':username, 'id':uid, 'comment':comment, 'shell':shell,
                 'home':'/home/'+username, 'groups':[username]}
@@ -639,16 +1730,67 @@ class MockConfigurationManager(ConfigurationManager):
                 user['home'] = home
             else:
                 raise ValueError('errrrrr')
-        self.users += [user]
+        self.mock_users += [user]
         self._groupadd(username, gid)
 
-    def _add_user_to_group(self, username, groupname):
-        user = [x for x in self.users if x['name'] == username][0]
-        user['groups'] = sorted(list(set(user['groups'] + [groupname])))
+    def _set_user_groups(self, username, groups):
+        user = [x for x in self.mock_users if x['name'] == username][0]
+        user['groups'] = sorted(list(set(groups + [username])))
+
+    def _password_hash(self, username):
+        return [x for x in self.mock_users if x['name'] == username][0].get('password_hash')
+
+    def _chpasswd(self, lines, encrypted=False):
+        import crypt
+        for line in lines.splitlines():
+            username, password = line.split(':', 1)
+            user = [x for x in self.mock_users if x['name'] == username][0]
+            user['password_hash'] = password if encrypted else crypt.crypt(password, '$6$mocksalt$')
+
+    def _newusers(self, users):
+        for u in users:
+            self._useradd(u['username'], u['home'], u['uid'], u['gid'],
+                          None, u['shell'], u['comment'])
+
+    def _http_open(self, url, headers=None, method='GET', timeout=None):
+        if url not in self.mock_urls:
+            return MockResponse(404)
+        data = self.mock_urls[url]
+        headers = headers or {}
+        response_headers = {'Accept-Ranges': 'bytes'}
+        if 'Range' in headers:
+            start, _, end = headers['Range'][len('bytes='):].partition('-')
+            if int(start) >= len(data):
+                return MockResponse(416)
+            total = len(data)
+            data = data[int(start):int(end) + 1 if end else total]
+            response_headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                int(start), int(start) + len(data) - 1, total)
+            status = 206
+        else:
+            status = 200
+        response_headers['Content-Length'] = str(len(data))
+        return MockResponse(status, data if method == 'GET' else '', response_headers)
+
+    def _fsync(self, path):
+        pass
+
+    def _syncfs(self, path):
+        return False
+
+class MockResponse(object):
+    '''
+    just enough of a requests.Response for download()
+    '''
+
+    def __init__(self, status_code, content='', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
 
-    def _remove_user_from_group(self, username, groupname):
-        user = [x for x in self.users if x['name'] == username][0]
-        user['groups'] = sorted(list(set(user['groups']) - set([groupname])))
+    def iter_content(self, chunk_size=1):
+        for i in xrange(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
 
-    def _urlretrieve(self, url, path):
-        self._write_file(path, self.mock_urls[url])
+    def close(self):
+        pass
@@ -1,23 +1,23 @@
 
 import json
 import os
-import subprocess
 import time
 
 class Counselor(object):
 
-    def __init__(self, region=None, ec2=None, iam=None, in_ec2=False):
+    def __init__(self, region=None, ec2=None, iam=None, in_ec2=False, facts=None):
         import boto
         import boto.ec2
         import boto.iam
-        import consul
 
         if in_ec2:
-            import boto.utils
-            self.meta = boto.utils.get_instance_metadata()
+            if facts is None:
+                from .configuration_manager import ConfigurationManager
+                facts = ConfigurationManager().facts
+            self.meta = facts.get('ec2')
         if region is None:
             if in_ec2:
-                self.region = self.meta['hostname'].split('.')[1]
+                self.region = self.meta['region']
             else:
                 self.region = 'us-west-2'
         else:
@@ -127,6 +127,7 @@ sudo /usr/local/bin/carlcm-counselor %i''' % (count)
         return
 
     def ensure_local(self, count=1, is_bootstrap=False, context=None):
+        import subprocess
         from .configuration_manager import ConfigurationManager
         from .modules import ConsulModule
 
@@ -0,0 +1,176 @@
+import errno
+import json
+import os as real_os
+import threading
+import time
+
+DEFAULT_FACTS_PATH = '/var/cache/carlcm/facts.json'
+
+class Facts(object):
+    '''
+    Facts about the host, each gathered the first time it's asked for
+    and then cached, in memory and (with a path) on disk, for ttls[name]
+    seconds, so that the next process gets it for free too:
+
+      hostname, fqdn      from socket
+      ipv4_addresses      the local addresses in /proc/net/fib_trie
+      cpu_count           online cpus
+      memory_bytes        MemTotal from /proc/meminfo
+      ec2                 the instance identity document, keyed like
+                          boto's instance metadata (instance-id, region,
+                          availability-zone, local-ipv4, ...), or None
+                          outside of EC2
+
+    ec2 takes a single request to the metadata service at metadata_url;
+    point that (or $CARLCM_METADATA_URL) at a stand-in to test with, or
+    add its documents to a MockConfigurationManager's mock_urls.
+
+    A fact that came back None (ec2 when the request failed or timed
+    out, say) is only kept for negative_ttl seconds.  The cache on disk
+    is ignored after a reboot (a change of boot_id), since most facts
+    can change across one.
+    '''
+
+    version = 1
+
+    ttls = {'hostname': 300, 'fqdn': 300, 'ipv4_addresses': 60,
+            'cpu_count': 3600, 'memory_bytes': 3600, 'ec2': 3600}
+
+    negative_ttl = 60
+
+    metadata_timeout = 1
+
+    boot_id_path = '/proc/sys/kernel/random/boot_id'
+
+    def __init__(self, context, path=None, metadata_url=None):
+        self.context = context
+        self.path = path
+        self.metadata_url = (metadata_url or real_os.environ.get('CARLCM_METADATA_URL')
+                             or 'http://169.254.169.254/latest/')
+        self.facts = None
+        self.boot_id = None
+        self.lock = threading.Lock()
+        self.gathered = 0
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _load(self):
+        if self.facts is not None:
+            return self.facts
+        self.facts = {}
+        if not self.enabled:
+            return self.facts
+        self.boot_id = self._read_boot_id()
+        try:
+            with self.context.open(self.path, 'rb') as f:
+                d = json.loads(f.read())
+            if d.get('version') == self.version and d.get('boot_id') == self.boot_id:
+                self.facts = d['facts']
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            pass # a corrupt cache just means gathering again
+        return self.facts
+
+    def _read_boot_id(self):
+        try:
+            with self.context.open(self.boot_id_path, 'rb') as f:
+                return f.read().strip()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def _save(self):
+        if not self.enabled:
+            return
+        data = json.dumps({'version': self.version, 'boot_id': self.boot_id,
+                           'facts': self.facts}, sort_keys=True)
+        try:
+            self.context._mkdir(self.context.os.path.dirname(self.path))
+            self.context._write_file(self.path, data)
+        except (IOError, OSError) as e:
+            # it's only a cache; running unprivileged shouldn't fail
+            if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+
+    def get(self, name):
+        if name not in self.ttls:
+            raise KeyError(name)
+        with self.lock:
+            facts = self._load()
+            fact = facts.get(name)
+            if fact is None or fact['expires'] <= time.time():
+                value = getattr(self, '_gather_' + name)()
+                ttl = self.ttls[name] if value is not None else self.negative_ttl
+                fact = {'value': value, 'expires': time.time() + ttl}
+                facts[name] = fact
+                self.gathered += 1
+                self._save()
+            return fact['value']
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def invalidate(self, name=None):
+        '''
+        forgets name (or every fact), so it's gathered again next time.
+        '''
+        with self.lock:
+            facts = self._load()
+            for k in ([name] if name else list(facts)):
+                facts.pop(k, None)
+            self._save()
+
+    def _gather_hostname(self):
+        import socket
+        return socket.gethostname()
+
+    def _gather_fqdn(self):
+        import socket
+        return socket.getfqdn()
+
+    def _gather_ipv4_addresses(self):
+        addresses = set()
+        last = None
+        try:
+            with self.context.open('/proc/net/fib_trie', 'rb') as f:
+                for line in f.read().split('\n'):
+                    line = line.strip()
+                    if line.startswith('|--'):
+                        last = line[3:].strip()
+                    elif line == '/32 host LOCAL' and last is not None:
+                        addresses.add(last)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return sorted(addresses)
+
+    def _gather_cpu_count(self):
+        return real_os.sysconf('SC_NPROCESSORS_ONLN')
+
+    def _gather_memory_bytes(self):
+        with self.context.open('/proc/meminfo', 'rb') as f:
+            for line in f.read().split('\n'):
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+        return None
+
+    def _gather_ec2(self):
+        import requests
+        url = self.metadata_url + 'dynamic/instance-identity/document'
+        try:
+            with self.context.tracer.span('get', 'http', url=url):
+                res = self.context._http_open(url, timeout=self.metadata_timeout)
+        except requests.exceptions.RequestException:
+            return None
+        if res.status_code != 200:
+            return None
+        doc = json.loads(res.content)
+        return {'instance-id': doc['instanceId'], 'region': doc['region'],
+                'availability-zone': doc['availabilityZone'],
+                'local-ipv4': doc['privateIp'], 'instance-type': doc['instanceType'],
+                'account-id': doc['accountId'], 'ami-id': doc['imageId']}
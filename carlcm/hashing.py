@@ -0,0 +1,77 @@
+import hashlib
+import mmap
+import os as real_os
+
+READ_SIZE = 1 << 20
+
+class HashCache(object):
+    '''
+    Computes file digests, any number of algorithms in a single pass
+    over the file, and remembers them keyed by the file's (dev, inode,
+    size, mtime_ns, ctime_ns), so an unchanged file is never hashed
+    twice.  The remembered digests live in the state store, so with
+    one configured they carry over between runs too.
+    '''
+
+    def __init__(self, context):
+        self.context = context
+        self.hashed_bytes = 0
+
+    def _key(self, st):
+        if not st.st_ino:
+            return None # can't tell files apart, so don't remember
+        return '%s:%s:%s:%s:%s' % (st.st_dev, st.st_ino, st.st_size,
+                                   getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)),
+                                   getattr(st, 'st_ctime_ns', int(st.st_ctime * 1e9)))
+
+    def digests(self, path, algos):
+        '''
+        {algo: hexdigest} of path for each of algos.
+        '''
+        algos = set(algos)
+        st = self.context.os.stat(path)
+        key = self._key(st)
+        known = {}
+        if key is not None:
+            known = self.context.state.digests(key)
+        missing = algos - set(known)
+        if missing:
+            known = dict(known)
+            known.update(self._compute(path, st.st_size, missing))
+            if key is not None:
+                self.context.state.remember_digests(key, known)
+        return dict([(a, known[a]) for a in algos])
+
+    def remember(self, path, digests):
+        '''
+        records digests that were computed elsewhere, e.g. on the fly
+        while path was being downloaded.
+        '''
+        key = self._key(self.context.os.stat(path))
+        if key is not None:
+            known = dict(self.context.state.digests(key))
+            known.update(digests)
+            self.context.state.remember_digests(key, known)
+
+    def _compute(self, path, size, algos):
+        hashers = [(a, hashlib.new(a)) for a in sorted(algos)]
+        with self.context.open(path, 'rb') as f:
+            if self.context.os is real_os and size > READ_SIZE:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for offset in xrange(0, size, 64 * READ_SIZE):
+                        chunk = buffer(m, offset, 64 * READ_SIZE)
+                        for _, h in hashers:
+                            h.update(chunk)
+                finally:
+                    m.close()
+            else:
+                while True:
+                    chunk = f.read(READ_SIZE)
+                    if len(chunk) == 0:
+                        break
+                    for _, h in hashers:
+                        h.update(chunk)
+        self.hashed_bytes += size
+        self.context.metrics.count('bytes_read', size)
+        return dict([(a, h.hexdigest()) for a, h in hashers])
@@ -0,0 +1,176 @@
+import contextlib
+import threading
+import time
+
+COUNTERS = ['subprocesses', 'subprocess_seconds', 'bytes_read', 'bytes_written']
+
+class Metrics(object):
+    '''
+    Times every action call and counts what it does (subprocesses and
+    the time spent in them, bytes read and written, whether it changed
+    anything), attributing everything to the module whose main() made
+    the call.  Time is recorded exclusive of nested actions (e.g. the
+    file() inside authorized_keys()), so per-module sums add up.
+
+    resources holds one record per action call; summary() adds them up
+    per module, and format_summary() lays that out as a table.  With a
+    textfile_path, finish() writes the totals for node_exporter's
+    textfile collector.
+
+    Each thread has its own stack of action calls, so what a worker
+    thread (a prefetch, say) does outside of any action isn't counted
+    against the action the main thread is in.
+    '''
+
+    def __init__(self, context, textfile_path=None):
+        self.context = context
+        self.textfile_path = textfile_path
+        self.module = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.resources = []
+        self.started = time.time()
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _resource(self, resource):
+        if resource is None or isinstance(resource, basestring):
+            return resource
+        if type(resource) in (list, tuple):
+            return ' '.join([str(r) for r in resource])
+        return str(resource)
+
+    def measure(self, action, resource, f, *args, **kwargs):
+        '''
+        calls f(*args, **kwargs) as the action named action, on
+        resource, and records it.
+        '''
+        frame = dict([(k, 0) for k in COUNTERS])
+        frame['child_seconds'] = 0.0
+        stack = self._stack()
+        stack.append(frame)
+        changed = None
+        start = time.time()
+        try:
+            changed = f(*args, **kwargs)
+            return changed
+        finally:
+            seconds = time.time() - start
+            stack.pop()
+            if stack:
+                stack[-1]['child_seconds'] += seconds
+            record = {'module': self.module, 'action': action,
+                      'resource': self._resource(resource),
+                      'seconds': seconds - frame.pop('child_seconds'),
+                      'changed': bool(changed)}
+            record.update(frame)
+            with self.lock:
+                self.resources.append(record)
+
+    def count(self, name, n=1):
+        # only what happens within an action is counted
+        stack = self._stack()
+        if stack:
+            stack[-1][name] += n
+
+    @contextlib.contextmanager
+    def command(self):
+        '''
+        wraps a subprocess call.
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.count('subprocesses')
+            self.count('subprocess_seconds', time.time() - start)
+
+    def totals(self):
+        '''
+        (module, action) -> summed counters, call count, changed and
+        unchanged counts and seconds.
+        '''
+        totals = {}
+        with self.lock:
+            resources = list(self.resources)
+        for r in resources:
+            t = totals.setdefault((r['module'], r['action']),
+                                  dict([(k, 0) for k in COUNTERS + ['calls', 'changed',
+                                                                    'unchanged', 'seconds']]))
+            for k in COUNTERS + ['seconds']:
+                t[k] += r[k]
+            t['calls'] += 1
+            t['changed' if r['changed'] else 'unchanged'] += 1
+        return totals
+
+    def summary(self):
+        '''
+        module -> summed counters, for each module (None for calls made
+        outside of run_modules).
+        '''
+        summary = {}
+        for (module, action), t in self.totals().items():
+            s = summary.setdefault(module, dict([(k, 0) for k in t]))
+            for k, v in t.items():
+                s[k] += v
+        return summary
+
+    def format_summary(self):
+        '''
+        summary() as a table, one line per module, slowest first.
+        '''
+        summary = self.summary()
+        columns = ['calls', 'changed', 'seconds', 'subprocesses', 'subprocess_seconds',
+                   'bytes_read', 'bytes_written']
+        lines = ['%-24s' % 'module' + ''.join(['%20s' % c for c in columns])]
+        for module in sorted(summary, key=lambda m: -summary[m]['seconds']):
+            s = summary[module]
+            lines += ['%-24s' % (module or '-') +
+                      ''.join([('%20.3f' if c.endswith('seconds') else '%20d') % s[c]
+                               for c in columns])]
+        return '\n'.join(lines) + '\n'
+
+    def textfile(self):
+        lines = []
+        metrics = [('carlcm_action_seconds', 'seconds', 'Time spent in actions in the last run, excluding nested actions.'),
+                   ('carlcm_action_subprocesses', 'subprocesses', 'Subprocesses run by actions in the last run.'),
+                   ('carlcm_action_subprocess_seconds', 'subprocess_seconds', 'Time spent waiting on subprocesses in the last run.'),
+                   ('carlcm_action_read_bytes', 'bytes_read', 'Bytes read by actions in the last run.'),
+                   ('carlcm_action_written_bytes', 'bytes_written', 'Bytes written (or downloaded) by actions in the last run.')]
+        totals = self.totals()
+        keys = sorted(totals, key=lambda k: (k[0] or '', k[1]))
+        def escape(value):
+            # as the exposition format requires of label values
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        def labels(key, extra=''):
+            return '{module="%s",action="%s"%s}' % (escape(key[0] or ''), escape(key[1]), extra)
+        for name, counter, help in metrics:
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s gauge' % name]
+            lines += ['%s%s %s' % (name, labels(k), repr(totals[k][counter])) for k in keys]
+        lines += ['# HELP carlcm_actions Action calls in the last run, by whether they changed anything.',
+                  '# TYPE carlcm_actions gauge']
+        for k in keys:
+            for outcome in ['changed', 'unchanged']:
+                lines += ['carlcm_actions%s %d' % (labels(k, ',outcome="%s"' % outcome),
+                                                         totals[k][outcome])]
+        lines += ['# HELP carlcm_run_seconds Wall time of the last run.',
+                  '# TYPE carlcm_run_seconds gauge',
+                  'carlcm_run_seconds %r' % (time.time() - self.started),
+                  '# HELP carlcm_last_run_timestamp_seconds When the last run finished.',
+                  '# TYPE carlcm_last_run_timestamp_seconds gauge',
+                  'carlcm_last_run_timestamp_seconds %d' % time.time()]
+        return '\n'.join(lines) + '\n'
+
+    def finish(self):
+        '''
+        writes the textfile, if there is one, atomically (as the
+        textfile collector requires).
+        '''
+        if self.textfile_path is None:
+            return
+        self.context._mkdir(self.context.os.path.dirname(self.textfile_path))
+        self.context._write_file(self.textfile_path, self.textfile())
@@ -6,5 +6,15 @@ class BaseModule(object):
     def packages(self):
         return []
 
+    def pip_packages(self):
+        return []
+
+    def downloads(self):
+        '''
+        dicts of download() arguments (at least url and a sha256) that
+        main() will download, so they can be prefetched.
+        '''
+        return []
+
     def main(self, context):
         return
@@ -18,6 +18,11 @@ from .base import BaseModule
 # also, changing service definitions should only send a SIGHUP, not restart the process
 # ...maybe service definitions should be available at the Module level, so there's no race between consul and other modules' instantiations
 
+CONSUL_URL = 'https://dl.bintray.com/mitchellh/consul/0.4.1_linux_amd64.zip'
+CONSUL_SHA256 = '2cf6e59edf348c3094c721eb77436e8c789afa2c35e6e3123a804edfeb1744ac'
+WEBUI_URL = 'https://dl.bintray.com/mitchellh/consul/0.4.1_web_ui.zip'
+WEBUI_SHA256 = 'e02929ed44f5392cadd5513bdc60b7ab7363d1670d59e64d2422123229962fa0'
+
 class ConsulModule(BaseModule):
 
     def __init__(self, encrypt=None, mode='client', servers=None, webui=False,
@@ -33,6 +38,12 @@ class ConsulModule(BaseModule):
     def packages(self):
         return ['unzip']
 
+    def downloads(self):
+        d = [{'url': CONSUL_URL, 'sha256sum': CONSUL_SHA256}]
+        if self.webui:
+            d += [{'url': WEBUI_URL, 'sha256sum': WEBUI_SHA256}]
+        return d
+
     def main(self, context):
         context.user('consul', home='/var/consul', home_mode='750')
         self._acquire_consul(context)
@@ -50,23 +61,21 @@ class ConsulModule(BaseModule):
         context.file('/etc/init/consul.conf',
                      data=self._upstart_conf(), triggers='consul-restart')
 
-        context.shell('service consul restart', triggered_by='consul-restart')
-        context.shell('service consul reload', triggered_by='consul')
+        context.handler('consul-restart', service='consul', action='restart')
+        context.handler('consul', service='consul', action='reload')
 
     def _acquire_consul(self, context):
-        is_new = context.download('/opt/consul/0.4.1/consul.zip',
-                                  'https://dl.bintray.com/mitchellh/consul/0.4.1_linux_amd64.zip',
-                                  sha256sum='2cf6e59edf348c3094c721eb77436e8c789afa2c35e6e3123a804edfeb1744ac')
-        if is_new:
-            context.cmd(['unzip', '/opt/consul/0.4.1/consul.zip', '-d', '/opt/consul/0.4.1/'], quiet=True)
+        context.download('/opt/consul/0.4.1/consul.zip', CONSUL_URL,
+                         sha256sum=CONSUL_SHA256)
+        context.cmd(['unzip', '-o', '/opt/consul/0.4.1/consul.zip', '-d', '/opt/consul/0.4.1/'],
+                    quiet=True, creates='/opt/consul/0.4.1/consul')
 
     def _acquire_webui(self, context):
         context.mkdir('/opt/consul/0.4.1/web', owner='consul', group='consul')
-        ui_is_new = context.download('/opt/consul/0.4.1/web/web.zip',
-                                     'https://dl.bintray.com/mitchellh/consul/0.4.1_web_ui.zip',
-                                     sha256sum='e02929ed44f5392cadd5513bdc60b7ab7363d1670d59e64d2422123229962fa0')
-        if ui_is_new:
-            context.cmd(['unzip', '/opt/consul/0.4.1/web/web.zip', '-d', '/opt/consul/0.4.1/web/'], quiet=True)
+        context.download('/opt/consul/0.4.1/web/web.zip', WEBUI_URL,
+                         sha256sum=WEBUI_SHA256)
+        context.cmd(['unzip', '-o', '/opt/consul/0.4.1/web/web.zip', '-d', '/opt/consul/0.4.1/web/'],
+                    quiet=True, creates='/opt/consul/0.4.1/web/dist')
 
     def _common_config(self):
         d = {'datacenter':self.datacenter,
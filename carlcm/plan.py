@@ -0,0 +1,47 @@
+import json
+
+class ChangeSet(object):
+    '''
+    What a run in plan mode (see ConfigurationManager.begin_plan)
+    would have changed: one entry per resource, in the order the run
+    would have changed them, each with its delta (what differs between
+    what was asked for and what is there) and the triggers it would
+    have fired.
+
+    Actions from action modules that can't plan themselves aren't run
+    at all; they're listed with an 'unplanned' delta and fire nothing.
+    '''
+
+    def __init__(self, context):
+        self.context = context
+        self.changes = []
+
+    def add(self, action, resource, delta, triggers=None):
+        entry = {'action': action, 'resource': resource, 'delta': delta}
+        if triggers:
+            entry['triggers'] = sorted(triggers)
+        self.changes.append(entry)
+
+    def rewrites(self, path):
+        '''
+        whether an earlier planned change creates or rewrites the file
+        at path, so that what's on disk isn't what a later action would
+        find there.
+        '''
+        abspath = self.context.os.path.abspath
+        for c in self.changes:
+            if not isinstance(c['resource'], basestring) or abspath(c['resource']) != abspath(path):
+                continue
+            if 'create' in c['delta'] or 'content' in c['delta']:
+                return True
+        return False
+
+    def __len__(self):
+        return len([c for c in self.changes if 'unplanned' not in c['delta']])
+
+    def to_dict(self):
+        return {'changes': self.changes,
+                'triggers': sorted(self.context.triggers)}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True, separators=(',', ':'))
@@ -0,0 +1,84 @@
+import marshal
+import posixpath
+
+class Profiler(object):
+    '''
+    Profiles each module's main() (or a role's main() or cluster())
+    separately with cProfile, and writes, into the directory at path,
+    <name>.pstats (for pstats, snakeviz, ...) and <name>.collapsed,
+    collapsed stacks for flamegraph.pl or speedscope.
+
+    cProfile only knows caller -> callee edges, not whole stacks, so
+    the collapsed stacks apportion each function's time among its
+    callers by how much of it each one accounted for.
+
+    Runs nest: a role profiled while its modules are profiled too
+    pauses while each module runs, so every profile is exclusive.
+
+    With path=None (the default), run() just calls the function.
+    '''
+
+    def __init__(self, context, path=None):
+        self.context = context
+        self.path = path
+        self.active = []
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def run(self, name, f, *args, **kwargs):
+        if not self.enabled:
+            return f(*args, **kwargs)
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        if self.active:
+            self.active[-1].disable()
+        self.active.append(profile)
+        try:
+            return profile.runcall(f, *args, **kwargs)
+        finally:
+            self.active.pop()
+            if self.active:
+                self.active[-1].enable()
+            self.save(name, pstats.Stats(profile))
+
+    def save(self, name, stats):
+        self.context._mkdir(self.path)
+        base = self.context.os.path.join(self.path, name)
+        self.context._write_file(base + '.pstats', marshal.dumps(stats.stats))
+        self.context._write_file(base + '.collapsed', self.collapsed(stats))
+
+    def _frame(self, func):
+        filename, line, name = func
+        if filename == '~':
+            return name.replace(';', ',')
+        return ('%s (%s:%d)' % (name, posixpath.basename(filename), line)).replace(';', ',')
+
+    def collapsed(self, stats, max_depth=64):
+        '''
+        "frame;frame;frame microseconds" lines.
+        '''
+        children = {}
+        for callee, (_, _, _, _, callers) in stats.stats.items():
+            for caller, edge in callers.items():
+                children.setdefault(caller, []).append((callee, edge[3]))
+        counts = {}
+        def walk(func, stack, scale):
+            _, _, tt, ct, _ = stats.stats[func]
+            stack = stack + [self._frame(func)]
+            key = ';'.join(stack)
+            counts[key] = counts.get(key, 0) + tt * scale
+            if len(stack) >= max_depth:
+                return
+            for callee, edge_ct in children.get(func, []):
+                callee_ct = stats.stats[callee][3]
+                if self._frame(callee) in stack or callee_ct <= 0:
+                    continue
+                walk(callee, stack, scale * edge_ct / callee_ct)
+        for func, (_, _, _, _, callers) in stats.stats.items():
+            if not callers:
+                walk(func, [], 1.0)
+        return ''.join(['%s %d\n' % (k, round(v * 1e6)) for k, v in sorted(counts.items())
+                        if round(v * 1e6) > 0])
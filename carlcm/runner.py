@@ -0,0 +1,204 @@
+import os as real_os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+class CommandTimeout(subprocess.CalledProcessError):
+    '''
+    raised when a command outlives its timeout (or the run's); its
+    whole process group has been killed by then.
+    '''
+
+    def __init__(self, cmd, timeout, output=None):
+        subprocess.CalledProcessError.__init__(self, -signal.SIGKILL, cmd, output)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '%s' timed out after %s seconds" % (self.cmd, self.timeout)
+
+class RingBuffer(object):
+    '''
+    keeps the last size bytes written to it.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray()
+        self.dropped = 0
+
+    def write(self, data):
+        self.data += data
+        if len(self.data) > self.size:
+            excess = len(self.data) - self.size
+            del self.data[:excess]
+            self.dropped += excess
+
+    def getvalue(self):
+        return str(self.data)
+
+class Result(object):
+
+    def __init__(self, cmd, pid, returncode, duration, output, dropped):
+        self.cmd = cmd
+        self.pid = pid
+        self.returncode = returncode
+        self.duration = duration
+        self.output = output
+        self.dropped = dropped
+
+class Runner(object):
+    '''
+    Runs subprocesses for the ConfigurationManager: each in its own
+    process group, with stdout and stderr streamed into a ring buffer
+    of the last buffer_size bytes (and, when echo is set, to our own
+    stdout), and appended to the log at log_path if there is one.
+
+    timeout bounds each command, and run_timeout the whole run; a
+    command that outlives either has its process group killed (TERM,
+    then KILL after kill_grace seconds) and raises CommandTimeout.
+    Failures raise CalledProcessError with the buffered output.  Once
+    a command exits, its output is read for at most drain_grace more
+    seconds, so a daemon it leaves holding the pipe doesn't block us.
+
+    At most max_workers commands run at once, however many threads ask
+    (see run_all and prefetch); history records the exit status and
+    duration of every command of the run (begin_run clears it).
+    '''
+
+    def __init__(self, context, timeout=None, run_timeout=None, max_workers=4,
+                 buffer_size=1 << 20, log_path=None, kill_grace=5, drain_grace=0.1):
+        self.context = context
+        self.timeout = timeout
+        self.run_timeout = run_timeout
+        self.max_workers = max_workers
+        self.buffer_size = buffer_size
+        self.log_path = log_path
+        self.kill_grace = kill_grace
+        self.drain_grace = drain_grace
+        self.started = time.time()
+        self.slots = threading.BoundedSemaphore(max_workers)
+        self.log_lock = threading.Lock()
+        self.history = []
+
+    def _timeout(self, timeout):
+        timeout = self.timeout if timeout is None else timeout
+        if self.run_timeout is not None:
+            left = self.started + self.run_timeout - time.time()
+            timeout = left if timeout is None else min(timeout, left)
+        return timeout
+
+    def _log(self, data):
+        if self.log_path is None:
+            return
+        with self.log_lock:
+            with self.context.open(self.log_path, 'a') as f:
+                f.write(data)
+
+    def _kill(self, proc):
+        for sig, wait in [(signal.SIGTERM, self.kill_grace), (signal.SIGKILL, None)]:
+            try:
+                real_os.killpg(proc.pid, sig)
+            except OSError:
+                return
+            deadline = time.time() + (wait or 0)
+            while proc.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if proc.poll() is not None:
+                return
+        proc.wait()
+
+    def run(self, cmd, stdin=None, timeout=None, echo=False, check=True, **kwargs):
+        '''
+        runs cmd (Popen arguments in kwargs, e.g. shell, cwd, env) and
+        returns its Result.
+        '''
+        with self.slots:
+            return self._run(cmd, stdin, self._timeout(timeout), echo, check, kwargs)
+
+    def _run(self, cmd, stdin, timeout, echo, check, kwargs):
+        if timeout is not None and timeout <= 0:
+            raise CommandTimeout(cmd, timeout)
+        kwargs.pop('stderr', None)
+        buf = RingBuffer(self.buffer_size)
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if stdin is not None else None,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                preexec_fn=real_os.setpgrp, close_fds=True, **kwargs)
+        self._log('==> [%d] %s\n' % (proc.pid, cmd if isinstance(cmd, basestring) else ' '.join(cmd)))
+        def feed():
+            try:
+                proc.stdin.write(str(stdin))
+            except IOError:
+                pass # it exited without reading it all
+            finally:
+                proc.stdin.close()
+        def drain():
+            # closes the pipe itself, since it may outlive the call
+            try:
+                while True:
+                    chunk = real_os.read(proc.stdout.fileno(), 65536)
+                    if not chunk:
+                        break
+                    buf.write(chunk)
+                    self._log(chunk)
+                    if echo:
+                        sys.stdout.write(chunk)
+                        sys.stdout.flush()
+            finally:
+                proc.stdout.close()
+        threads = [threading.Thread(target=drain)]
+        if stdin is not None:
+            threads += [threading.Thread(target=feed)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        deadline = None if timeout is None else start + timeout
+        try:
+            while threads[0].is_alive():
+                left = None if deadline is None else deadline - time.time()
+                if left is not None and left <= 0:
+                    self._kill(proc)
+                    threads[0].join(self.kill_grace)
+                    raise CommandTimeout(cmd, timeout, buf.getvalue())
+                threads[0].join(0.05 if left is None else min(left, 0.05))
+                if proc.poll() is not None:
+                    # it exited, but something it started in the
+                    # background (a daemon) may hold the pipe open;
+                    # take what's buffered and don't wait for the rest
+                    threads[0].join(self.drain_grace)
+                    break
+            returncode = proc.wait()
+        finally:
+            if proc.poll() is None:
+                self._kill(proc)
+        result = Result(cmd, proc.pid, returncode, time.time() - start, buf.getvalue(), buf.dropped)
+        # without the output, which could add up
+        self.history.append(Result(cmd, proc.pid, returncode, result.duration, None, buf.dropped))
+        self._log('==> [%d] exited %d after %.3fs\n' % (proc.pid, returncode, result.duration))
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, result.output)
+        return result
+
+    def run_all(self, cmds, **kwargs):
+        '''
+        runs independent commands concurrently, at most max_workers at
+        a time, and returns their Results in order.  if any fail, the
+        first failure is raised once they've all finished.
+        '''
+        results = [None] * len(cmds)
+        errors = []
+        def run(i, cmd):
+            try:
+                results[i] = self.run(cmd, **kwargs)
+            except Exception as e:
+                errors.append((i, e))
+        threads = [threading.Thread(target=run, args=(i, cmd)) for i, cmd in enumerate(cmds)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise sorted(errors)[0][1]
+        return results
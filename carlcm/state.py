@@ -0,0 +1,148 @@
+import errno
+import hashlib
+import json
+
+DEFAULT_STATE_PATH = '/var/lib/carlcm/state.json'
+
+class StateStore(object):
+    '''
+    Remembers, per resource, a fingerprint of what it was asked for
+    and of what was on disk when it last converged, so that unchanged
+    resources can be skipped on the next run with a single stat.
+
+    With path=None (the default) nothing is remembered and nothing is
+    skipped.  Setting verify=True forces every resource to be fully
+    checked again, while still recording fresh fingerprints.
+    '''
+
+    version = 1
+
+    def __init__(self, context, path=None, verify=False):
+        self.context = context
+        self.path = path
+        self.verify = verify
+        self.resources = None
+        self.known_digests = {}
+        self.used_digests = {}
+        self.skipped = 0
+        self.verified = 0
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _load(self):
+        if self.resources is not None:
+            return self.resources
+        self.resources = {}
+        if not self.enabled:
+            return self.resources
+        try:
+            with self.context.open(self.path, 'rb') as f:
+                d = json.loads(f.read())
+            if d.get('version') == self.version:
+                self.resources = d['resources']
+                self.known_digests = d.get('digests', {})
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            pass # corrupt state just means a full run
+        return self.resources
+
+    def digest(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    def stat_fingerprint(self, path):
+        '''
+        size, mtime_ns, ctime_ns, inode, mode, uid and gid of path, or
+        None if it doesn't exist.  a resource without a path (path=None)
+        has the empty fingerprint.
+        '''
+        if path is None:
+            return []
+        try:
+            st = self.context.os.stat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return [st.st_size,
+                getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)),
+                getattr(st, 'st_ctime_ns', int(st.st_ctime * 1e9)),
+                st.st_ino, st.st_mode, st.st_uid, st.st_gid]
+
+    def _normalize(self, inputs):
+        # so that freshly built inputs compare equal to ones loaded
+        # back from json (tuples become lists, etc.)
+        return json.loads(json.dumps(inputs, sort_keys=True))
+
+    def unchanged(self, key, inputs, path):
+        '''
+        True if the resource was last converged with the same inputs
+        and path still looks exactly like it did afterwards.
+        '''
+        if not self.enabled:
+            return False
+        entry = self._load().get(key)
+        if (not self.verify and entry is not None and
+            entry['inputs'] == self._normalize(inputs) and
+            entry['result'] is not None and
+            entry['result'] == self.stat_fingerprint(path)):
+            self.skipped += 1
+            return True
+        self.verified += 1
+        return False
+
+    def record(self, key, inputs, path, sha256=None, **extra):
+        '''
+        extra values are kept alongside the fingerprints, and can be
+        read back with entry().
+        '''
+        if not self.enabled:
+            return
+        entry = self._normalize(extra)
+        entry.update({'inputs': self._normalize(inputs),
+                      'result': self.stat_fingerprint(path),
+                      'sha256': sha256})
+        self._load()[key] = entry
+
+    def entry(self, key):
+        if not self.enabled:
+            return {}
+        return self._load().get(key, {})
+
+    def forget(self, key):
+        if self.enabled:
+            self._load().pop(key, None)
+
+    def digests(self, key):
+        '''
+        digests remembered for a file fingerprint (see HashCache).
+        these are kept in memory even when the store is disabled.
+        '''
+        if key in self.used_digests:
+            return self.used_digests[key]
+        self._load()
+        if key in self.known_digests:
+            self.used_digests[key] = self.known_digests[key]
+        return self.used_digests.get(key, {})
+
+    def remember_digests(self, key, digests):
+        # only digests used in this run are saved, so stale ones
+        # don't pile up
+        self.used_digests[key] = digests
+
+    def report(self):
+        return {'skipped': self.skipped, 'verified': self.verified}
+
+    def save(self):
+        if not self.enabled or self.resources is None:
+            return
+        self.context._mkdir(self.context.os.path.dirname(self.path))
+        self.context._write_file(self.path, json.dumps({'version': self.version,
+                                                        'resources': self.resources,
+                                                        'digests': self.used_digests},
+                                                       sort_keys=True))
@@ -0,0 +1,100 @@
+import hashlib
+import posixpath
+
+import jinja2
+
+DEFAULT_BYTECODE_CACHE_PATH = '/var/cache/carlcm/jinja2'
+
+INLINE_PREFIX = 'inline:'
+
+class ContextLoader(jinja2.BaseLoader):
+    '''
+    Loads templates through the ConfigurationManager's os and open, so
+    it works on the mock filesystem too.  Template names are file
+    paths, except for inline templates, which are registered under
+    'inline:<sha1 of source>'.
+    '''
+
+    def __init__(self, context):
+        self.context = context
+        self.inline = {}
+
+    def add_inline(self, source):
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        name = INLINE_PREFIX + hashlib.sha1(source).hexdigest()
+        self.inline.setdefault(name, source.decode('utf-8'))
+        return name
+
+    def _stat(self, path):
+        st = self.context.os.stat(path)
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def get_source(self, environment, template):
+        if template in self.inline:
+            return self.inline[template], None, lambda: True
+        try:
+            stat = self._stat(template)
+            source = self.context._read_file(template).decode('utf-8')
+        except (IOError, OSError):
+            raise jinja2.TemplateNotFound(template)
+        def uptodate():
+            try:
+                return self._stat(template) == stat
+            except OSError:
+                return False
+        return source, template, uptodate
+
+class TemplateEnvironment(jinja2.Environment):
+
+    def join_path(self, template, parent):
+        '''
+        includes and extends in a template file are relative to that
+        file's directory.
+        '''
+        if posixpath.isabs(template) or parent.startswith(INLINE_PREFIX):
+            return template
+        return posixpath.join(posixpath.dirname(parent), template)
+
+class Templates(object):
+    '''
+    One shared jinja2 environment per ConfigurationManager, so that
+    each template is compiled once per process (the environment keeps
+    an LRU of cache_size compiled templates), and, with a
+    bytecode_cache_path, once across runs.
+    '''
+
+    def __init__(self, context, bytecode_cache_path=None, cache_size=400):
+        self.context = context
+        self.bytecode_cache_path = bytecode_cache_path
+        self.cache_size = cache_size
+        self._environment = None
+
+    @property
+    def environment(self):
+        if self._environment is None:
+            bytecode_cache = None
+            if self.bytecode_cache_path is not None:
+                self.context._mkdir(self.bytecode_cache_path)
+                bytecode_cache = jinja2.FileSystemBytecodeCache(self.bytecode_cache_path)
+            self._environment = TemplateEnvironment(loader=ContextLoader(self.context),
+                                                    cache_size=self.cache_size,
+                                                    bytecode_cache=bytecode_cache)
+        return self._environment
+
+    def clear_inline(self):
+        '''
+        forgets the sources of the inline templates; each is registered
+        again when it's next rendered, and the compiled ones stay in
+        the LRU.
+        '''
+        if self._environment is not None:
+            self._environment.loader.inline.clear()
+
+    def get(self, template=None, template_file=None):
+        if template_file is not None:
+            return self.environment.get_template(template_file)
+        return self.environment.get_template(self.environment.loader.add_inline(template))
+
+    def render(self, template=None, template_file=None, vars=None):
+        return self.get(template, template_file).render(vars or {}).encode('utf-8')
@@ -0,0 +1,116 @@
+import itertools
+import json
+import threading
+import time
+
+class _NoSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_SPAN = _NoSpan()
+
+class Span(object):
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self.id = next(self.tracer.ids)
+        self.parent = stack[-1].id if stack else None
+        self.thread = threading.current_thread().ident
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.time() - self.start
+        self.tracer._stack().pop()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer._finished(self)
+        return False
+
+class Tracer(object):
+    '''
+    Records a span for each module's main(), each action call, and
+    each subprocess, HTTP transfer and AWS call, nested by thread.
+    save() writes them to path, either as a Chrome trace-event file
+    (format='chrome', which Perfetto and chrome://tracing open) or as
+    one json object per finished span (format='jsonl'), which is
+    written as spans finish.  begin_run() starts the spans over, so a
+    long-lived ConfigurationManager saves only the latest run's.
+
+    With path=None (the default) span() returns a shared no-op, so
+    tracing costs one attribute check per span.
+    '''
+
+    def __init__(self, context, path=None, format='chrome'):
+        assert format in ['chrome', 'jsonl']
+        self.context = context
+        self.path = path
+        self.format = format
+        self.spans = []
+        self.ids = itertools.count(1)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stream = None
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def span(self, name, cat, **args):
+        if self.path is None:
+            return NO_SPAN
+        return Span(self, name, cat, args)
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _event(self, span):
+        return {'name': span.name, 'cat': span.cat, 'id': span.id, 'parent': span.parent,
+                'thread': span.thread, 'start': span.start, 'duration': span.duration,
+                'args': span.args}
+
+    def _finished(self, span):
+        with self.lock:
+            if self.format == 'jsonl':
+                if self.stream is None:
+                    self.context._mkdir(self.context.os.path.dirname(self.path))
+                    self.stream = self.context.open(self.path, 'a')
+                self.stream.write(json.dumps(self._event(span), sort_keys=True, default=str) + '\n')
+                self.stream.flush()
+            else:
+                self.spans.append(span)
+
+    def chrome_trace(self):
+        pid = self.context.os.getpid()
+        events = []
+        for s in sorted(self.spans, key=lambda s: s.start):
+            args = dict(s.args)
+            args.update({'id': s.id, 'parent': s.parent})
+            events.append({'name': s.name, 'cat': s.cat, 'ph': 'X', 'pid': pid, 'tid': s.thread,
+                           'ts': int(s.start * 1e6), 'dur': int(s.duration * 1e6), 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self):
+        if not self.enabled:
+            return
+        if self.format == 'jsonl':
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            return
+        self.context._mkdir(self.context.os.path.dirname(self.path))
+        self.context._write_file(self.path, json.dumps(self.chrome_trace(), sort_keys=True, default=str))
@@ -14,6 +14,8 @@ config = {
     'install_requires': ['jinja2>=2', 'pyyaml>=3', 'requests>=2'],
     'packages': find_packages(),
     'scripts': [
+        'bin/carlcm-agent',
+        'bin/carlcm-apply-catalog',
         'bin/carlcm-bootstrap-council',
         'bin/carlcm-cluster-role',
         'bin/carlcm-counselor',
@@ -0,0 +1,59 @@
+from nose.tools import *
+
+import carlcm
+
+c = None
+
+class TestCarlCMAccounts(object):
+
+    def setup(self):
+        global c
+        c = carlcm.MockConfigurationManager()
+        c._mkdir('/etc')
+        c._write_file('/etc/passwd', '''root:x:0:0:root:/root:/bin/bash
+# a comment
+jessie:x:1000:1000:Jessie,,,:/home/jessie:/bin/bash
++nisuser::::::
+''')
+        c._write_file('/etc/group', '''root:x:0:
+admins:x:27:jessie,root
+jessie:x:1000:
+gamers:x:1001:jessie
+''')
+        c._write_file('/etc/shadow', 'jessie:$6$salt$hash:16000:0:99999:7:::\n')
+
+    def test_user(self):
+        eq_(c.accounts.user('jessie'),
+            {'name': 'jessie', 'uid': 1000, 'gid': 1000, 'comment': 'Jessie,,,',
+             'home': '/home/jessie', 'shell': '/bin/bash'})
+        eq_(c.accounts.user('nobody-at-all'), None)
+
+    def test_group(self):
+        eq_(c.accounts.group('admins'), {'name': 'admins', 'gid': 27, 'members': ['jessie', 'root']})
+        eq_(c.accounts.group('root')['gid'], 0)
+
+    def test_user_groups(self):
+        eq_(c.accounts.user_groups('jessie'), ['admins', 'gamers', 'jessie'])
+        eq_(c.accounts.user_groups('root'), ['admins', 'root'])
+
+    def test_password_hash(self):
+        eq_(c.accounts.password_hash('jessie'), '$6$salt$hash')
+        eq_(c.accounts.password_hash('root'), None)
+
+    def test_loaded_once(self):
+        for i in xrange(10):
+            c.accounts.user('jessie')
+            c.accounts.group('gamers')
+        eq_(c.accounts.loads, 1)
+        c.accounts.invalidate()
+        c.accounts.user('jessie')
+        eq_(c.accounts.loads, 2)
+
+    def test_set_user_groups(self):
+        carlcm.ConfigurationManager._set_user_groups(c, 'jessie', ['wheel', 'admins'])
+        c._cmd_quiet.assert_called_once_with(['usermod', '-G', 'admins,wheel', 'jessie'])
+        c.accounts.user('jessie')
+        c.accounts.user('jessie')
+        carlcm.ConfigurationManager._set_user_groups(c, 'jessie', ['wheel'])
+        c.accounts.user('jessie')
+        eq_(c.accounts.loads, 2)
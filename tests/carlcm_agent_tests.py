@@ -0,0 +1,95 @@
+import json
+import os
+import shutil
+import tempfile
+import urllib2
+
+from mock import Mock
+from nose.tools import *
+
+import carlcm
+from carlcm.agent import Agent, IN_Q_OVERFLOW
+
+c = None
+
+class TestCarlCMAgent(object):
+
+    def setup(self):
+        global c
+        self.dir = tempfile.mkdtemp()
+        c = carlcm.ConfigurationManager(state_path=os.path.join(self.dir, 'state.json'))
+        c._cmd = Mock(return_value=0)
+        self.runs = 0
+        self.agent = Agent(c, self.converge, interval=3600)
+
+    def teardown(self):
+        self.agent.stop()
+        self.agent.inotify.close()
+        shutil.rmtree(self.dir)
+
+    def path(self, *parts):
+        return os.path.join(self.dir, *parts)
+
+    def converge(self, context):
+        self.runs += 1
+        context.handler('conf', cmd='reload-a')
+        context.mkdir(self.path('etc'))
+        context.file(self.path('etc', 'a.conf'), data='a\n', mode=0o644, triggers='conf')
+        context.file(self.path('etc', 'b.conf'), data='b\n')
+
+    def test_full_run_records_paths(self):
+        self.agent.run()
+        eq_(self.runs, 1)
+        eq_(sorted(self.agent.recorder.paths),
+            [self.path('etc'), self.path('etc', 'a.conf'), self.path('etc', 'b.conf')])
+        # mkdir, both files and the handler's cmd
+        eq_(self.agent.last_run['changed'], 4)
+        # our own writes aren't drift
+        eq_(self.agent.step(0), 0)
+
+    def test_repairs_only_what_drifted(self):
+        self.agent.run()
+        c._cmd.reset_mock()
+        with open(self.path('etc', 'a.conf'), 'w') as f:
+            f.write('tampered\n')
+        eq_(self.agent.step(1), 1)
+        eq_(open(self.path('etc', 'a.conf')).read(), 'a\n')
+        eq_(self.runs, 1)
+        eq_(self.agent.repairs, 1)
+        # the file, and the handler the full run registered
+        eq_(self.agent.last_repair['actions'], 2)
+        eq_(c._cmd.call_args[0][0], 'reload-a')
+        eq_(self.agent.step(0), 0)
+
+    def test_repairs_mode_and_deletion(self):
+        self.agent.run()
+        os.chmod(self.path('etc', 'a.conf'), 0o600)
+        os.unlink(self.path('etc', 'b.conf'))
+        eq_(self.agent.step(1), 2)
+        eq_(os.stat(self.path('etc', 'a.conf')).st_mode & 0o777, 0o644)
+        eq_(open(self.path('etc', 'b.conf')).read(), 'b\n')
+
+    def test_unmanaged_files_are_ignored(self):
+        self.agent.run()
+        open(self.path('etc', 'c.conf'), 'w').close()
+        eq_(self.agent.step(1), 0)
+        eq_(self.agent.repairs, 0)
+
+    def test_overflow_runs_everything(self):
+        self.agent.run()
+        eq_(self.agent.drifted([(None, None, IN_Q_OVERFLOW)]), None)
+
+    @raises(ValueError)
+    def test_file_object_not_replayable(self):
+        self.converge = lambda context: context.file(self.path('a'), data=open(__file__))
+        Agent(c, self.converge, watch=False).run()
+
+    def test_status(self):
+        self.agent.status_port = 0
+        self.agent.run()
+        server = self.agent.serve_status()
+        status = json.loads(urllib2.urlopen('http://127.0.0.1:%d/' % server.server_port).read())
+        eq_(status['runs'], 1)
+        eq_(status['watched_paths'], 3)
+        eq_(status['last_run']['actions'], 4)
+        ok_(status['last_run']['seconds'] >= 0)
@@ -0,0 +1,84 @@
+import hashlib
+
+from nose.tools import *
+
+import carlcm
+from carlcm.artifact_cache import ArtifactCache
+
+c = None
+
+URL = 'http://blah.com/blah.zip'
+DATA = 'zipzipzip\n'
+SHA = hashlib.sha256(DATA).hexdigest()
+
+class TestCarlCMArtifactCache(object):
+
+    def setup(self):
+        global c
+        c = carlcm.MockConfigurationManager()
+        c.artifacts = ArtifactCache(c, '/cache', shared_path='/shared')
+        c.mock_urls[URL] = DATA
+
+    def test_download_populates_cache(self):
+        eq_(c.download('/a/blah.zip', URL, sha256=SHA), True)
+        eq_(c._read_file('/cache/%s/%s' % (SHA[:2], SHA)), DATA)
+        eq_(c._read_file('/shared/%s/%s' % (SHA[:2], SHA)), DATA)
+        eq_((c.artifacts.hits, c.artifacts.misses), (0, 1))
+
+    def test_download_from_cache(self):
+        c.download('/a/blah.zip', URL, sha256=SHA)
+        del c.mock_urls[URL]
+        eq_(c.download('/b/blah.zip', URL, sha256=SHA, mode='600'), True)
+        eq_(c._read_file('/b/blah.zip'), DATA)
+        eq_(c.download('/b/blah.zip', URL, sha256=SHA, mode='600'), False)
+        eq_(c.artifacts.hits, 1)
+
+    def test_local_corrupt_ignored(self):
+        c.download('/a/blah.zip', URL, sha256=SHA)
+        c._write_file('/cache/%s/%s' % (SHA[:2], SHA), 'corrupt')
+        eq_(c.download('/b/blah.zip', URL, sha256=SHA), True)
+        eq_(c._read_file('/b/blah.zip'), DATA)
+        eq_(c._read_file('/cache/%s/%s' % (SHA[:2], SHA)), DATA)
+        # pulled back from the shared store
+        eq_((c.artifacts.hits, c.artifacts.misses), (1, 1))
+
+    def test_installed_copy(self):
+        c.download('/a/blah.zip', URL, sha256=SHA)
+        c.download('/b/blah.zip', URL, sha256=SHA)
+        with c.open('/b/blah.zip', 'r+b') as f:
+            f.write('edited')
+        eq_(c._read_file('/cache/%s/%s' % (SHA[:2], SHA)), DATA)
+
+    def test_download_from_shared(self):
+        c._mkdir('/shared/' + SHA[:2])
+        c._write_file('/shared/%s/%s' % (SHA[:2], SHA), DATA)
+        del c.mock_urls[URL]
+        eq_(c.download('/a/blah.zip', URL, sha256=SHA), True)
+        eq_(c._read_file('/a/blah.zip'), DATA)
+        eq_(c._read_file('/cache/%s/%s' % (SHA[:2], SHA)), DATA)
+
+    def test_shared_corrupt_ignored(self):
+        c._mkdir('/shared/' + SHA[:2])
+        c._write_file('/shared/%s/%s' % (SHA[:2], SHA), 'corrupt')
+        eq_(c.download('/a/blah.zip', URL, sha256=SHA), True)
+        eq_(c._read_file('/a/blah.zip'), DATA)
+
+    def test_evict_lru(self):
+        c.artifacts = ArtifactCache(c, '/cache', max_bytes=25)
+        shas = []
+        for i, data in enumerate(['a' * 10, 'b' * 10, 'c' * 10]):
+            c._write_file('/f%d' % i, data)
+            shas.append(hashlib.sha256(data).hexdigest())
+            c.artifacts.put('/f%d' % i, shas[-1])
+            c.artifacts.index[shas[-1]] = i
+            if i == 1:
+                c.artifacts.index[shas[0]] = 5
+        c.artifacts.evict()
+        eq_(sorted(c.artifacts._objects()), sorted([shas[0], shas[2]]))
+        eq_(c.artifacts.size(), 20)
+
+    def test_index_persisted(self):
+        c.download('/a/blah.zip', URL, sha256=SHA)
+        c.artifacts.save()
+        cache = ArtifactCache(c, '/cache')
+        eq_(cache._load().keys(), [SHA])
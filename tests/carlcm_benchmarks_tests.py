@@ -0,0 +1,43 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from nose.tools import *
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+class TestCarlCMBenchmarks(object):
+    '''
+    only that the suite still runs; not how fast.
+    '''
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def bench(self, *args):
+        return subprocess.check_output([sys.executable, os.path.join(ROOT, 'benchmarks', 'actions.py'),
+                                        '--quick'] + list(args), cwd=ROOT)
+
+    def test_results(self):
+        output = os.path.join(self.dir, 'results.json')
+        self.bench('--only', '^(file_small|dir)$', '--output', output)
+        d = json.load(open(output))
+        eq_(d['scale'], 0.1)
+        eq_(sorted(d['results']),
+            ['mock/dir/cold', 'mock/dir/warm', 'mock/file_small/cold', 'mock/file_small/warm',
+             'tmpfs/dir/cold', 'tmpfs/dir/warm', 'tmpfs/file_small/cold', 'tmpfs/file_small/warm'])
+        r = d['results']['tmpfs/file_small/warm']
+        eq_(r['ops'], 100)
+        ok_(r['latency_ms']['p50'] <= r['latency_ms']['p99'] <= r['latency_ms']['max'])
+
+    def test_compare(self):
+        output = os.path.join(self.dir, 'results.json')
+        self.bench('--backend', 'mock', '--only', '^dir$', '--output', output)
+        ok_('mock/dir/warm' in self.bench('--backend', 'mock', '--only', '^dir$',
+                                          '--compare', output, '--threshold', '100'))
@@ -0,0 +1,79 @@
+import json
+
+from mock import Mock
+from nose.tools import *
+
+import carlcm
+from carlcm.catalog import Catalog
+
+c = None
+
+class ExampleModule(carlcm.BaseModule):
+
+    def packages(self):
+        return ['nginx']
+
+    def main(self, context):
+        context.handler('nginx', service='nginx', action='reload')
+        context.mkdir('/etc/nginx')
+        context.file('/etc/nginx/nginx.conf', data='worker_processes 4;\n',
+                     mode=0o644, triggers='nginx')
+        context.user('www', home='/var/www')
+
+class TestCarlCMCatalog(object):
+
+    def setup(self):
+        global c
+        c = carlcm.MockConfigurationManager()
+
+    def converge(self, context):
+        context.add_modules(ExampleModule())
+        context.run_modules()
+
+    def test_compile_changes_nothing(self):
+        catalog = Catalog(c, role='example').compile(self.converge)
+        eq_(c.os.path.exists('/etc/nginx'), False)
+        eq_([call[0] for call in catalog.calls],
+            ['begin_package_batch', 'apt', 'flush_package_batch',
+             'handler', 'mkdir', 'file', 'user', 'flush_handlers'])
+        eq_(catalog.calls[-2][3], 'ExampleModule')
+        eq_(c.planned, None)
+
+    def test_round_trip(self):
+        Catalog(c, role='example').compile(self.converge).save('/var/lib/carlcm/example.json')
+        d = json.loads(c.open('/var/lib/carlcm/example.json').read())
+        eq_(d['version'], Catalog.version)
+        eq_(d['role'], 'example')
+        eq_(c.os.stat('/var/lib/carlcm/example.json').st_mode & 0o777, 0o600)
+        catalog = Catalog(c).load('/var/lib/carlcm/example.json')
+        eq_(catalog.role, 'example')
+        # back to str, which actions check for
+        eq_(type(catalog.calls[5][2]['triggers']), str)
+
+    def test_apply(self):
+        Catalog(c).compile(self.converge).save('/catalog.json')
+        a = carlcm.MockConfigurationManager()
+        a._mkdir('/')
+        a.fs.CreateFile('/catalog.json', contents=c.open('/catalog.json').read())
+        a._apt_install = Mock(return_value=set(['nginx']))
+        Catalog(a).load('/catalog.json').apply()
+        a._apt_install.assert_called_once_with(['nginx'])
+        eq_(a.open('/etc/nginx/nginx.conf').read(), 'worker_processes 4;\n')
+        eq_(a.os.stat('/etc/nginx/nginx.conf').st_mode & 0o777, 0o644)
+        eq_(a.mock_users[-1]['name'], 'www')
+        # the handler ran, once, at the end
+        eq_(a._cmd.call_args_list[-1][0][0], ['service', 'nginx', 'reload'])
+        eq_(a.metrics.totals()[('ExampleModule', 'file')]['changed'], 1)
+
+    @raises(ValueError)
+    def test_unserializable(self):
+        Catalog(c).compile(lambda context: context.file('/a', data=open('/dev/null'))).to_json()
+
+    @raises(ValueError)
+    def test_version(self):
+        c._write_file('/catalog.json', json.dumps({'version': 0, 'role': None, 'calls': []}))
+        Catalog(c).load('/catalog.json')
+
+    @raises(ValueError)
+    def test_not_utf8(self):
+        Catalog(c).compile(lambda context: context.file('/a', data='\xff')).to_json()
@@ -1,4 +1,5 @@
 
+import json
 from stat import S_ISDIR, S_IMODE
 
 import fake_filesystem
@@ -6,6 +7,8 @@ from nose.tools import *
 from mock import Mock, MagicMock, call
 
 import carlcm
+from carlcm.artifact_cache import ArtifactCache
+from carlcm.state import StateStore
 
 c = None
 
@@ -206,26 +209,26 @@ class TestCarlCMConfigurationManager(object):
         eq_(c._useradd_cmd('auser', comment='blah'), ['useradd', '-c', 'blah', '-U', 'auser'])
 
     def test_group_exists(self):
-        c.groups += [{'name':'group', 'id': 1003}]
+        c.mock_groups += [{'name':'group', 'id': 1003}]
         eq_(c.group('group'), False)
 
     def test_group_new(self):
         eq_(c.group('group'), True)
-        eq_(c.groups[1], {'name':'group', 'id': 1000})
+        eq_(c.mock_groups[1], {'name':'group', 'id': 1000})
 
     def test_group_new_with_gid(self):
         eq_(c.group('group', gid=74), True)
-        eq_(c.groups[1], {'name':'group', 'id': 74})
+        eq_(c.mock_groups[1], {'name':'group', 'id': 74})
 
     def test_user_exists(self):
-        c.users += [{'name':'jessie', 'id':1002, 'home':None}]
+        c.mock_users += [{'name':'jessie', 'id':1002, 'home':None}]
         eq_(c.user('jessie', home=False), False)
 
     def test_user_new(self):
         eq_(c.user('jessie'), True)
-        eq_(c.users[1]['name'], 'jessie')
-        eq_(c.users[1]['groups'], ['jessie'])
-        eq_(c.groups[1]['name'], 'jessie')
+        eq_(c.mock_users[1]['name'], 'jessie')
+        eq_(c.mock_users[1]['groups'], ['jessie'])
+        eq_(c.mock_groups[1]['name'], 'jessie')
         eq_(self.os.path.isdir('/home/jessie'), True)
         eq_(S_IMODE(self.os.stat('/home/jessie').st_mode), 0755)
         eq_(self.os.stat('/home/jessie').st_uid, 1000)
@@ -245,8 +248,8 @@ class TestCarlCMConfigurationManager(object):
 
     def test_user_new_grouped(self):
         eq_(c.user('jessie', groups=['agroup', 'bgroup']), True)
-        eq_(c.users[1]['name'], 'jessie')
-        eq_(c.users[1]['groups'], ['agroup', 'bgroup', 'jessie'])
+        eq_(c.mock_users[1]['name'], 'jessie')
+        eq_(c.mock_users[1]['groups'], ['agroup', 'bgroup', 'jessie'])
 
     def test_user_authorized_keys(self):
         eq_(c.user('jessie', authorized_keys='ssh-rsa blah== blah@blah'), True)
@@ -266,44 +269,88 @@ class TestCarlCMConfigurationManager(object):
         c.user('jessie', authorized_keys='ssh-rsa blah== blah@blah', home=False)
 
     def test_user_groups_unchanged(self):
-        c.users += [{'name':'jessie', 'id':1000,
+        c.mock_users += [{'name':'jessie', 'id':1000,
                      'groups':['wheel', 'admins', 'gamers', 'jessie']}]
         eq_(c.user('jessie', home=False, groups=['wheel', 'admins', 'gamers']), False)
 
     def test_user_groups_changed(self):
-        c.users += [{'name':'jessie', 'id':1000,
+        c.mock_users += [{'name':'jessie', 'id':1000,
                      'groups':['devs', 'admins', 'gamers', 'jessie']}]
         eq_(c.user('jessie', home=False, groups=['wheel', 'admins', 'gamers']), True)
-        eq_(c.users[1]['groups'], ['admins', 'gamers', 'jessie', 'wheel'])
+        eq_(c.mock_users[1]['groups'], ['admins', 'gamers', 'jessie', 'wheel'])
 
     def test_current_apt_packages(self):
-        c._cmd_quiet.side_effect = ['''
-Desired=Unknown/Install/Remove/Purge/Hold
-| Status=Not/Inst/Conf-files/Unpacked/halF-conf/Half-inst/trig-aWait/Trig-pend
-|/ Err?=(none)/Reinst-required (Status,Err: uppercase=bad)
-||/ Name                                                  Version                                             Architecture Description
-+++-=====================================================-===================================================-============-===============================================================================
-ii  ack-grep                                              2.12-1                                              all          grep-like program specifically for large source trees
-ii  acpid                                                 1:2.0.21-1ubuntu2                                   amd64        Advanced Configuration and Power Interface event daemon
-''']
-        eq_(c.current_apt_packages(), {'ack-grep':'2.12-1','acpid':'1:2.0.21-1ubuntu2'})
-        eq_(c.current_apt_packages(), {'ack-grep':'2.12-1','acpid':'1:2.0.21-1ubuntu2'})
-        c._cmd_quiet.assert_has_calls([call(['dpkg', '-l'])])
+        c._mkdir('/var/lib/dpkg')
+        c._write_file('/var/lib/dpkg/status', '''Package: ack-grep
+Status: install ok installed
+Priority: optional
+Architecture: all
+Version: 2.12-1
+Description: grep-like program specifically for large source trees
+ Ack is designed as a replacement for 99% of the uses of grep.
+
+Package: acpid
+Status: install ok installed
+Architecture: amd64
+Multi-Arch: foreign
+Version: 1:2.0.21-1ubuntu2
+
+Package: removed
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 1.0
+''')
+        eq_(c.current_apt_packages(), {'ack-grep':'2.12-1','acpid':'1:2.0.21-1ubuntu2',
+                                       'acpid:amd64':'1:2.0.21-1ubuntu2'})
+        eq_(c.apt_package_status()['removed'], ('1.0', 'amd64', 'deinstall ok config-files'))
+        eq_(c.current_apt_packages()['ack-grep'], '2.12-1')
+        c._write_file('/var/lib/dpkg/status', '''Package: ack-grep
+Status: install ok installed
+Architecture: all
+Version: 2.13-1
+''')
+        eq_(c.current_apt_packages(), {'ack-grep':'2.13-1'})
+        eq_(c._cmd_quiet.call_count, 0)
+
+    def test_current_apt_packages_no_dpkg(self):
+        eq_(c.current_apt_packages(), {})
 
     def test_current_pip_packages(self):
-        c._cmd_quiet.side_effect = ['''
-argparse==1.2.1
-boto==2.38.0
-''']
-        eq_(c.current_pip_packages(), {'argparse':'1.2.1','boto':'2.38.0'})
-        eq_(c.current_pip_packages(), {'argparse':'1.2.1','boto':'2.38.0'})
-        c._cmd_quiet.assert_has_calls([call(['pip', 'freeze'])])
+        c._mkdir('/site-packages/boto-2.38.0.dist-info')
+        c._mkdir('/site-packages/PyYAML-3.11-py2.7.egg-info')
+        c._mkdir('/site-packages/python_consul-0.4.4.dist-info')
+        c._mkdir('/site-packages/boto')
+        c._touch('/site-packages/argparse-1.2.1.egg-info')
+        c._touch('/site-packages/six.py')
+        c.pip_paths = ['/site-packages', '/nonexistent']
+        expected = {'argparse':'1.2.1','boto':'2.38.0','pyyaml':'3.11','python-consul':'0.4.4'}
+        eq_(c.current_pip_packages(), expected)
+        eq_(c.current_pip_packages(), expected)
+        eq_(c._cmd_quiet.call_count, 0)
 
     def test_pip_new(self):
         c.current_pip_packages = Mock(return_value={})
         eq_(c.pip('asdf hello=world'), True)
-        c._cmd_quiet.assert_has_calls([call(['pip', 'install', 'asdf', '--upgrade']),
-                                       call(['pip', 'install', 'hello==world'])])
+        eq_(c._cmd_quiet.call_args_list, [call(['pip', 'install', '--upgrade', 'asdf']),
+                                          call(['pip', 'install', 'hello==world'])])
+
+    def test_pip_present(self):
+        c.current_pip_packages = Mock(return_value={'pyyaml':'3.11', 'python-consul':'0.4.4'})
+        eq_(c.pip(['PyYAML', 'python_consul==0.4.4']), False)
+        eq_(c._cmd_quiet.call_count, 0)
+
+    def test_pip_batched(self):
+        c.current_pip_packages = Mock(return_value={'boto':'2.38.0'})
+        c.begin_package_batch()
+        eq_(c.pip('boto>=2.30', triggers='t1'), False)
+        eq_(c.pip(['asdf', 'Hello=world'], triggers='t2'), False)
+        eq_(c.pip('hello', triggers='t3'), False)
+        eq_(c.flush_package_batch(), True)
+        eq_(c._cmd_quiet.call_args_list, [call(['pip', 'install', '--upgrade', 'asdf']),
+                                          call(['pip', 'install', 'hello==world'])])
+        eq_(c.cmd([], triggered_by='t1'), False)
+        eq_(c.cmd([], triggered_by='t2'), True)
+        eq_(c.cmd([], triggered_by='t3'), True)
 
     def test_packages_new(self):
         c.current_apt_packages = Mock(return_value={})
@@ -374,3 +421,444 @@ boto==2.38.0
         eq_(c.download('/blah.txt', 'http://blah.com/blah.txt',
                        md5='2b00042f7481c7b056c4b410d28f33cf'), True)
         eq_(c._read_file('/blah.txt'), 'asdf\n')
+
+    def test_packages_batched(self):
+        c.current_apt_packages = Mock(return_value={'acpid':'1:2.0.21-1ubuntu2'})
+        c.begin_package_batch()
+        eq_(c.apt(['ack-grep', 'acpid'], triggers='t1'), False)
+        eq_(c.apt('acpid', triggers='t2'), False)
+        eq_(c.apt(['htop', 'ack-grep'], triggers='t3'), False)
+        eq_(c._cmd_quiet.call_count, 0)
+        eq_(c.flush_package_batch(), True)
+        c._cmd_quiet.assert_called_once_with(['apt-get', 'install', '-y', 'ack-grep', 'htop'])
+        eq_(c.cmd([], triggered_by='t1'), True)
+        eq_(c.cmd([], triggered_by='t2'), False)
+        eq_(c.cmd([], triggered_by='t3'), True)
+
+    def test_packages_batched_nothing_new(self):
+        c.current_apt_packages = Mock(return_value={'acpid':'1:2.0.21-1ubuntu2'})
+        c.begin_package_batch()
+        eq_(c.apt('acpid', triggers='t1'), False)
+        eq_(c.flush_package_batch(), False)
+        eq_(c._cmd_quiet.call_count, 0)
+        eq_(c.cmd([], triggered_by='t1'), False)
+
+    def test_packages_batched_version_merge(self):
+        c.current_apt_packages = Mock(return_value={'ack-grep':'2.12-0'})
+        c.begin_package_batch()
+        c.apt(['ack-grep', 'ack-grep>=2.11-0', 'acpid>=1.0'])
+        c.apt(['ack-grep>=2.12-1', 'acpid=1.2', 'acpid=any'])
+        c.flush_package_batch()
+        c._cmd_quiet.assert_called_once_with(['apt-get', 'install', '-y', 'ack-grep', 'acpid=1.2'])
+
+    def test__merge_pkgs(self):
+        eq_(c._merge_pkgs(['a', 'b>=1.9', 'a=latest', 'b>=1.10', 'c=2', 'c>=1']),
+            ['a=latest', 'b>=1.10', 'c=2'])
+
+    @raises(Exception)
+    def test__merge_pkgs_conflict(self):
+        c._merge_pkgs(['a=1.2', 'a=1.3'])
+
+    @raises(Exception)
+    def test__merge_pkgs_conflict_minimum(self):
+        c._merge_pkgs(['a=1.2', 'a>=1.3'])
+
+    def test_state_file_skipped(self):
+        c.state.path = '/var/lib/carlcm/state.json'
+        eq_(c.file('/f', data='asdf', mode='600'), True)
+        c._read_file = Mock(side_effect=AssertionError)
+        eq_(c.file('/f', data='asdf', mode='600'), False)
+        eq_(c.state.report(), {'skipped': 1, 'verified': 1})
+
+    def test_state_file_drift(self):
+        c.state.path = '/var/lib/carlcm/state.json'
+        eq_(c.file('/f', data='asdf'), True)
+        with self.open('/f', 'wb') as f: f.write('asdff')
+        eq_(c.file('/f', data='asdf'), True)
+        eq_(self.open('/f', 'rb').read(), 'asdf')
+        eq_(c.file('/f', data='blah'), True)
+        eq_(self.open('/f', 'rb').read(), 'blah')
+        eq_(c.state.report(), {'skipped': 0, 'verified': 3})
+
+    def test_state_persisted(self):
+        c.state.path = '/var/lib/carlcm/state.json'
+        eq_(c.dir('/d', mode='750'), True)
+        eq_(c.line_in_file('existingfile', 'blah'), True)
+        c.state.save()
+        c.state = StateStore(c, '/var/lib/carlcm/state.json')
+        c._mkdir = Mock(side_effect=AssertionError)
+        eq_(c.dir('/d', mode='750'), False)
+        eq_(c.line_in_file('existingfile', 'blah'), False)
+        eq_(c.state.report(), {'skipped': 2, 'verified': 0})
+
+    def test_state_verify(self):
+        c.state.path = '/var/lib/carlcm/state.json'
+        c.state.verify = True
+        eq_(c.dir('/d', mode='750'), True)
+        eq_(c.dir('/d', mode='750'), False)
+        eq_(c.state.report(), {'skipped': 0, 'verified': 2})
+
+    def test_state_verify_from_constructor(self):
+        cm = carlcm.ConfigurationManager(state_path='/var/lib/carlcm/state.json', verify=True)
+        eq_((cm.state.path, cm.state.verify), ('/var/lib/carlcm/state.json', True))
+
+    def test_state_download_skips_hashing(self):
+        c.state.path = '/var/lib/carlcm/state.json'
+        c.mock_urls['http://blah.com/blah.txt'] = 'asdf\n'
+        eq_(c.download('/blah.txt', 'http://blah.com/blah.txt',
+                       md5='2b00042f7481c7b056c4b410d28f33cf'), True)
+        c._hash_file = Mock(side_effect=AssertionError)
+        eq_(c.download('/blah.txt', 'http://blah.com/blah.txt',
+                       md5='2b00042f7481c7b056c4b410d28f33cf'), False)
+
+    def test_file_data_file_streamed(self):
+        import carlcm.configuration_manager as cm
+        old_chunk_size, cm.CHUNK_SIZE = cm.CHUNK_SIZE, 3
+        try:
+            with self.open('src', 'wb') as f: f.write('asdfasdfasdf')
+            with self.open('dest', 'wb') as f: f.write('asdfasdfasdg')
+            c._read_file = Mock(side_effect=AssertionError)
+            eq_(c.file('dest', data_file='src'), True)
+            eq_(self.open('dest', 'rb').read(), 'asdfasdfasdf')
+            eq_(c.file('dest', data_file='src'), False)
+        finally:
+            cm.CHUNK_SIZE = old_chunk_size
+
+    def test__files_equal(self):
+        with self.open('src', 'wb') as f: f.write('asdf')
+        eq_(c._files_equal('src', 'existingfile'), True)
+        with self.open('src', 'wb') as f: f.write('asdff')
+        eq_(c._files_equal('src', 'existingfile'), False)
+        with self.open('src', 'wb') as f: f.write('asdg')
+        eq_(c._files_equal('src', 'existingfile'), False)
+
+    def test_file_atomic_preserves_permissions(self):
+        self.os.chmod('existingfile', 0640)
+        self.os.chown('existingfile', 37, 75)
+        eq_(c.file('existingfile', data='new'), True)
+        eq_(self.open('existingfile', 'rb').read(), 'new')
+        eq_(S_IMODE(self.os.stat('existingfile').st_mode), 0640)
+        eq_(self.os.stat('existingfile').st_uid, 37)
+        eq_(self.os.stat('existingfile').st_gid, 75)
+        eq_([x for x in self.os.listdir('.') if 'carlcm' in x], [])
+
+    def test_file_new_with_mode(self):
+        eq_(c.file('/d/f', data='secret', mode='600'), True)
+        eq_(S_IMODE(self.os.stat('/d/f').st_mode), 0600)
+        eq_(self.os.listdir('/d'), ['f'])
+
+    def test_durability_file(self):
+        c.durability = 'file'
+        c._fsync = Mock()
+        c.file('/d/f', data='x')
+        c._fsync.assert_has_calls([call('/d/.f.carlcm-%d.tmp' % self.os.getpid()), call('/d')])
+        eq_(c._fsync.call_count, 2)
+
+    def test_durability_run(self):
+        c.durability = 'run'
+        c._fsync = Mock()
+        c.file('/d/f', data='x')
+        c.file('/d/g', data='y')
+        c.file('/e/h', data='z')
+        eq_(c._fsync.call_count, 0)
+        c.sync()
+        eq_(c._fsync.call_args_list, [call('/d/f'), call('/d/g'), call('/e/h'),
+                                      call('/d'), call('/e')])
+        c.sync()
+        eq_(c._fsync.call_count, 5)
+
+    def test_durability_run_syncfs(self):
+        c.durability = 'run'
+        c._fsync = Mock()
+        c._syncfs = Mock(return_value=True)
+        c.file('/d/f', data='x')
+        c.file('/d/g', data='y')
+        c.sync()
+        c._syncfs.assert_called_once_with('/d')
+        eq_(c._fsync.call_count, 0)
+
+    def test_download_hash_mismatch_leaves_nothing(self):
+        c.mock_urls['http://blah.com/blah.txt'] = 'asdf\n'
+        try:
+            c.download('/d/blah.txt', 'http://blah.com/blah.txt',
+                       md5='2b10042f7481c7b056c4b410d28f33cf')
+        except AssertionError:
+            pass
+        eq_(self.os.listdir('/d'), [])
+
+    def test_hashes_single_pass(self):
+        c.hashes._compute = Mock(wraps=c.hashes._compute)
+        eq_(c.hashes.digests('existingfile', ['md5', 'sha1']),
+            {'md5': '912ec803b2ce49e4a541068d495ab570',
+             'sha1': '3da541559918a808c2402bba5012f6c60b27661c'})
+        eq_(c.hashes._compute.call_count, 1)
+
+    def test_hashes_memoized(self):
+        c.fs.GetObject('existingfile').st_ino = 7
+        c.hashes._compute = Mock(wraps=c.hashes._compute)
+        eq_(c._hash_file('existingfile', 'md5'), '912ec803b2ce49e4a541068d495ab570')
+        eq_(c._hash_file('existingfile', 'md5'), '912ec803b2ce49e4a541068d495ab570')
+        eq_(c.hashes._compute.call_count, 1)
+        c._hash_file('existingfile', 'sha1')
+        eq_(c.hashes._compute.call_args[0][2], set(['sha1']))
+        with self.open('existingfile', 'wb') as f: f.write('asdff')
+        c.fs.GetObject('existingfile').st_ino = 7
+        eq_(c._hash_file('existingfile', 'md5'), '277f255555a1e4ff124bdacc528b815d')
+        eq_(c.hashes._compute.call_count, 3)
+
+    def test_hashes_persisted(self):
+        c.state.path = '/var/lib/carlcm/state.json'
+        c.fs.GetObject('existingfile').st_ino = 7
+        c._hash_file('existingfile', 'md5')
+        c.state.save()
+        c.state = StateStore(c, '/var/lib/carlcm/state.json')
+        c.hashes._compute = Mock(side_effect=AssertionError)
+        eq_(c._hash_file('existingfile', 'md5'), '912ec803b2ce49e4a541068d495ab570')
+
+    def test_prefetch_download(self):
+        sha256 = 'd1bc8d3ba4afc7e109612cb73acbdddac052c93025aa1f82942edabb7deb82a1'
+        c.mock_urls['http://blah.com/blah.txt'] = 'asdf\n'
+        c.artifacts = ArtifactCache(c, '/cache')
+        c.prefetch(downloads=[{'url': 'http://blah.com/blah.txt', 'sha256sum': sha256}])
+        c.finish_prefetch()
+        del c.mock_urls['http://blah.com/blah.txt']
+        eq_(c.download('/blah.txt', 'http://blah.com/blah.txt', sha256sum=sha256), True)
+        eq_(self.open('/blah.txt').read(), 'asdf\n')
+
+    def test_prefetch_needs_cache(self):
+        c.mock_urls['http://blah.com/blah.txt'] = 'asdf\n'
+        c.prefetch(downloads=[{'url': 'http://blah.com/blah.txt', 'sha256sum': '0' * 64}],
+                   pip=['asdf'])
+        c.finish_prefetch()
+        eq_(c.artifacts.enabled, False)
+        eq_(c.prefetching, {})
+        eq_(c._cmd_quiet.call_count, 0)
+
+    def test_prefetch_apt(self):
+        c.prefetch(apt=['git'])
+        c.apt('git')
+        eq_(c._cmd_quiet.call_count, 2)
+        eq_(c._cmd_quiet.call_args_list[0],
+            call(['apt-get', 'install', '--download-only', '-y', 'git']))
+        eq_(c._cmd_quiet.call_args_list[1][0][0][-1], 'git')
+
+    @raises(ValueError)
+    def test_run_modules_prefetch_error(self):
+        class M(carlcm.BaseModule):
+            def main(self, context):
+                raise ValueError()
+        c.add_modules(M())
+        try:
+            c.run_modules(prefetch=True)
+        finally:
+            eq_(c.prefetch_pool, None)
+
+    def test_run_modules_prefetch(self):
+        class M(carlcm.BaseModule):
+            def downloads(self):
+                return [{'url': 'http://blah.com/blah.txt', 'sha256sum': '0' * 64}]
+            def main(self, context):
+                pass
+        c.prefetch = Mock()
+        c.add_modules(M())
+        c.run_modules(prefetch=True)
+        c.prefetch.assert_called_once_with(
+            [{'url': 'http://blah.com/blah.txt', 'sha256sum': '0' * 64}], [], [])
+
+    def test_plan_file(self):
+        c.begin_plan()
+        eq_(c.file('existingfile', data='asdf', mode=0600, triggers='t'), True)
+        eq_(c.file('newfile', data='asdf'), True)
+        eq_(c.file('existingfile', data='asdf'), False)
+        eq_(c.file('existingfile', data='other'), True)
+        eq_(self.os.path.exists('newfile'), False)
+        eq_(self.open('existingfile').read(), 'asdf')
+        changes = c.planned.to_dict()['changes']
+        eq_(changes[0]['delta'], {'mode': ['0644', '0600']})
+        eq_(changes[0]['triggers'], ['t'])
+        eq_(changes[1]['delta'], {'create': True})
+        eq_(changes[2]['delta'], {'content': True})
+        eq_(len(c.planned), 3)
+
+    def test_plan_line_in_planned_file(self):
+        c.begin_plan()
+        eq_(c.file('/newfile', data='a\n'), True)
+        eq_(c.line_in_file('/newfile', 'b', triggers='t'), True)
+        eq_(c.line_in_file('existingfile', 'asdf', enforce_trailing_newline=False), False)
+        eq_(c.file('existingfile', data='other'), True)
+        eq_(c.line_in_file('existingfile', 'asdf'), True)
+        changes = c.planned.to_dict()['changes']
+        eq_(changes[1], {'action': 'line_in_file', 'resource': '/newfile',
+                         'delta': {'content': True}, 'triggers': ['t']})
+        eq_(changes[-1]['delta'], {'content': True})
+
+    def test_plan_triggers(self):
+        c.begin_plan()
+        c.dir('/newdir', triggers='newdir')
+        c.cmd(['echo', 'hi'], triggered_by='newdir')
+        c.cmd(['echo', 'bye'], triggered_by='nothing')
+        eq_(self.os.path.exists('/newdir'), False)
+        eq_(c._cmd.call_count, 0)
+        eq_(json.loads(c.planned.to_json()),
+            {'changes': [{'action': 'dir', 'resource': '/newdir',
+                          'delta': {'create': True}, 'triggers': ['newdir']},
+                         {'action': 'cmd', 'resource': 'echo hi', 'delta': {'run': True}}],
+             'triggers': ['newdir']})
+
+    def test_plan_packages(self):
+        c.apt_status_cache = None
+        c.current_apt_packages = Mock(return_value={'git': '1.0'})
+        c.begin_plan()
+        eq_(c.apt(['git', 'curl=7.0'], triggers='pkgs'), True)
+        eq_(c._cmd_quiet.call_count, 0)
+        eq_([(x['resource'], x['delta']) for x in c.planned.changes],
+            [('curl', {'install': 'curl=7.0'})])
+        eq_(c.triggers, set(['pkgs']))
+
+    def test_plan_users(self):
+        c.begin_plan()
+        eq_(c.group('root'), False)
+        eq_(c.group('newgroup'), True)
+        eq_(c.user('newuser', groups=['newgroup']), True)
+        eq_(c.mock_groups, [{'name': 'root', 'id': 0}])
+        eq_([x['resource'] for x in c.planned.changes], ['newgroup', 'newuser'])
+
+    def test_plan_unplanned_action(self):
+        c.actions['launch'] = Mock()
+        c.begin_plan()
+        eq_(c.launch('x'), False)
+        eq_(c.actions['launch'].call_count, 0)
+        eq_(c.planned.changes, [{'action': 'launch', 'resource': None, 'delta': {'unplanned': True}}])
+        eq_(len(c.planned), 0)
+
+    def test_user_password_unchanged(self):
+        c._chpasswd = Mock(wraps=c._chpasswd)
+        eq_(c.user('jessie', password='hunter2'), True)
+        eq_(c._chpasswd.call_count, 1)
+        eq_(c.user('jessie', password='hunter2'), False)
+        eq_(c._chpasswd.call_count, 1)
+        eq_(c.user('jessie', password='hunter3'), True)
+        eq_(c._chpasswd.call_count, 2)
+
+    def test_user_encrypted_password_unchanged(self):
+        c._chpasswd = Mock(wraps=c._chpasswd)
+        eq_(c.user('jessie', encrypted_password='$6$x$y'), True)
+        eq_(c.user('jessie', encrypted_password='$6$x$y'), False)
+        eq_(c._chpasswd.call_count, 1)
+
+    def test_users(self):
+        c._newusers = Mock(wraps=c._newusers)
+        c._chpasswd = Mock(wraps=c._chpasswd)
+        c.mock_users += [{'name':'jessie', 'id':1000, 'groups':['jessie'], 'home':'/home/jessie'}]
+        c.mock_groups += [{'name':'jessie', 'id':1000}]
+        eq_(c.users([{'username': 'jessie', 'groups': ['admins'], 'triggers': 'jessie'},
+                     {'username': 'alex', 'password': 'hunter2', 'authorized_keys': 'ssh-rsa a'},
+                     {'username': 'sam', 'encrypted_password': '$6$x$y'},
+                     {'username': 'kim', 'home': False}], triggers='users'), True)
+        eq_(sorted([u['username'] for u in c._newusers.call_args[0][0]]), ['alex', 'sam'])
+        eq_(c._chpasswd.call_args_list,
+            [call('alex:hunter2\n', False), call('sam:$6$x$y\nkim:!\n', True)])
+        eq_([x['groups'] for x in c.mock_users if x['name'] == 'jessie'], [['admins', 'jessie']])
+        eq_(c._read_file('/home/alex/.ssh/authorized_keys'), 'ssh-rsa a')
+        eq_(self.os.path.isdir('/home/kim'), False)
+        eq_(c.triggers, set(['jessie', 'users']))
+
+    def test_newusers_home(self):
+        c._cmd_in = Mock()
+        c._mkdir('/etc/default')
+        c._write_file('/etc/default/useradd', 'SHELL=/bin/sh\nHOME=/srv/home\n')
+        carlcm.ConfigurationManager._newusers(c, [
+            {'username': 'alex', 'home': True, 'uid': None, 'gid': None, 'comment': None, 'shell': None},
+            {'username': 'sam', 'home': '/var/sam', 'uid': 1001, 'gid': None, 'comment': None, 'shell': None}])
+        lines = [l.split(':') for l in c._cmd_in.call_args[0][1].splitlines()]
+        eq_([l[5] for l in lines], ['/srv/home/alex', '/var/sam'])
+
+    def test_users_unchanged(self):
+        specs = [{'username': 'alex', 'password': 'hunter2', 'authorized_keys': 'ssh-rsa a'},
+                 {'username': 'sam', 'encrypted_password': '$6$x$y', 'triggers': 'sam'}]
+        eq_(c.users(specs), True)
+        c._newusers = Mock()
+        c._chpasswd = Mock()
+        c.triggers = set()
+        eq_(c.users(specs), False)
+        eq_(c._newusers.call_count, 0)
+        eq_(c._chpasswd.call_count, 0)
+        eq_(c.triggers, set())
+
+    def test_handlers(self):
+        c.handler('consul', service='consul', action='reload')
+        c.handler('consul-restart', service='consul', action='restart')
+        c.handler('other', cmd='echo hi')
+        c.file('/a', data='a', triggers='consul')
+        c.file('/b', data='b', triggers='consul')
+        eq_(c._cmd.call_count, 0)
+        eq_(c.flush_handlers(), True)
+        eq_(c._cmd.call_args_list, [call(['service', 'consul', 'reload'], shell=False)])
+        eq_(c.flush_handlers(), False)
+        eq_(c._cmd.call_count, 1)
+
+    def test_handlers_restart_supersedes_reload(self):
+        c.file('/a', data='a', triggers=['consul', 'consul-restart', 'other'])
+        c.handler('consul', service='consul', action='reload')
+        c.handler('consul-restart', service='consul', action='restart')
+        c.handler('other', cmd='echo hi')
+        c.handler('other2', cmd='echo hi')
+        c.file('/b', data='b', triggers='other2')
+        c.flush_handlers()
+        eq_(c._cmd.call_args_list, [call(['service', 'consul', 'restart'], shell=False),
+                                    call('echo hi', shell=True)])
+
+    def test_handlers_kept_when_one_fails(self):
+        c.handler('first', cmd='echo 1')
+        c.handler('second', cmd='echo 2')
+        c.handler('third', cmd='echo 3')
+        c.file('/a', data='a', triggers=['first', 'second', 'third'])
+        c._cmd.side_effect = [0, OSError('boom')]
+        assert_raises(OSError, c.flush_handlers)
+        eq_(c.pending_handlers, set(['second', 'third']))
+        c._cmd.side_effect = None
+        eq_(c.flush_handlers(), True)
+        eq_(c._cmd.call_args_list[-2:], [call('echo 2', shell=True), call('echo 3', shell=True)])
+        eq_(c.pending_handlers, set())
+
+    def test_cmd_creates(self):
+        eq_(c.cmd(['make'], creates='existingfile', triggers='built'), False)
+        eq_(c.cmd(['make'], creates='/nothing'), True)
+        eq_(c._cmd.call_count, 1)
+        eq_(c.triggers, set())
+
+    def test_cmd_unless_onlyif(self):
+        eq_(c.cmd(['make'], unless='test -f x'), False)
+        c._succeeds.assert_called_once_with('test -f x')
+        eq_(c.cmd(['make'], onlyif='test -f x'), True)
+        c._succeeds.return_value = False
+        eq_(c.cmd(['make'], unless='test -f x'), True)
+        eq_(c.cmd(['make'], onlyif='test -f x'), False)
+        eq_(c._cmd.call_count, 2)
+
+    def test_cmd_inputs(self):
+        c.state.path = '/var/lib/carlcm/state.json'
+        eq_(c.cmd(['make'], inputs=['existingfile']), True)
+        eq_(c.cmd(['make'], inputs=['existingfile']), False)
+        eq_(c.cmd(['make', 'all'], inputs=['existingfile']), True)
+        with self.open('existingfile', 'wb') as f: f.write('changed')
+        eq_(c.cmd(['make'], inputs=['existingfile']), True)
+        eq_(c._cmd.call_count, 3)
+        c.state.save()
+        c.state = StateStore(c, '/var/lib/carlcm/state.json')
+        eq_(c.cmd(['make'], inputs=['existingfile']), False)
+
+    def test_cmd_inputs_missing(self):
+        c.state.path = '/var/lib/carlcm/state.json'
+        eq_(c.cmd(['make'], inputs=['/nothing']), True)
+        eq_(c.cmd(['make'], inputs=['/nothing']), False)
+        c._write_file('/nothing', 'something')
+        eq_(c.cmd(['make'], inputs=['/nothing']), True)
+        eq_(c._cmd.call_count, 2)
+
+    def test_cmd_inputs_failed_run_not_recorded(self):
+        c.state.path = '/var/lib/carlcm/state.json'
+        c._cmd.side_effect = Exception('failed')
+        assert_raises(Exception, c.cmd, ['make'], inputs=['existingfile'])
+        c._cmd.side_effect = None
+        eq_(c.cmd(['make'], inputs=['existingfile']), True)
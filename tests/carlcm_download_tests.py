@@ -0,0 +1,142 @@
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from nose.tools import *
+
+import carlcm
+import carlcm.configuration_manager
+
+c = None
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    body = 'hello world\n' * 1000
+    etag = '"v1"'
+    last_modified = 'Wed, 21 Oct 2015 07:28:00 GMT'
+    honor_range_start = True
+    requests = []
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        Handler.requests.append((self.command, dict(self.headers)))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = self.body
+        rng = self.headers.get('Range')
+        if rng:
+            start, _, end = rng[len('bytes='):].partition('-')
+            if int(start) >= len(body):
+                self.send_response(416)
+                self.end_headers()
+                return
+            start = int(start) if self.honor_range_start else 0
+            body = body[start:int(end) + 1 if end else len(body)]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, start + len(body) - 1, len(self.body)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', self.etag)
+        self.send_header('Last-Modified', self.last_modified)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestCarlCMDownload(object):
+
+    def setup(self):
+        global c
+        Handler.body = 'hello world\n' * 1000
+        Handler.etag = '"v1"'
+        Handler.honor_range_start = True
+        Handler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/file.txt' % self.server.server_port
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sub', 'file.txt')
+        c = carlcm.ConfigurationManager(state_path=os.path.join(self.dir, 'state.json'))
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def sha256(self):
+        return hashlib.sha256(Handler.body).hexdigest()
+
+    def test_hashed(self):
+        eq_(c.download(self.path, self.url, sha256=self.sha256()), True)
+        eq_(open(self.path).read(), Handler.body)
+        eq_(os.listdir(os.path.dirname(self.path)), ['file.txt'])
+        eq_(c.download(self.path, self.url, sha256=self.sha256()), False)
+        eq_(len(Handler.requests), 1)
+
+    @raises(AssertionError)
+    def test_hash_mismatch(self):
+        c.download(self.path, self.url, sha256='0' * 64)
+
+    def test_last_modified(self):
+        c.download(self.path, self.url)
+        eq_(os.stat(self.path).st_mtime, 1445412480)
+
+    def test_revalidate(self):
+        eq_(c.download(self.path, self.url, revalidate=True), True)
+        eq_(c.download(self.path, self.url, revalidate=True), False)
+        eq_(Handler.requests[-1][1].get('if-none-match'), '"v1"')
+        Handler.body = 'changed\n'
+        Handler.etag = '"v2"'
+        eq_(c.download(self.path, self.url, revalidate=True), True)
+        eq_(open(self.path).read(), 'changed\n')
+        eq_(c.download(self.path, self.url), False)
+
+    def test_resume(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(c._partial_path(self.path), 'wb') as f:
+            f.write(Handler.body[:5000])
+        eq_(c.download(self.path, self.url, sha256=self.sha256()), True)
+        eq_(open(self.path).read(), Handler.body)
+        eq_(Handler.requests[0][1].get('range'), 'bytes=5000-')
+
+    def test_resume_past_end(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(c._partial_path(self.path), 'wb') as f:
+            f.write(Handler.body + 'stale')
+        eq_(c.download(self.path, self.url, sha256=self.sha256()), True)
+        eq_(open(self.path).read(), Handler.body)
+        eq_([r[1].get('range') for r in Handler.requests], ['bytes=12005-', None])
+
+    def test_resume_wrong_range(self):
+        Handler.honor_range_start = False
+        os.makedirs(os.path.dirname(self.path))
+        with open(c._partial_path(self.path), 'wb') as f:
+            f.write(Handler.body[:5000])
+        eq_(c.download(self.path, self.url, sha256=self.sha256()), True)
+        eq_(open(self.path).read(), Handler.body)
+        eq_([r[1].get('range') for r in Handler.requests], ['bytes=5000-', None])
+
+    def test_parallel(self):
+        old_chunk_size = carlcm.configuration_manager.CHUNK_SIZE
+        carlcm.configuration_manager.CHUNK_SIZE = 1000
+        try:
+            eq_(c.download(self.path, self.url, parallel=4, sha256=self.sha256()), True)
+        finally:
+            carlcm.configuration_manager.CHUNK_SIZE = old_chunk_size
+        eq_(open(self.path).read(), Handler.body)
+        eq_(sorted([r[1].get('range') for r in Handler.requests if r[0] == 'GET']),
+            ['bytes=0-2999', 'bytes=3000-5999', 'bytes=6000-8999', 'bytes=9000-11999'])
@@ -0,0 +1,117 @@
+import json
+
+from mock import Mock, patch
+from nose.tools import *
+
+import carlcm
+from carlcm.facts import Facts
+
+c = None
+
+IDENTITY = {'instanceId': 'i-0123456789abcdef0', 'region': 'us-west-2',
+            'availabilityZone': 'us-west-2b', 'privateIp': '10.0.1.23',
+            'instanceType': 't2.micro', 'accountId': '123456789012',
+            'imageId': 'ami-12345678'}
+
+class TestCarlCMFacts(object):
+
+    def setup(self):
+        global c
+        c = carlcm.MockConfigurationManager()
+        c.facts = Facts(c, '/var/cache/carlcm/facts.json', metadata_url='http://metadata/latest/')
+        self.url = 'http://metadata/latest/dynamic/instance-identity/document'
+        c.mock_urls[self.url] = json.dumps(IDENTITY)
+        c._http_open = Mock(wraps=c._http_open)
+        c._mkdir('/proc/net')
+        c._write_file('/proc/meminfo', 'MemTotal:        2048 kB\nMemFree:          512 kB\n')
+        c._write_file('/proc/net/fib_trie', '''Main:
+  +-- 0.0.0.0/0 3 0 5
+     |-- 0.0.0.0
+        /0 universe UNICAST
+     +-- 10.0.1.0/24 2 0 2
+        |-- 10.0.1.0
+           /32 link BROADCAST
+           /24 link UNICAST
+        |-- 10.0.1.23
+           /32 host LOCAL
+  +-- 127.0.0.0/8 2 0 2
+     |-- 127.0.0.1
+        /32 host LOCAL
+''')
+
+    def test_ec2(self):
+        eq_(c.facts.get('ec2'),
+            {'instance-id': 'i-0123456789abcdef0', 'region': 'us-west-2',
+             'availability-zone': 'us-west-2b', 'local-ipv4': '10.0.1.23',
+             'instance-type': 't2.micro', 'account-id': '123456789012',
+             'ami-id': 'ami-12345678'})
+
+    def test_not_in_ec2(self):
+        del c.mock_urls[self.url]
+        with patch('time.time', return_value=1000.0):
+            eq_(c.facts.get('ec2'), None)
+            # and that's cached too, for a while
+            eq_(c.facts.get('ec2'), None)
+        eq_(c._http_open.call_count, 1)
+        c.mock_urls[self.url] = json.dumps(IDENTITY)
+        with patch('time.time', return_value=1000.0 + Facts.negative_ttl):
+            eq_(c.facts.get('ec2')['region'], 'us-west-2')
+        eq_(c._http_open.call_count, 2)
+
+    def test_host_facts(self):
+        eq_(c.facts['memory_bytes'], 2048 * 1024)
+        eq_(c.facts['ipv4_addresses'], ['10.0.1.23', '127.0.0.1'])
+        ok_(c.facts['cpu_count'] >= 1)
+        ok_(c.facts['hostname'])
+
+    @raises(KeyError)
+    def test_unknown_fact(self):
+        c.facts.get('favorite_color')
+
+    def test_cached_on_disk(self):
+        c.facts.get('ec2')
+        c.facts.get('memory_bytes')
+        facts = Facts(c, '/var/cache/carlcm/facts.json', metadata_url='http://metadata/latest/')
+        eq_(facts.get('ec2')['instance-id'], 'i-0123456789abcdef0')
+        eq_(facts.get('memory_bytes'), 2048 * 1024)
+        eq_(facts.gathered, 0)
+        eq_(c._http_open.call_count, 1)
+
+    def test_reboot_ignores_cache(self):
+        c._mkdir('/proc/sys/kernel/random')
+        c._write_file('/proc/sys/kernel/random/boot_id', 'boot-1\n')
+        c.facts.get('memory_bytes')
+        c._write_file('/proc/sys/kernel/random/boot_id', 'boot-2\n')
+        facts = Facts(c, '/var/cache/carlcm/facts.json')
+        facts.get('memory_bytes')
+        eq_(facts.gathered, 1)
+        eq_(json.loads(c._read_file('/var/cache/carlcm/facts.json'))['boot_id'], 'boot-2')
+
+    def test_ttl(self):
+        with patch('time.time', return_value=1000.0):
+            c.facts.get('memory_bytes')
+        c._write_file('/proc/meminfo', 'MemTotal:        4096 kB\n')
+        with patch('time.time', return_value=1000.0 + Facts.ttls['memory_bytes'] - 1):
+            eq_(c.facts.get('memory_bytes'), 2048 * 1024)
+        with patch('time.time', return_value=1000.0 + Facts.ttls['memory_bytes']):
+            eq_(c.facts.get('memory_bytes'), 4096 * 1024)
+
+    def test_invalidate(self):
+        c.facts.get('memory_bytes')
+        c._write_file('/proc/meminfo', 'MemTotal:        4096 kB\n')
+        c.facts.invalidate('memory_bytes')
+        eq_(c.facts.get('memory_bytes'), 4096 * 1024)
+
+    def test_one_metadata_request_per_converge(self):
+        c.add_action_module('carlcm.actions.aws', in_ec2=True, ec2=Mock(), iam=Mock())
+        eq_(c.aws_mock.region, 'us-west-2')
+        counselor = carlcm.Counselor(in_ec2=True, facts=c.facts, ec2=Mock(), iam=Mock())
+        eq_(counselor.region, 'us-west-2')
+        eq_(counselor.meta['local-ipv4'], '10.0.1.23')
+        ec2 = Mock()
+        ec2.get_only_instances.return_value = ['instance']
+        with patch('boto.ec2.connect_to_region', return_value=ec2) as connect:
+            eq_(c.aws_info(), 'instance')
+        connect.assert_called_once_with('us-west-2')
+        ec2.get_only_instances.assert_called_once_with('i-0123456789abcdef0')
+        eq_(c._http_open.call_count, 1)
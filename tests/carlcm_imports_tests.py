@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+
+from nose.tools import *
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+HEAVY = ['boto', 'consul', 'jinja2', 'requests', 'yaml']
+
+def imported(code):
+    '''
+    the heavy dependencies a fresh interpreter has imported after code.
+    '''
+    out = subprocess.check_output([sys.executable, '-c', code + '''
+import sys
+print ' '.join(sorted(set([m.split('.')[0] for m in sys.modules if sys.modules[m] is not None])))
+'''], cwd=ROOT)
+    return sorted(set(out.split()) & set(HEAVY))
+
+class TestCarlCMImports(object):
+
+    def test_context(self):
+        eq_(imported('import carlcm; carlcm.Context()'), [])
+
+    def test_aws_actions(self):
+        eq_(imported('''
+import carlcm
+c = carlcm.Context()
+c.add_action_module('carlcm.actions.aws')
+assert 'launch_instance' in c.actions
+'''), [])
+
+    def test_catalog(self):
+        eq_(imported('''
+from carlcm.catalog import Catalog
+from carlcm.configuration_manager import ConfigurationManager
+Catalog(ConfigurationManager())
+'''), [])
+
+    def test_loaded_on_first_use(self):
+        eq_(imported('''
+import carlcm
+c = carlcm.MockConfigurationManager()
+c._mkdir('/etc')
+c.file('/etc/a.yaml', yaml_data={'a': 1})
+c.file('/etc/b', template='{{ b }}', b=2)
+'''), ['jinja2', 'yaml'])
@@ -0,0 +1,83 @@
+import threading
+
+from nose.tools import *
+
+import carlcm
+
+c = None
+
+class TestCarlCMMetrics(object):
+
+    def setup(self):
+        global c
+        c = carlcm.MockConfigurationManager()
+
+    def test_actions_recorded(self):
+        c.file('/a', data='asdf')
+        c.file('/a', data='asdf')
+        eq_([(r['action'], r['resource'], r['changed'], r['bytes_written'])
+             for r in c.metrics.resources],
+            [('file', '/a', True, 4), ('file', '/a', False, 0)])
+        eq_(c.metrics.resources[1]['bytes_read'], 4)
+
+    def test_nested_time_is_exclusive(self):
+        c.mock_users += [{'name':'jessie', 'id':1000, 'home':'/home/jessie'}]
+        c.mock_groups += [{'name':'jessie', 'id':1000}]
+        c.authorized_keys('jessie', 'ssh-rsa a')
+        records = dict([(r['action'], r) for r in c.metrics.resources])
+        eq_(sorted(records), ['authorized_keys', 'file', 'mkdir'])
+        eq_(records['authorized_keys']['bytes_written'], 0)
+        eq_(records['file']['bytes_written'], 9)
+
+    def test_subprocesses_counted(self):
+        c = carlcm.ConfigurationManager()
+        c.cmd(['true'], quiet=True)
+        eq_(c.metrics.resources[0]['subprocesses'], 1)
+        eq_(c.metrics.summary()[None]['subprocesses'], 1)
+
+    def test_summary_per_module(self):
+        class M(carlcm.BaseModule):
+            def main(self, context):
+                context.file('/a', data='a')
+                context.file('/b', data='b')
+        c.add_modules(M())
+        c.run_modules()
+        s = c.metrics.summary()['M']
+        eq_((s['calls'], s['changed'], s['unchanged'], s['bytes_written']), (2, 2, 0, 2))
+
+    def test_format_summary(self):
+        c.metrics.module = 'M'
+        c.file('/a', data='asdf')
+        lines = c.metrics.format_summary().splitlines()
+        eq_(lines[0].split(), ['module', 'calls', 'changed', 'seconds', 'subprocesses',
+                               'subprocess_seconds', 'bytes_read', 'bytes_written'])
+        eq_(lines[1].split()[:3], ['M', '1', '1'])
+        eq_(lines[1].split()[-1], '4')
+
+    def test_other_threads_not_counted(self):
+        def worker():
+            c.metrics.count('bytes_written', 100)
+            c._cmd_quiet(['true'])
+        def action(path):
+            t = threading.Thread(target=worker)
+            t.start()
+            t.join()
+            return False
+        c.metrics.measure('action', '/a', action, '/a')
+        eq_(c.metrics.resources[0]['bytes_written'], 0)
+        eq_(c.metrics.resources[0]['subprocesses'], 0)
+
+    def test_textfile(self):
+        c.metrics.textfile_path = '/var/lib/node_exporter/carlcm.prom'
+        c.file('/a', data='asdf')
+        c.metrics.finish()
+        prom = c._read_file('/var/lib/node_exporter/carlcm.prom')
+        ok_('carlcm_action_written_bytes{module="",action="file"} 4\n' in prom)
+        ok_('carlcm_actions{module="",action="file",outcome="changed"} 1\n' in prom)
+        ok_('# TYPE carlcm_run_seconds gauge\n' in prom)
+
+    def test_textfile_escaped(self):
+        c.metrics.module = 'My"Module\\\n'
+        c.file('/a', data='asdf')
+        ok_('carlcm_actions{module="My\\"Module\\\\\\n",action="file",outcome="changed"} 1\n'
+            in c.metrics.textfile())
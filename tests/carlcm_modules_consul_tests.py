@@ -32,7 +32,7 @@ class TestCarlCMConsulTests(object):
         c.packages = Mock()
         c.add_modules(m)
         c.run_modules()
-        eq_(c.users[1]['name'], 'consul')
+        eq_(c.mock_users[1]['name'], 'consul')
         eq_(c.os.path.isfile('/etc/init/consul.conf'), True)
 
     def test_module_server(self):
@@ -42,7 +42,15 @@ class TestCarlCMConsulTests(object):
         c.packages = Mock()
         c.add_modules(m)
         c.run_modules()
-        eq_(c.users[1]['name'], 'consul')
+        eq_(c.mock_users[1]['name'], 'consul')
         eq_(c.os.path.isfile('/etc/init/consul.conf'), True)
         conf = json.loads(c.open('/etc/consul.d/config.json').read())
         eq_(conf['server'], False)
+
+    def test_module_restarts_once(self):
+        m = carlcm.ConsulModule(mode='client')
+        m._acquire_consul = Mock()
+        c.packages = Mock()
+        c.add_modules(m)
+        c.run_modules()
+        eq_(c._cmd.call_args_list, [call(['service', 'consul', 'restart'], shell=False)])
@@ -0,0 +1,47 @@
+import marshal
+
+from nose.tools import *
+
+import carlcm
+
+c = None
+
+def busy(n):
+    return sum([i * i for i in xrange(n)])
+
+def outer():
+    return busy(100000) + busy(100000)
+
+class TestCarlCMProfiling(object):
+
+    def setup(self):
+        global c
+        c = carlcm.MockConfigurationManager()
+
+    def test_disabled(self):
+        eq_(c.profiler.run('x', outer), outer())
+        eq_(c.os.path.exists('/prof'), False)
+
+    def test_run_modules(self):
+        c.profiler.path = '/prof'
+        class M(carlcm.BaseModule):
+            def main(self, context):
+                outer()
+        c.add_modules(M())
+        c.run_modules()
+        eq_(sorted(c.os.listdir('/prof')), ['M.collapsed', 'M.pstats'])
+        stats = marshal.loads(c._read_file('/prof/M.pstats'))
+        ok_([f for f in stats if f[2] == 'busy'])
+        lines = c._read_file('/prof/M.collapsed').splitlines()
+        busy_lines = [l for l in lines if l.rsplit(' ', 1)[0].split(';')[-1].startswith('busy (')]
+        eq_(len(busy_lines), 1)
+        ok_(';outer (carlcm_profiling_tests.py:' in busy_lines[0])
+        ok_(int(busy_lines[0].rsplit(' ', 1)[1]) > 0)
+
+    def test_nested_runs_are_exclusive(self):
+        c.profiler.path = '/prof'
+        c.profiler.run('role', lambda: c.profiler.run('module', outer))
+        role = marshal.loads(c._read_file('/prof/role.pstats'))
+        module = marshal.loads(c._read_file('/prof/module.pstats'))
+        eq_([f for f in role if f[2] == 'busy'], [])
+        ok_([f for f in module if f[2] == 'busy'])
@@ -0,0 +1,86 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from nose.tools import *
+
+import carlcm
+from carlcm.runner import CommandTimeout, Runner
+
+c = None
+
+class TestCarlCMRunner(object):
+
+    def setup(self):
+        global c
+        self.dir = tempfile.mkdtemp()
+        c = carlcm.ConfigurationManager()
+        c.runner = Runner(c, log_path=os.path.join(self.dir, 'cmd.log'), kill_grace=1)
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_output(self):
+        eq_(c._cmd_quiet(['sh', '-c', 'echo out; echo err >&2']), 'out\nerr\n')
+        eq_(c.runner.history[0].returncode, 0)
+        log = open(os.path.join(self.dir, 'cmd.log')).read()
+        ok_('] sh -c echo out; echo err >&2\nout\nerr\n' in log)
+        ok_('exited 0 after' in log)
+
+    def test_stdin(self):
+        eq_(c._cmd_in(['cat'], 'a:b\n'), 'a:b\n')
+
+    @raises(subprocess.CalledProcessError)
+    def test_failure(self):
+        c._cmd_quiet(['false'])
+
+    def test_ring_buffer(self):
+        c.runner.buffer_size = 10
+        eq_(c._cmd_quiet('seq 1 100', shell=True), '98\n99\n100\n')
+        eq_(c.runner.history[0].dropped, 282)
+
+    def test_timeout_kills_process_group(self):
+        pidfile = os.path.join(self.dir, 'pid')
+        start = time.time()
+        try:
+            c.cmd('sleep 30 & echo $! > %s; wait' % pidfile, shell=True, quiet=True, timeout=0.5)
+        except CommandTimeout as e:
+            eq_(e.timeout, 0.5)
+        else:
+            ok_(False, 'should have timed out')
+        ok_(time.time() - start < 5)
+        pid = int(open(pidfile).read())
+        time.sleep(0.1)
+        # gone, or a zombie nobody has reaped yet
+        if os.path.exists('/proc/%d/stat' % pid):
+            eq_(open('/proc/%d/stat' % pid).read().split(') ')[1][0], 'Z')
+
+    def test_daemon_holding_stdout(self):
+        start = time.time()
+        eq_(c._cmd(['sh', '-c', 'echo started; sleep 3 &']), 0)
+        ok_(time.time() - start < 1)
+        eq_(c._cmd_quiet(['sh', '-c', 'echo started; sleep 3 &']), 'started\n')
+        ok_(time.time() - start < 2)
+
+    def test_begin_run_clears_history(self):
+        c._cmd_quiet(['true'])
+        c.begin_run()
+        eq_(c.runner.history, [])
+
+    @raises(CommandTimeout)
+    def test_run_timeout(self):
+        c.runner.run_timeout = 0
+        c._cmd_quiet(['true'])
+
+    def test_run_all(self):
+        c.runner = Runner(c, max_workers=2)
+        start = time.time()
+        results = c.runner.run_all([['sleep', '0.3']] * 4 + [['echo', 'hi']])
+        ok_(0.6 <= time.time() - start < 2)
+        eq_(results[-1].output, 'hi\n')
+
+    def test_succeeds(self):
+        eq_(c._succeeds('test -d /'), True)
+        eq_(c._succeeds(['false']), False)
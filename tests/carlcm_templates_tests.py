@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from nose.tools import *
+from mock import Mock
+
+import carlcm
+
+c = None
+
+class TestCarlCMTemplates(object):
+
+    def setup(self):
+        global c
+        c = carlcm.MockConfigurationManager()
+        c._mkdir('/t/sub')
+        c._write_file('/t/base.j2', 'header\n{% block body %}{% endblock %}\nfooter')
+        c._write_file('/t/page.j2', '{% extends "base.j2" %}{% block body %}'
+                      '{% include "sub/part.j2" %}{% endblock %}')
+        c._write_file('/t/sub/part.j2', 'hello {{ name }}')
+
+    def test_inheritance_and_includes(self):
+        eq_(c.file('/out', template_file='/t/page.j2', name='carl'), True)
+        eq_(c._read_file('/out'), 'header\nhello carl\nfooter')
+
+    def test_inline_compiled_once(self):
+        env = c.templates.environment
+        env.compile = Mock(wraps=env.compile)
+        eq_(c.file('/a', template='{{ x }}!', x='1'), True)
+        eq_(c.file('/b', template='{{ x }}!', x='2'), True)
+        eq_(c._read_file('/b'), '2!')
+        eq_(env.compile.call_count, 1)
+
+    def test_begin_run_clears_inline(self):
+        eq_(c.file('/a', template='{{ x }}!', x='1'), True)
+        c.begin_run()
+        eq_(c.templates.environment.loader.inline, {})
+        eq_(c.file('/a', template='{{ x }}!', x='2'), True)
+        eq_(c._read_file('/a'), '2!')
+
+    def test_template_file_reloaded_when_changed(self):
+        env = c.templates.environment
+        env.compile = Mock(wraps=env.compile)
+        c.file('/a', template_file='/t/sub/part.j2', name='carl')
+        c.file('/b', template_file='/t/sub/part.j2', name='carl')
+        eq_(env.compile.call_count, 1)
+        c._write_file('/t/sub/part.j2', 'goodbye {{ name }}')
+        c.file('/a', template_file='/t/sub/part.j2', name='carl')
+        eq_(c._read_file('/a'), 'goodbye carl')
+        eq_(env.compile.call_count, 2)
+
+    def test_unicode(self):
+        c.file('/a', template=u'☃ {{ x }}', x=u'é')
+        eq_(c._read_file('/a'), u'☃ é'.encode('utf-8'))
+
+    def test_bytecode_cache(self):
+        d = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(d, 'a.j2'), 'wb') as f:
+                f.write('{{ x }}df')
+            c1 = carlcm.ConfigurationManager(bytecode_cache_path=os.path.join(d, 'bytecode'))
+            eq_(c1.templates.render(template_file=os.path.join(d, 'a.j2'), vars={'x': 'as'}), 'asdf')
+            eq_(len(os.listdir(os.path.join(d, 'bytecode'))), 1)
+            c2 = carlcm.ConfigurationManager(bytecode_cache_path=os.path.join(d, 'bytecode'))
+            c2.templates.environment._parse = Mock(side_effect=AssertionError)
+            eq_(c2.templates.render(template_file=os.path.join(d, 'a.j2'), vars={'x': 'bl'}), 'bldf')
+        finally:
+            shutil.rmtree(d)
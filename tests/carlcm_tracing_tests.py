@@ -0,0 +1,61 @@
+import json
+
+from nose.tools import *
+
+import carlcm
+from carlcm.tracing import Tracer, NO_SPAN
+
+c = None
+
+class TestCarlCMTracing(object):
+
+    def setup(self):
+        global c
+        c = carlcm.MockConfigurationManager()
+
+    def test_disabled(self):
+        eq_(c.tracer.span('x', 'action'), NO_SPAN)
+        c.file('/a', data='a')
+        eq_(c.tracer.spans, [])
+
+    def test_chrome_trace(self):
+        c.tracer = Tracer(c, '/trace.json')
+        class M(carlcm.BaseModule):
+            def main(self, context):
+                context.mock_users += [{'name':'jessie', 'id':1000, 'home':'/home/jessie'}]
+                context.mock_groups += [{'name':'jessie', 'id':1000}]
+                context.authorized_keys('jessie', 'ssh-rsa a')
+        c.add_modules(M())
+        c.run_modules()
+        events = json.loads(c._read_file('/trace.json'))['traceEvents']
+        by_name = dict([(e['name'], e) for e in events])
+        eq_(by_name['M']['cat'], 'module')
+        eq_(by_name['authorized_keys']['args']['parent'], by_name['M']['args']['id'])
+        eq_(by_name['file']['args']['parent'], by_name['authorized_keys']['args']['id'])
+        eq_(by_name['file']['args']['resource'], '/home/jessie/.ssh/authorized_keys')
+        eq_(by_name['file']['ph'], 'X')
+        ok_(by_name['M']['dur'] >= by_name['file']['dur'])
+
+    def test_begin_run_starts_over(self):
+        c.tracer = Tracer(c, '/trace.json')
+        c.file('/a', data='a')
+        c.begin_run()
+        c.file('/b', data='b')
+        eq_([s.args['resource'] for s in c.tracer.spans], ['/b'])
+
+    def test_jsonl(self):
+        c.tracer = Tracer(c, '/var/log/carlcm/trace.jsonl', format='jsonl')
+        c.mock_urls['http://blah.com/blah.txt'] = 'asdf\n'
+        c.download('/blah.txt', 'http://blah.com/blah.txt')
+        c.tracer.save()
+        events = [json.loads(l) for l in c._read_file('/var/log/carlcm/trace.jsonl').splitlines()]
+        eq_([(e['name'], e['cat']) for e in events], [('fetch', 'http'), ('download', 'action')])
+        eq_(events[0]['parent'], events[1]['id'])
+        eq_(events[0]['args']['url'], 'http://blah.com/blah.txt')
+
+    def test_subprocess_span(self):
+        c = carlcm.ConfigurationManager()
+        c.tracer = Tracer(c, '/dev/null')
+        c.cmd(['true'], quiet=True)
+        eq_([(s.name, s.args.get('cmd')) for s in c.tracer.spans], [('cmd', ['true']), ('cmd', None)])
+        eq_(c.tracer.spans[0].parent, c.tracer.spans[1].id)